@@ -0,0 +1,848 @@
+"""
+Нагрузочный бенчмарк FSM API.
+
+Сценарий load бьёт по запущенному серверу (uvicorn main:app).
+Сценарий exchange работает напрямую с БД (DB_HOST, DB_PORT, DB_NAME,
+DB_USER, DB_PASSWORD): наполняет биржу курьера1 тестовыми заказами и
+после каждого шага роста меряет страницу биржи и опрос по since.
+Сценарий packing (та же БД) из N потоков создаёт заказы на одном
+маршруте и проверяет, что рейсы не переполнены и не размножились.
+Сценарий lifecycle гоняет N конкурентных клиентов через полный цикл
+заказа (create-smart → резерв → курьер1 → рейс → постамат2 → доставка)
+по API приложения в том же процессе — на FSM-симуляторе (--backend memory)
+или на MySQL. Сценарий compare сравнивает два таких результата.
+
+Использование:
+python benchmark.py load --url http://localhost:8000/api/orders --concurrency 50 --duration 10
+python benchmark.py load --url http://localhost:8000/health -c 100 -d 30 --output before.json
+python benchmark.py exchange --sizes 1000,10000,100000 --output exchange.json
+python benchmark.py packing --threads 32 --orders 2000 --output packing.json
+python benchmark.py lifecycle --clients 20 --rounds 10 --output after.json
+python benchmark.py compare before.json after.json --threshold 0.2
+
+Результат — JSON со статистикой: requests/sec, p50/p95/p99 latency (мс), ошибки.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль по отсортированному списку (nearest-rank)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    """Сводка по замерам одного эндпоинта (latency в секундах)."""
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "elapsed_sec": round(elapsed, 3),
+        "rps": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def run_load(url: str, concurrency: int, duration: float, method: str = "GET") -> Dict:
+    """N клиентов без пауз бьют в один URL в течение duration секунд."""
+    deadline = time.perf_counter() + duration
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def client() -> None:
+        nonlocal errors
+        local_latencies: List[float] = []
+        local_errors = 0
+        while time.perf_counter() < deadline:
+            request = urllib.request.Request(url, method=method)
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                local_latencies.append(time.perf_counter() - started)
+            except (urllib.error.URLError, OSError):
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies, errors, elapsed)
+    result.update({"url": url, "method": method, "concurrency": concurrency})
+    return result
+
+
+EXCHANGE_MARK = "benchmark-exchange"
+PACKING_MARK = "benchmark-packing"
+
+
+def _db_from_env(**kwargs):
+    from db_layer import DatabaseLayer
+
+    return DatabaseLayer(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=int(os.getenv("DB_PORT", "3307")),
+        database=os.getenv("DB_NAME", "testdb"),
+        user=os.getenv("DB_USER", "root"),
+        password=os.getenv("DB_PASSWORD", "root"),
+        **kwargs,
+    )
+
+
+def _bench_cell(db, locker_id: int = 900, address: str = "Msk, benchmark") -> int:
+    """Постамат и ячейка для тестовых заказов (создаются один раз)."""
+    db.create_locker_model(900, "benchmark")
+    db.create_locker(locker_id, f"BENCH-{locker_id}", address)
+    return db.create_locker_cell(locker_id, "BENCH", "S")
+
+
+def _grow_exchange(db, cell_id: int, count: int, chunk: int = 1000) -> None:
+    """Добавить count заказов в биржу курьера1 (пополам Msk/Spb)."""
+    from sqlalchemy import text
+
+    ids = db.get_city_ids(["Msk", "Spb", "Kzn"])
+    for start in range(0, count, chunk):
+        size = min(chunk, count - start)
+        values = ", ".join(
+            f"('order_courier_reserved_post1_and_post2', :mark, 'courier', 'courier', "
+            f"{':msk' if (start + i) % 2 == 0 else ':spb'}, :kzn, "
+            f"{':msk_id' if (start + i) % 2 == 0 else ':spb_id'}, :kzn_id, :cell, :cell)"
+            for i in range(size)
+        )
+        with db.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO orders (status, description, pickup_type, delivery_type, "
+                    "from_city, to_city, from_city_id, to_city_id, source_cell_id, dest_cell_id) "
+                    "VALUES " + values
+                ),
+                {
+                    "mark": EXCHANGE_MARK,
+                    "cell": cell_id,
+                    "msk": "Msk",
+                    "spb": "Spb",
+                    "kzn": "Kzn",
+                    "msk_id": ids["Msk"],
+                    "spb_id": ids["Spb"],
+                    "kzn_id": ids["Kzn"],
+                },
+            )
+
+
+def _time_calls(func, repeat: int) -> Dict:
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies, 0, sum(latencies))
+
+
+def run_exchange(sizes: List[int], repeat: int, page_size: int, keep: bool) -> Dict:
+    """
+    Рост биржи до каждого из sizes и замеры:
+    - first_page — первая страница биржи по городу;
+    - next_page — страница по cursor из середины выборки;
+    - since_poll — опрос изменений с актуальным since (перечитывает только
+      изменения последних EXCHANGE_POLL_LAG_SECONDS секунд).
+    """
+    db = _db_from_env()
+    steps = []
+    try:
+        cell_id = _bench_cell(db)
+        total = 0
+        for size in sorted(sizes):
+            _grow_exchange(db, cell_id, size - total)
+            total = size
+
+            middle = None
+            page = db.get_exchange_orders("pickup", "Msk", page_size)
+            for _ in range(5):
+                if not page["next_cursor"]:
+                    break
+                middle = page["next_cursor"]
+                page = db.get_exchange_orders("pickup", "Msk", page_size, middle)
+            since = db.get_exchange_orders("pickup", "Msk", page_size, since="0")["since"]
+            # Догоняем since до горизонта опроса (дальше он не сдвигается)
+            while True:
+                polled = db.get_exchange_orders("pickup", "Msk", 500, since=since)
+                if polled["since"] == since:
+                    break
+                since = polled["since"]
+            db.release_session()
+
+            step = {
+                "exchange_size": total,
+                "first_page": _time_calls(
+                    lambda: db.get_exchange_orders("pickup", "Msk", page_size), repeat
+                ),
+                "next_page": _time_calls(
+                    lambda: db.get_exchange_orders("pickup", "Msk", page_size, middle), repeat
+                ),
+                "since_poll": _time_calls(
+                    lambda: db.get_exchange_orders("pickup", "Msk", page_size, since=since), repeat
+                ),
+            }
+            db.release_session()
+            steps.append(step)
+            print(
+                f"{total:>8} заказов: first p50={step['first_page']['p50_ms']} мс, "
+                f"next p50={step['next_page']['p50_ms']} мс, "
+                f"since p50={step['since_poll']['p50_ms']} мс"
+            )
+    finally:
+        if not keep:
+            from sqlalchemy import text
+
+            while True:
+                with db.engine.begin() as conn:
+                    deleted = conn.execute(
+                        text("DELETE FROM orders WHERE description = :mark LIMIT 5000"),
+                        {"mark": EXCHANGE_MARK},
+                    ).rowcount
+                if not deleted:
+                    break
+        db.close()
+
+    return {"scenario": "exchange", "page_size": page_size, "repeat": repeat, "steps": steps}
+
+
+def _packing_report(db, route: Dict[str, int], max_orders: int) -> Dict:
+    """Заполненность рейсов маршрута: переполнения и расхождения order_count."""
+    from sqlalchemy import text
+
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT t.id, t.order_count, COUNT(so.order_id) "
+                "FROM trips t LEFT JOIN stage_orders so ON so.trip_id = t.id "
+                "WHERE t.from_city_id = :from_city_id AND t.to_city_id = :to_city_id "
+                "GROUP BY t.id, t.order_count"
+            ),
+            route,
+        ).fetchall()
+    assigned = sum(row[2] for row in rows)
+    return {
+        "trips": len(rows),
+        "min_trips": math.ceil(assigned / max_orders) if max_orders else 0,
+        "assigned": assigned,
+        "overfilled": [row[0] for row in rows if row[2] > max_orders],
+        "count_mismatch": [row[0] for row in rows if row[1] != row[2]],
+        "not_full": sum(1 for row in rows if row[2] < max_orders),
+    }
+
+
+def run_packing(threads: int, orders: int, max_orders: int, via: str, keep: bool) -> Dict:
+    """
+    threads потоков создают orders заказов на одном маршруте
+    (BenchFrom → BenchTo) и раскладывают их по рейсам:
+    - via=create — create_order_and_assign (как create-smart);
+    - via=smart — create_order + assign_order_to_trip_smart.
+
+    Ожидается: ни одного рейса больше max_orders заказов, order_count
+    совпадает с stage_orders, рейсов не больше ceil(orders / max_orders)
+    плюс единицы недобранных на момент окончания.
+    """
+    from sqlalchemy import text
+
+    db = _db_from_env(pool_size=threads, max_overflow=threads)
+    from_city, to_city = "BenchFrom", "BenchTo"
+    counter = iter(range(orders))
+    counter_lock = threading.Lock()
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+    try:
+        source_cell = _bench_cell(db, 901, f"{from_city}, benchmark")
+        dest_cell = _bench_cell(db, 902, f"{to_city}, benchmark")
+        db.get_cities_for_cells([source_cell, dest_cell])
+        city_ids = db.get_city_ids([from_city, to_city])
+        route = {"from_city_id": city_ids[from_city], "to_city_id": city_ids[to_city]}
+        db.release_session()
+
+        def worker() -> None:
+            local_latencies: List[float] = []
+            local_errors: List[str] = []
+            while True:
+                with counter_lock:
+                    if next(counter, None) is None:
+                        break
+                started = time.perf_counter()
+                try:
+                    if via == "smart":
+                        order_id = db.create_order(
+                            PACKING_MARK, source_cell, dest_cell, from_city, to_city
+                        )
+                        _, success, msg = db.assign_order_to_trip_smart(
+                            order_id, from_city, to_city, max_orders
+                        )
+                        if not success:
+                            raise RuntimeError(msg)
+                    else:
+                        db.create_order_and_assign(
+                            PACKING_MARK, source_cell, dest_cell, max_orders=max_orders
+                        )
+                    local_latencies.append(time.perf_counter() - started)
+                except Exception as e:
+                    local_errors.append(str(e))
+            db.release_session()
+            with lock:
+                latencies.extend(local_latencies)
+                errors.extend(local_errors)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for _ in range(threads):
+                pool.submit(worker)
+        elapsed = time.perf_counter() - started
+
+        result = summarize(latencies, len(errors), elapsed)
+        result.update(_packing_report(db, route, max_orders))
+        result["ok"] = (
+            not errors and not result["overfilled"] and not result["count_mismatch"]
+            and result["assigned"] == orders
+        )
+        result.update({
+            "scenario": "packing",
+            "via": via,
+            "threads": threads,
+            "orders": orders,
+            "max_orders": max_orders,
+            "error_samples": errors[:5],
+        })
+    finally:
+        if not keep:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    text("DELETE FROM orders WHERE description = :mark"),
+                    {"mark": PACKING_MARK},
+                )
+                conn.execute(
+                    text(
+                        "DELETE FROM trips WHERE from_city = :from_city AND to_city = :to_city"
+                    ),
+                    {"from_city": from_city, "to_city": to_city},
+                )
+        db.close()
+    return result
+
+
+LIFECYCLE_MARK = "benchmark-lifecycle"
+LIFECYCLE_LOCKER_BASE = 9100
+LIFECYCLE_USER_BASE = 9100
+
+
+class LifecycleStepError(Exception):
+    """Шаг жизненного цикла вернул ошибку — цикл прерывается."""
+
+
+class AsgiClient:
+    """
+    HTTP-клиент поверх ASGI-приложения в том же процессе (без сети).
+
+    Время ответа копится по эндпоинту (шаблону пути), ответ >= 400
+    считается ошибкой и прерывает шаг.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        endpoint: Optional[str] = None,
+        params: Optional[Dict] = None,
+        body: Optional[Dict] = None,
+    ):
+        endpoint = endpoint or f"{method} {path}"
+        payload = json.dumps(body).encode() if body is not None else b""
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": urllib.parse.urlencode(params or {}).encode(),
+            "headers": [(b"content-type", b"application/json"), (b"host", b"benchmark")],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+        }
+        received = False
+        response = {"status": 500, "body": b""}
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": payload, "more_body": False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+
+        started = time.perf_counter()
+        await self.app(scope, receive, send)
+        elapsed = time.perf_counter() - started
+        if response["status"] >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            raise LifecycleStepError(
+                f"{endpoint}: {response['status']} {response['body'][:300].decode(errors='replace')}"
+            )
+        self.latencies.setdefault(endpoint, []).append(elapsed)
+        return json.loads(response["body"]) if response["body"] else None
+
+
+async def _fsm_action(client: AsgiClient, entity_type: str, entity_id: int, action: str, user_id: int) -> None:
+    await client.request("POST", "/api/fsm/action", body={
+        "entity_type": entity_type,
+        "entity_id": entity_id,
+        "action_name": action,
+        "user_id": user_id,
+    })
+
+
+async def _fsm_batch(client: AsgiClient, actions: List[tuple], user_id: int) -> None:
+    """Атомарная пачка [(entity_type, entity_id, action)]."""
+    result = await client.request("POST", "/api/fsm/actions/batch", body={
+        "actions": [
+            {"entity_type": t, "entity_id": i, "action_name": a, "user_id": user_id}
+            for t, i, a in actions
+        ],
+        "atomic": True,
+    })
+    if not result["success"]:
+        failed = next(r for r in result["results"] if not r["message"].startswith(("Откат", "Не выполнено")))
+        raise LifecycleStepError(f"POST /api/fsm/actions/batch: {failed['message']}")
+
+
+async def _run_trip_round(
+    client: AsgiClient,
+    adb,
+    route: Dict,
+    orders_per_trip: int,
+    pickup: str,
+    delivery: str,
+) -> None:
+    """
+    Один рейс клиента от создания заказов до завершения:
+    create-smart → start-flow → (курьер1 с биржи) → сдача в постамат1 →
+    активация рейса → водитель забирает → рейс → постамат2 →
+    (курьер2 с биржи | получатель) → заказ завершён.
+    """
+    courier1, courier2, driver, client_id = route["users"]
+    orders: List[int] = []
+    trips = set()
+    for _ in range(orders_per_trip):
+        created = await client.request(
+            "POST", "/api/orders/create-smart",
+            params={
+                "source_cell_id": route["source_cell"],
+                "dest_cell_id": route["dest_cell"],
+                "title": LIFECYCLE_MARK,
+                "pickup_type": pickup,
+                "delivery_type": delivery,
+            },
+        )
+        orders.append(created["order_id"])
+        trips.add(created["trip_id"])
+        route["from_city"], route["to_city"] = created["from_city"], created["to_city"]
+
+    for order_id in orders:
+        await client.request(
+            "POST", f"/api/orders/{order_id}/start-flow", "POST /api/orders/{id}/start-flow",
+            params={"user_id": courier1 if pickup == "courier" else client_id},
+        )
+    if pickup == "courier":
+        await client.request(
+            "GET", "/api/courier/exchange-pickup",
+            params={"city": route["from_city"], "limit": 50},
+        )
+        for order_id in orders:
+            # В API нет записи курьера в stage_orders — пишем через тот же слой БД
+            await adb.set_courier1_in_stage(order_id, courier1)
+            await _fsm_action(client, "order", order_id, "order_assign_courier1_to_order", courier1)
+            await _fsm_action(client, "order", order_id, "order_courier_pickup_parcel", courier1)
+            await _fsm_action(client, "order", order_id, "order_confirm_parcel_in", courier1)
+    else:
+        for order_id in orders:
+            await _fsm_action(client, "order", order_id, "order_confirm_parcel_in", client_id)
+    for order_id in orders:
+        await _fsm_action(client, "order", order_id, "order_parcel_submitted", 0)
+
+    await client.request(
+        "POST", "/api/timeouts/process",
+        params={"trip_timeout_hours": 0, "trip_max_orders": orders_per_trip},
+    )
+    for trip_id in sorted(trips):
+        trip_orders = await client.request(
+            "GET", f"/api/trips/{trip_id}/orders", "GET /api/trips/{id}/orders"
+        )
+        mine = [order_id for order_id in trip_orders if order_id in orders]
+        await _fsm_action(client, "trip", trip_id, "trip_vzyat_reis", driver)
+        await _fsm_action(client, "trip", trip_id, "trip_assign_voditel", driver)
+        await _fsm_batch(
+            client,
+            [("trip", trip_id, "trip_confirm_pickup")]
+            + [("order", order_id, "order_pickup_by_voditel") for order_id in mine],
+            driver,
+        )
+        await _fsm_batch(
+            client,
+            [("trip", trip_id, "trip_start_trip")]
+            + [("order", order_id, "order_start_transit") for order_id in mine],
+            driver,
+        )
+        await _fsm_batch(
+            client,
+            [("trip", trip_id, "trip_end_delivery")]
+            + [("order", order_id, "order_arrive_at_post2") for order_id in mine],
+            driver,
+        )
+        for order_id in mine:
+            await _fsm_action(client, "order", order_id, "order_confirm_parcel_in", driver)
+        await _fsm_batch(
+            client,
+            [("trip", trip_id, "trip_confirm_delivery"), ("trip", trip_id, "trip_complete_trip")],
+            driver,
+        )
+
+    for order_id in orders:
+        await client.request(
+            "POST", f"/api/orders/{order_id}/handle-parcel-confirmed",
+            "POST /api/orders/{id}/handle-parcel-confirmed",
+        )
+    if delivery == "courier":
+        await client.request(
+            "GET", "/api/courier/exchange-delivery",
+            params={"city": route["to_city"], "limit": 50},
+        )
+        for order_id in orders:
+            await adb.set_courier2_in_stage(order_id, courier2)
+            await _fsm_action(client, "order", order_id, "order_assign_courier2_to_order", courier2)
+            await _fsm_action(client, "order", order_id, "order_courier2_pickup_parcel", courier2)
+            await _fsm_action(client, "order", order_id, "order_courier2_delivered_parcel", courier2)
+            await _fsm_action(client, "order", order_id, "order_recipient_confirmed", client_id)
+    else:
+        for order_id in orders:
+            await _fsm_action(client, "order", order_id, "order_pickup_poluchatel", client_id)
+            await _fsm_action(client, "order", order_id, "order_delivered_parcel", client_id)
+
+    for order_id in orders:
+        order = await client.request("GET", f"/api/orders/{order_id}", "GET /api/orders/{id}")
+        if order["status"] != "order_completed":
+            raise LifecycleStepError(f"Заказ {order_id} завершился в {order['status']}")
+
+
+async def _setup_lifecycle_clients(client: AsgiClient, clients: int) -> List[Dict]:
+    """Свой маршрут (2 постамата) и пользователи на каждого клиента — рейсы не пересекаются."""
+    lockers = []
+    routes = []
+    for i in range(clients):
+        source_id = LIFECYCLE_LOCKER_BASE + 2 * i
+        users = [LIFECYCLE_USER_BASE + 4 * i + k for k in range(4)]
+        for user_id, role in zip(users, ("courier", "courier", "driver", "client")):
+            await client.request("POST", "/api/users", body={
+                "user_id": user_id, "name": f"{LIFECYCLE_MARK}-{user_id}", "role": role,
+            })
+        for locker_id, city in ((source_id, f"BenchFrom{i}"), (source_id + 1, f"BenchTo{i}")):
+            lockers.append({
+                "locker_id": locker_id,
+                "locker_code": f"BENCH-LC-{locker_id}",
+                "location_address": f"{city}, benchmark",
+            })
+        routes.append({"lockers": (source_id, source_id + 1), "users": users})
+    await client.request("POST", "/api/lockers/provision", body={"lockers": lockers})
+    for route in routes:
+        cells = []
+        for locker_id in route["lockers"]:
+            found = await client.request(
+                "GET", f"/api/lockers/{locker_id}/cells", "GET /api/lockers/{id}/cells"
+            )
+            if not found:
+                raise LifecycleStepError(f"У постамата {locker_id} нет свободных ячеек")
+            cells.append(found[0]["id"])
+        route["source_cell"], route["dest_cell"] = cells
+    return routes
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_lifecycle(
+    clients: int,
+    rounds: int,
+    orders_per_trip: int,
+    backend: str,
+    pickup: str,
+    delivery: str,
+    keep: bool,
+) -> Dict:
+    """
+    clients конкурентных клиентов проходят по rounds рейсов каждый
+    (orders_per_trip заказов в рейсе) через FastAPI-приложение в том же
+    процессе (ASGI, без сети). backend=memory — FSM-симулятор
+    (DB_BACKEND=memory), mysql — БД из DB_HOST/DB_PORT/...
+
+    Результат — p50/p95/p99 и rps по каждому эндпоинту, итог по всем
+    запросам и число завершённых/прерванных циклов.
+    """
+    os.environ["DB_BACKEND"] = backend
+    # Планировщик сдвигал бы статусы и время ответа посреди замера
+    os.environ.setdefault("SCHEDULER_ENABLED", "0")
+    import main
+
+    async def scenario() -> Dict:
+        client = AsgiClient(main.app)
+        async with main.lifespan(main.app):
+            routes = await _setup_lifecycle_clients(client, clients)
+            client.latencies.clear()
+            client.errors.clear()
+            completed = 0
+            failures: List[str] = []
+
+            async def simulated_client(route: Dict) -> None:
+                nonlocal completed
+                for _ in range(rounds):
+                    try:
+                        await _run_trip_round(
+                            client, main.db_instance, route, orders_per_trip, pickup, delivery
+                        )
+                        completed += 1
+                    except LifecycleStepError as e:
+                        failures.append(str(e))
+
+            started = time.perf_counter()
+            await asyncio.gather(*(simulated_client(route) for route in routes))
+            elapsed = time.perf_counter() - started
+
+            if backend == "mysql" and not keep:
+                _cleanup_lifecycle(main.db_instance.db)
+        return {
+            "elapsed": elapsed,
+            "completed": completed,
+            "failures": failures,
+            "latencies": client.latencies,
+            "errors": client.errors,
+        }
+
+    # Отладочный вывод приложения — в stderr, чтобы stdout оставался JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        run = asyncio.run(scenario())
+
+    elapsed = run["elapsed"]
+    endpoints = {
+        endpoint: summarize(run["latencies"].get(endpoint, []), run["errors"].get(endpoint, 0), elapsed)
+        for endpoint in sorted(set(run["latencies"]) | set(run["errors"]))
+    }
+    all_latencies = [value for values in run["latencies"].values() for value in values]
+    total = summarize(all_latencies, sum(run["errors"].values()), elapsed)
+    lifecycles = clients * rounds
+    return {
+        "scenario": "lifecycle",
+        "commit": _git_commit(),
+        "backend": backend,
+        "clients": clients,
+        "rounds": rounds,
+        "orders_per_trip": orders_per_trip,
+        "pickup": pickup,
+        "delivery": delivery,
+        "trips_completed": run["completed"],
+        "trips_failed": lifecycles - run["completed"],
+        "orders_completed": run["completed"] * orders_per_trip,
+        "orders_per_sec": round(run["completed"] * orders_per_trip / elapsed, 1) if elapsed > 0 else 0.0,
+        "total": total,
+        "endpoints": endpoints,
+        "error_samples": run["failures"][:5],
+        "ok": run["completed"] == lifecycles,
+    }
+
+
+def _cleanup_lifecycle(db) -> None:
+    from sqlalchemy import text
+
+    with db.engine.begin() as conn:
+        trip_ids = [
+            row[0]
+            for row in conn.execute(
+                text(
+                    "SELECT DISTINCT so.trip_id FROM stage_orders so "
+                    "JOIN orders o ON o.id = so.order_id WHERE o.description = :mark"
+                ),
+                {"mark": LIFECYCLE_MARK},
+            ).fetchall()
+        ]
+        conn.execute(
+            text("DELETE FROM orders WHERE description = :mark"), {"mark": LIFECYCLE_MARK}
+        )
+        if trip_ids:
+            params = {f"id{i}": trip_id for i, trip_id in enumerate(trip_ids)}
+            placeholders = ", ".join(f":{name}" for name in params)
+            conn.execute(text(f"DELETE FROM trips WHERE id IN ({placeholders})"), params)
+
+
+def compare_results(before: Dict, after: Dict, threshold: float) -> Dict:
+    """
+    Сравнение двух JSON-результатов lifecycle: изменение p50/p95/p99 и rps
+    по эндпоинтам (в долях: 0.1 = +10%). Регрессия — рост p95 больше threshold.
+    """
+    def delta(old: float, new: float) -> Optional[float]:
+        return round((new - old) / old, 3) if old else None
+
+    rows = {}
+    regressions = []
+    before_endpoints = dict(before.get("endpoints", {}), total=before["total"])
+    after_endpoints = dict(after.get("endpoints", {}), total=after["total"])
+    for endpoint in sorted(set(before_endpoints) & set(after_endpoints)):
+        old, new = before_endpoints[endpoint], after_endpoints[endpoint]
+        row = {
+            key: {"before": old[key], "after": new[key], "change": delta(old[key], new[key])}
+            for key in ("p50_ms", "p95_ms", "p99_ms", "rps")
+        }
+        row["errors"] = {"before": old["errors"], "after": new["errors"]}
+        rows[endpoint] = row
+        p95_change = row["p95_ms"]["change"]
+        if (p95_change is not None and p95_change > threshold) or new["errors"] > old["errors"]:
+            regressions.append(endpoint)
+    return {
+        "scenario": "compare",
+        "before": before.get("commit"),
+        "after": after.get("commit"),
+        "threshold": threshold,
+        "endpoints": rows,
+        "only_before": sorted(set(before_endpoints) - set(after_endpoints)),
+        "only_after": sorted(set(after_endpoints) - set(before_endpoints)),
+        "regressions": regressions,
+        "ok": not regressions,
+    }
+
+
+def write_output(result: Dict, output: Optional[str]) -> None:
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк FSM API")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    load = sub.add_parser("load", help="Нагрузка на один эндпоинт")
+    load.add_argument("--url", default="http://localhost:8000/api/orders")
+    load.add_argument("--method", default="GET")
+    load.add_argument("-c", "--concurrency", type=int, default=50)
+    load.add_argument("-d", "--duration", type=float, default=10.0)
+    load.add_argument("-o", "--output", default=None, help="Куда сохранить JSON")
+
+    exchange = sub.add_parser("exchange", help="Время ответа биржи при росте числа заказов")
+    exchange.add_argument("--sizes", default="1000,10000,100000",
+                          help="Размеры биржи через запятую")
+    exchange.add_argument("--repeat", type=int, default=200)
+    exchange.add_argument("--page-size", type=int, default=50)
+    exchange.add_argument("--keep", action="store_true", help="Не удалять тестовые заказы")
+    exchange.add_argument("-o", "--output", default=None, help="Куда сохранить JSON")
+
+    packing = sub.add_parser("packing", help="Параллельная раскладка заказов одного маршрута по рейсам")
+    packing.add_argument("-t", "--threads", type=int, default=32)
+    packing.add_argument("-n", "--orders", type=int, default=2000)
+    packing.add_argument("--max-orders", type=int, default=5, help="Мест в рейсе")
+    packing.add_argument("--via", choices=("create", "smart"), default="create")
+    packing.add_argument("--keep", action="store_true", help="Не удалять тестовые заказы и рейсы")
+    packing.add_argument("-o", "--output", default=None, help="Куда сохранить JSON")
+
+    lifecycle = sub.add_parser("lifecycle", help="Полные циклы заказов через API (ASGI в процессе)")
+    lifecycle.add_argument("-c", "--clients", type=int, default=20, help="Конкурентных клиентов")
+    lifecycle.add_argument("-r", "--rounds", type=int, default=10, help="Рейсов на клиента")
+    lifecycle.add_argument("--orders-per-trip", type=int, default=5,
+                           help="Заказов в рейсе (порог активации рейса)")
+    lifecycle.add_argument("--backend", choices=("memory", "mysql"), default="memory")
+    lifecycle.add_argument("--pickup", choices=("courier", "self"), default="courier")
+    lifecycle.add_argument("--delivery", choices=("courier", "self"), default="courier")
+    lifecycle.add_argument("--keep", action="store_true", help="Не удалять тестовые заказы и рейсы (mysql)")
+    lifecycle.add_argument("-o", "--output", default=None, help="Куда сохранить JSON")
+
+    compare = sub.add_parser("compare", help="Сравнить два JSON-результата lifecycle")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.add_argument("--threshold", type=float, default=0.2,
+                         help="Допустимый рост p95 (0.2 = +20%%)")
+    compare.add_argument("-o", "--output", default=None, help="Куда сохранить JSON")
+
+    args = parser.parse_args()
+    if args.command == "load":
+        result = run_load(args.url, args.concurrency, args.duration, args.method)
+        write_output(result, args.output)
+    elif args.command == "exchange":
+        sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+        result = run_exchange(sizes, args.repeat, args.page_size, args.keep)
+        write_output(result, args.output)
+    elif args.command == "packing":
+        result = run_packing(args.threads, args.orders, args.max_orders, args.via, args.keep)
+        write_output(result, args.output)
+        if not result["ok"]:
+            raise SystemExit(1)
+    elif args.command == "lifecycle":
+        result = run_lifecycle(
+            args.clients, args.rounds, args.orders_per_trip, args.backend,
+            args.pickup, args.delivery, args.keep,
+        )
+        write_output(result, args.output)
+        if not result["ok"]:
+            raise SystemExit(1)
+    elif args.command == "compare":
+        with open(args.before, encoding="utf-8") as f:
+            before = json.load(f)
+        with open(args.after, encoding="utf-8") as f:
+            after = json.load(f)
+        result = compare_results(before, after, args.threshold)
+        write_output(result, args.output)
+        if not result["ok"]:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,16 +13,34 @@ from db_layer import DatabaseLayer, DbLayerError, FsmCallError
 db = DatabaseLayer(port=3307, password="root")
 order_id = db.create_order(...)
 trip_id, success, msg = db.assign_order_to_trip_smart(order_id, "Москва", "СПб")
+
+Из async-кода (FastAPI) — через AsyncDatabaseLayer:
+adb = AsyncDatabaseLayer(db)
+order = await adb.get_order(order_id)
 """
 
-from typing import List, Dict, Optional, Tuple
+from typing import Any, Callable, Iterable, Iterator, List, Dict, Optional, Sequence, Tuple
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import contextvars
+import json
+import logging
+import re
+import threading
+import time
 from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
-import mysql.connector
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from mysql.connector import Error
 import traceback
 
+logger = logging.getLogger(__name__)
+
 
 class DbLayerError(Exception):
     """Базовое исключение для ошибок db_layer."""
@@ -34,6 +52,372 @@ class FsmCallError(DbLayerError):
     pass
 
 
+# entity_type -> таблица, где хранится статус сущности (как в fsm_perform_action)
+FSM_ENTITY_TABLES = {
+    "order": "orders",
+    "trip": "trips",
+    "locker": "locker_cells",
+}
+
+# Статусы резерва заказа, которые истекают по order_timeout_reservation
+RESERVATION_STATUSES = (
+    "order_courier_reserved_post1_and_post2",
+    "order_client_reserved_post1_and_post2",
+)
+
+# Сколько заказов собирается в один рейс (trips.order_count)
+TRIP_MAX_ORDERS = 5
+
+# Допустимые pickup_type / delivery_type заказа
+ORDER_HANDOFF_TYPES = ("self", "courier")
+
+# Типы ячеек постамата -> колонка числа ячеек в locker_models
+CELL_TYPE_COUNT_COLUMNS = {
+    "S": "cell_count_s",
+    "M": "cell_count_m",
+    "L": "cell_count_l",
+    "P": "cell_count_p",
+}
+
+# Колонки заказа в листингах (get_all_orders, get_orders_for_route, страницы)
+ORDER_LIST_COLUMNS = (
+    "id",
+    "status",
+    "description",
+    "pickup_type",
+    "delivery_type",
+    "from_city",
+    "to_city",
+    "source_cell_id",
+    "dest_cell_id",
+)
+
+# Поля get_order_routes (лента бирж сверяет их с фильтром листинга)
+ORDER_ROUTE_COLUMNS = (
+    "from_city",
+    "to_city",
+    "from_city_id",
+    "to_city_id",
+    "pickup_type",
+    "delivery_type",
+)
+
+
+def _encode_cursor(values: Dict[str, Any]) -> str:
+    """Непрозрачный курсор страницы: base64(JSON) с ключом последней строки."""
+    raw = json.dumps(values, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor: str, keys: Iterable[str], param: str = "cursor") -> Dict[str, Any]:
+    """Разобрать курсор из _encode_cursor; keys — обязательные поля, param — имя в ошибке."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError) as e:
+        raise DbLayerError(f"Некорректный {param}: {cursor}") from e
+    if not isinstance(values, dict) or any(key not in values for key in keys):
+        raise DbLayerError(f"Некорректный {param}: {cursor}")
+    return values
+
+
+def _locker_codes(rows: Iterable[Dict]) -> Dict[str, int]:
+    """
+    {locker_code: id} постаматов из запроса provision_lockers.
+
+    Коды сравниваются без учёта регистра, как уникальный ключ в MySQL;
+    один код у разных постаматов — DbLayerError.
+    """
+    codes: Dict[str, int] = {}
+    for row in rows:
+        owner = codes.setdefault(row["locker_code"].lower(), row["id"])
+        if owner != row["id"]:
+            raise DbLayerError(
+                f"locker_code '{row['locker_code']}' повторяется у постаматов {owner} и {row['id']}"
+            )
+    return codes
+
+
+def _check_locker_codes(codes: Dict[str, int], taken: Dict[str, int]) -> None:
+    """DbLayerError, если код из codes уже носит другой постамат (taken — {locker_code: id})."""
+    conflicts = [
+        f"{code} (постамат {owner})"
+        for code, owner in sorted(taken.items())
+        if codes.get(code.lower(), owner) != owner
+    ]
+    if conflicts:
+        raise DbLayerError(f"locker_code уже заняты другими постаматами: {', '.join(conflicts)}")
+
+
+# Разные написания одного города (ключ — в нижнем регистре, ё → е)
+CITY_ALIASES = {
+    "msk": "Москва",
+    "мск": "Москва",
+    "москва": "Москва",
+    "moscow": "Москва",
+    "moskva": "Москва",
+    "spb": "Санкт-Петербург",
+    "спб": "Санкт-Петербург",
+    "питер": "Санкт-Петербург",
+    "петербург": "Санкт-Петербург",
+    "санкт-петербург": "Санкт-Петербург",
+    "saint petersburg": "Санкт-Петербург",
+    "st. petersburg": "Санкт-Петербург",
+    "st petersburg": "Санкт-Петербург",
+    "sankt-peterburg": "Санкт-Петербург",
+}
+
+
+def normalize_city(name: str) -> str:
+    """
+    Каноническое имя города: "Msk", "мск", " Москва " → "Москва".
+
+    Неизвестные города возвращаются как есть, без лишних пробелов.
+    """
+    cleaned = " ".join(name.split())
+    return CITY_ALIASES.get(cleaned.lower().replace("ё", "е"), cleaned)
+
+
+# Биржи курьеров: какие заказы показываются и откуда их забирать
+EXCHANGES = {
+    "pickup": {
+        "status": "order_courier_reserved_post1_and_post2",
+        "type_column": "pickup_type",
+        "city_column": "from_city",
+        "city_id_column": "from_city_id",
+        "cell_column": "source_cell_id",
+        "prefix": "source",
+    },
+    "delivery": {
+        "status": "order_parcel_confirmed_post2",
+        "type_column": "delivery_type",
+        "city_column": "to_city",
+        "city_id_column": "to_city_id",
+        "cell_column": "dest_cell_id",
+        "prefix": "dest",
+    },
+}
+
+# На сколько секунд since опроса биржи отстаёт от NOW(): updated_at пишется
+# при UPDATE (точность — секунда), а виден после COMMIT, поэтому изменения
+# последних секунд перечитываются следующим опросом
+EXCHANGE_POLL_LAG_SECONDS = 5
+
+# Текст успешного перехода (fsm_perform_action и _fsm_success_message)
+FSM_SUCCESS_MESSAGE = re.compile(
+    r'^FSM action "(?P<action_name>[^"]+)" applied on (?P<entity_type>\w+) '
+    r"#(?P<entity_id>\d+): (?P<from_state>\S+) → (?P<to_state>\S+)$"
+)
+
+# Действия рейса, которые разрешены только при trips.active = 1
+TRIP_ACTIONS_REQUIRE_ACTIVE = ("trip_vzyat_reis", "trip_start_trip")
+
+
+class FsmTransitionTable:
+    """
+    Граф переходов FSM в памяти: (from_state, action) -> to_state.
+
+    Собирается из fsm_states / fsm_actions / fsm_transitions. Если для
+    пары (состояние, действие) переходов несколько, берётся первый по id —
+    как LIMIT 1 в fsm_perform_action.
+    """
+
+    def __init__(
+        self,
+        states: Iterable[str],
+        actions: Iterable[str],
+        transitions: Iterable[Tuple[str, str, str]],
+    ):
+        self.states = frozenset(states)
+        self.actions = frozenset(actions)
+        self._transitions: Dict[Tuple[str, str], str] = {}
+        self._from_states: Dict[str, List[str]] = {}
+        self._actions_from: Dict[str, List[str]] = {}
+        for from_state, action, to_state in transitions:
+            if (from_state, action) not in self._transitions:
+                self._transitions[(from_state, action)] = to_state
+                self._from_states.setdefault(action, []).append(from_state)
+                self._actions_from.setdefault(from_state, []).append(action)
+
+    @classmethod
+    def load(cls, conn) -> "FsmTransitionTable":
+        """Загрузить граф переходов из БД (conn — Connection или Session)."""
+        states = conn.execute(text("SELECT name FROM fsm_states")).fetchall()
+        actions = conn.execute(text("SELECT name FROM fsm_actions")).fetchall()
+        transitions = conn.execute(
+            text(
+                "SELECT s1.name, a.name, s2.name "
+                "FROM fsm_transitions t "
+                "JOIN fsm_states s1 ON s1.id = t.from_state_id "
+                "JOIN fsm_actions a ON a.id = t.action_id "
+                "JOIN fsm_states s2 ON s2.id = t.to_state_id "
+                "ORDER BY t.id"
+            )
+        ).fetchall()
+        return cls(
+            (row[0] for row in states),
+            (row[0] for row in actions),
+            (tuple(row) for row in transitions),
+        )
+
+    def next_state(self, from_state: str, action_name: str) -> Optional[str]:
+        """Состояние после действия или None, если переход не разрешён."""
+        return self._transitions.get((from_state, action_name))
+
+    def from_states(self, action_name: str) -> List[str]:
+        """Все состояния, из которых разрешено действие."""
+        return list(self._from_states.get(action_name, []))
+
+    def actions_from(self, state: str) -> List[str]:
+        """Все действия, разрешённые из состояния."""
+        return list(self._actions_from.get(state, []))
+
+    def __len__(self) -> int:
+        return len(self._transitions)
+
+
+class ButtonMatrix:
+    """
+    Таблица button_states в памяти: (user_role, entity_state) -> [кнопки].
+
+    Таблица маленькая и почти не меняется, поэтому читается целиком
+    одним запросом. Ключи сравниваются без учёта регистра — как в SQL
+    под collation таблицы (utf8mb4_0900_ai_ci).
+    """
+
+    def __init__(self, rows: Iterable[Tuple[str, str, str, object]]):
+        self._index: Dict[Tuple[str, str], List[Dict]] = {}
+        for user_role, entity_state, button_name, is_enabled in rows:
+            self._index.setdefault(self._key(user_role, entity_state), []).append(
+                {
+                    "button_name": button_name,
+                    "is_enabled": (
+                        is_enabled == "active"
+                        if isinstance(is_enabled, str)
+                        else bool(is_enabled)
+                    ),
+                }
+            )
+
+    @classmethod
+    def load(cls, conn) -> "ButtonMatrix":
+        """Загрузить button_states из БД (conn — Connection или Session)."""
+        rows = conn.execute(
+            text(
+                "SELECT user_role, entity_state, button_name, is_enabled "
+                "FROM button_states ORDER BY id"
+            )
+        ).fetchall()
+        return cls(tuple(row) for row in rows)
+
+    def resolve(
+        self,
+        user_role: str,
+        entity_type: str,
+        status: str,
+        active: Optional[int] = None,
+    ) -> List[Dict]:
+        """
+        Кнопки роли для статуса сущности.
+
+        Неактивный рейс (active=0) в trip_created / trip_assigned ищется
+        как '<статус>_inactive', при отсутствии таких строк — как обычный.
+        """
+        if (
+            entity_type == "trip"
+            and active == 0
+            and status in ("trip_created", "trip_assigned")
+        ):
+            buttons = self._index.get(self._key(user_role, status + "_inactive"))
+            if not buttons:
+                buttons = self._index.get(self._key(user_role, status), [])
+        else:
+            buttons = self._index.get(self._key(user_role, status), [])
+        return [dict(button) for button in buttons]
+
+    @staticmethod
+    def _key(user_role: str, entity_state: str) -> Tuple[str, str]:
+        return (user_role or "").casefold(), (entity_state or "").casefold()
+
+    def __len__(self) -> int:
+        return sum(len(buttons) for buttons in self._index.values())
+
+
+class _TtlCache:
+    """Значение, загружаемое при первом обращении и перечитываемое по истечении TTL (0 — никогда)."""
+
+    def __init__(self, loader: Callable[[], Any], ttl: float):
+        self._loader = loader
+        self._ttl = ttl
+        self._value: Any = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _fresh(self) -> bool:
+        return self._value is not None and (
+            self._ttl <= 0 or time.monotonic() - self._loaded_at < self._ttl
+        )
+
+    def get(self) -> Any:
+        if self._fresh():
+            return self._value
+        with self._lock:
+            if not self._fresh():
+                self._value = self._loader()
+                self._loaded_at = time.monotonic()
+            return self._value
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._value = None
+
+
+class _LruCache:
+    """Потокобезопасный LRU-словарь ограниченного размера."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: Iterable[Any]) -> Dict[Any, Any]:
+        """Найденные в кэше значения; промахи в результат не попадают."""
+        found: Dict[Any, Any] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._data.move_to_end(key)
+                    found[key] = self._data[key]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def put_many(self, items: Dict[Any, Any]) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = value
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
 class DatabaseLayer:
     def __init__(
         self,
@@ -43,37 +427,338 @@ class DatabaseLayer:
         user: str = "root",
         password: str = "root",
         echo: bool = False,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_timeout: float = 30.0,
+        pool_recycle: int = 1800,
+        fsm_engine: str = "python",
+        fsm_cache_ttl: float = 300.0,
+        button_cache_ttl: float = 300.0,
+        city_cache_size: int = 10000,
+        poolclass: Optional[type] = None,
     ):
-        """Инициализация подключения."""
+        """
+        Инициализация подключения.
+
+        Все соединения (ORM-сессия и вызовы хранимых процедур) берутся
+        из одного ограниченного пула engine:
+            pool_size: постоянное число соединений в пуле
+            max_overflow: сколько соединений можно открыть сверх pool_size
+            pool_timeout: сколько секунд ждать свободное соединение
+            pool_recycle: через сколько секунд пересоздавать соединение
+            poolclass: подкласс QueuePool (например, tracing.TracedQueuePool)
+
+        FSM-переходы:
+            fsm_engine: "python" — граф переходов кэшируется в памяти и
+                переход выполняется одним UPDATE + запись в лог;
+                "procedure" — через хранимую процедуру fsm_perform_action
+            fsm_cache_ttl: через сколько секунд перечитывать граф (0 — никогда)
+            button_cache_ttl: то же для таблицы button_states
+
+        city_cache_size: сколько ячеек держать в LRU-кэше «ячейка → город»
+        """
+        if fsm_engine not in ("python", "procedure"):
+            raise DbLayerError(f"Неизвестный fsm_engine: {fsm_engine}")
         connection_string = (
             f"mysql+mysqlconnector://{user}:{password}@{host}:{port}/{database}"
         )
 
         # ОДИН раз создаём engine с правильными параметрами
+        # pool_pre_ping — health check соединения перед выдачей из пула
         self.engine = create_engine(
             connection_string,
             echo=echo,
             future=True,
             pool_pre_ping=True,
-            pool_recycle=1800,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_recycle=pool_recycle,
+            poolclass=poolclass or QueuePool,
         )
+        self._max_overflow = max_overflow
+        self.pool_capacity = pool_size + max_overflow
 
-        Session = sessionmaker(
+        self._session_factory = sessionmaker(
             bind=self.engine,
             autoflush=False,
             autocommit=False,
             expire_on_commit=False,
         )
-        self.session = Session()
-
-        self._raw_config = {
-            "host": host,
-            "port": port,
-            "database": database,
-            "user": user,
-            "password": password,
+        # Сессия единицы работы (HTTP-запроса), см. session_scope()
+        self._scoped: contextvars.ContextVar[Optional[Session]] = (
+            contextvars.ContextVar(f"db_session_{id(self)}", default=None)
+        )
+        # Вне session_scope (скрипты, фоновые задачи) — своя сессия у
+        # каждого потока: одна общая Session между потоками небезопасна
+        self._thread_session = scoped_session(self._session_factory)
+
+        self._fsm_engine = fsm_engine
+        self._fsm_cache = _TtlCache(
+            lambda: self._load_cached(FsmTransitionTable), fsm_cache_ttl
+        )
+        self._button_cache = _TtlCache(
+            lambda: self._load_cached(ButtonMatrix), button_cache_ttl
+        )
+        # cell_id -> город постамата (адрес постамата практически не меняется)
+        self._city_cache = _LruCache(city_cache_size)
+        # Каноническое имя города -> cities.id (id городов не меняются)
+        self._city_ids: Dict[str, int] = {}
+        self._city_ids_lock = threading.Lock()
+        # Подписчики на выполненные FSM-переходы, см. add_transition_listener()
+        self._transition_listeners: List[Callable[[List[Dict]], None]] = []
+        # Подписчики на вызовы хранимых процедур, см. add_procedure_listener()
+        self._procedure_listeners: List[Callable[[str, float, Optional[BaseException]], None]] = []
+        # Подписчики на запросы мимо engine (iter_orders), см. add_raw_query_listener()
+        self._raw_query_listeners: List[Callable[[str, float, Optional[BaseException]], None]] = []
+        self._autoinc_step: Optional[int] = None
+
+    # ==================== СЕССИИ ====================
+
+    @property
+    def session(self) -> Session:
+        """Сессия текущей единицы работы (или сессия потока вне session_scope)."""
+        session = self._scoped.get()
+        if session is not None:
+            return session
+        return self._thread_session()
+
+    @contextmanager
+    def session_scope(self):
+        """
+        Отдельная Session на единицу работы (например, HTTP-запрос).
+
+        Все методы DatabaseLayer внутри блока работают с этой сессией;
+        при выходе она закрывается и соединение возвращается в пул,
+        незакоммиченные изменения откатываются.
+
+        Использование:
+        with db.session_scope():
+            order_id = db.create_order(...)
+            db.assign_order_to_trip_smart(order_id, ...)
+        """
+        session = self._session_factory()
+        token = self._scoped.set(session)
+        try:
+            yield session
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+            self._scoped.reset(token)
+
+    # ==================== ПУЛ СОЕДИНЕНИЙ ====================
+
+    @contextmanager
+    def _raw_connection(self):
+        """
+        DBAPI-соединение mysql-connector из пула engine (для callproc).
+
+        close() не рвёт TCP-соединение, а возвращает его в пул
+        (с rollback незакоммиченного).
+        """
+        conn = self.engine.raw_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _callproc(self, cursor, name: str, args: Optional[List] = None) -> List[tuple]:
+        """
+        callproc на готовом курсоре: все строки всех результатов процедуры.
+
+        Вызовы идут мимо событий engine SQLAlchemy, поэтому время каждого
+        отдаётся подписчикам add_procedure_listener().
+        """
+        started = time.perf_counter()
+        error: Optional[BaseException] = None
+        try:
+            cursor.callproc(name, args or [])
+            results = []
+            for result in cursor.stored_results():
+                results.extend(result.fetchall())
+            return results
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._notify_procedure(name, time.perf_counter() - started, error)
+
+    def add_procedure_listener(
+        self, listener: Callable[[str, float, Optional[BaseException]], None]
+    ) -> None:
+        """
+        Подписаться на вызовы хранимых процедур через mysql-connector.
+
+        listener(name, seconds, error) вызывается в потоке вызова после
+        каждой процедуры (error — исключение или None); он должен быть
+        быстрым и потокобезопасным.
+        """
+        self._procedure_listeners.append(listener)
+
+    def remove_procedure_listener(
+        self, listener: Callable[[str, float, Optional[BaseException]], None]
+    ) -> None:
+        if listener in self._procedure_listeners:
+            self._procedure_listeners.remove(listener)
+
+    def _notify_procedure(
+        self, name: str, seconds: float, error: Optional[BaseException]
+    ) -> None:
+        for listener in list(self._procedure_listeners):
+            try:
+                listener(name, seconds, error)
+            except Exception:
+                logger.exception("Ошибка подписчика процедур", extra={"procedure": name})
+
+    def add_raw_query_listener(
+        self, listener: Callable[[str, float, Optional[BaseException]], None]
+    ) -> None:
+        """
+        Подписаться на SQL-запросы, которые идут через курсор mysql-connector
+        мимо событий engine (потоковое чтение iter_orders).
+
+        listener(statement, seconds, error) вызывается после закрытия курсора;
+        seconds — время execute и чтения строк с сервера, без времени, пока
+        генератор ждал потребителя.
+        """
+        self._raw_query_listeners.append(listener)
+
+    def remove_raw_query_listener(
+        self, listener: Callable[[str, float, Optional[BaseException]], None]
+    ) -> None:
+        if listener in self._raw_query_listeners:
+            self._raw_query_listeners.remove(listener)
+
+    def _notify_raw_query(
+        self, statement: str, seconds: float, error: Optional[BaseException]
+    ) -> None:
+        for listener in list(self._raw_query_listeners):
+            try:
+                listener(statement, seconds, error)
+            except Exception:
+                logger.exception("Ошибка подписчика SQL-запросов")
+
+    def _call_procedure(self, name: str, args: Optional[List] = None) -> List[tuple]:
+        """Вызвать хранимую процедуру на соединении из пула и вернуть все строки результата."""
+        with self._raw_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                results = self._callproc(cursor, name, args)
+                conn.commit()
+                return results
+            finally:
+                cursor.close()
+
+    def release_session(self) -> None:
+        """Закрыть сессию текущего потока и вернуть её соединение в пул."""
+        self._thread_session.remove()
+
+    def get_pool_stats(self) -> Dict:
+        """Состояние пула соединений (для /health)."""
+        pool = self.engine.pool
+        return {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "max_overflow": self._max_overflow,
+            "timeout": pool.timeout(),
         }
 
+    @contextmanager
+    def advisory_lock(self, name: str, timeout: int = 0):
+        """
+        Именованная блокировка MySQL (GET_LOCK) на время блока.
+
+        Блокировка живёт на отдельном соединении, которое держится до выхода
+        из блока, поэтому работа внутри может идти через любые другие
+        соединения. Отдаёт True, если блокировку удалось взять за timeout
+        секунд, иначе False (её держит другой процесс/реплика).
+
+        Использование:
+        with db.advisory_lock("fsm:reservation_timeouts") as acquired:
+            if acquired:
+                db.check_and_process_reservation_timeouts()
+        """
+        with self.engine.connect() as conn:
+            acquired = conn.execute(
+                text("SELECT GET_LOCK(:name, :timeout)"),
+                {"name": name, "timeout": timeout},
+            ).scalar() == 1
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": name})
+
+    @contextmanager
+    def _connection(self, conn=None):
+        """
+        Соединение для служебной работы: переданное conn (работа идёт внутри
+        транзакции вызывающего, например шага миграции) или своя короткая
+        транзакция engine.begin().
+        """
+        if conn is not None:
+            yield conn
+            return
+        with self.engine.begin() as own:
+            yield own
+
+    @contextmanager
+    def _slot_transaction(self):
+        """
+        Транзакция раскладки заказов по рейсам (READ COMMITTED).
+
+        В REPEATABLE READ FOR UPDATE по маршруту без найденных строк ставит
+        gap-блокировку, и два процесса, одновременно создающие рейс,
+        упираются друг в друга на INSERT (deadlock). В READ COMMITTED
+        gap-блокировок нет, а блокирующие чтения видят последние
+        закоммиченные order_count.
+        """
+        with self.engine.connect() as conn:
+            conn.execution_options(isolation_level="READ COMMITTED")
+            with conn.begin():
+                yield conn
+
+    def _insert_values(
+        self, conn, table: str, columns: Sequence[str], rows: List[Dict]
+    ) -> List[int]:
+        """
+        Один многострочный INSERT ... VALUES (...), (...) на все rows.
+
+        Возвращает id вставленных строк по порядку. Для такого «простого»
+        INSERT InnoDB выделяет AUTO_INCREMENT одним блоком при любом
+        innodb_autoinc_lock_mode, поэтому id — это lastrowid (id первой
+        строки) плюс шаг auto_increment_increment.
+        """
+        if not rows:
+            return []
+        values, params = self._values_clause(columns, rows)
+        first_id = conn.execute(
+            text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values}"),
+            params,
+        ).lastrowid
+        if self._autoinc_step is None:
+            self._autoinc_step = int(
+                conn.execute(text("SELECT @@auto_increment_increment")).scalar() or 1
+            )
+        return [first_id + i * self._autoinc_step for i in range(len(rows))]
+
+    @staticmethod
+    def _values_clause(columns: Sequence[str], rows: List[Dict]) -> Tuple[str, Dict[str, Any]]:
+        """"(:a0, :b0), (:a1, :b1), ..." и параметры к нему."""
+        params: Dict[str, Any] = {}
+        values = []
+        for i, row in enumerate(rows):
+            names = []
+            for column in columns:
+                params[f"{column}{i}"] = row[column]
+                names.append(f":{column}{i}")
+            values.append(f"({', '.join(names)})")
+        return ", ".join(values), params
+
     # ==================== FSM БАЗОВЫЙ ВЫЗОВ ====================
 
     def call_fsm_action(
@@ -83,35 +768,428 @@ class DatabaseLayer:
         action_name: str,
         user_id: int,
         extra_id: Optional[str] = None,
+    ) -> bool:
+        """Выполнить FSM-переход (движком в памяти или процедурой fsm_perform_action)."""
+        if self._fsm_engine == "procedure":
+            return self._call_fsm_procedure(
+                entity_type, entity_id, action_name, user_id, extra_id
+            )
+        return self._perform_fsm_transition(
+            entity_type, entity_id, action_name, user_id
+        )
+
+    def _call_fsm_procedure(
+        self,
+        entity_type: str,
+        entity_id: int,
+        action_name: str,
+        user_id: int,
+        extra_id: Optional[str] = None,
     ) -> bool:
         """Вызов FSM процедуры fsm_perform_action."""
         try:
-            conn = mysql.connector.connect(**self._raw_config)
-            cursor = conn.cursor()
-            cursor.callproc(
+            results = self._call_procedure(
                 "fsm_perform_action",
                 [entity_type, entity_id, action_name, user_id, extra_id or None],
             )
-            results = []
-            for result in cursor.stored_results():
-                results.extend(result.fetchall())
-            conn.commit()
-            cursor.close()
-            conn.close()
+            message = self._fsm_procedure_message(results, action_name)
+        except (Error, SQLAlchemyError) as e:
+            raise FsmCallError(f"FSM {action_name}: {e}") from e
+        transition = self._parse_fsm_message(message, user_id)
+        if transition:
+            self._notify_transitions([transition])
+        return True
+
+    @staticmethod
+    def _fsm_procedure_message(results: List[tuple], action_name: str) -> str:
+        """Текст результата fsm_perform_action; FsmCallError, если переход не выполнен."""
+        if results and len(results) > 0:
+            first_result = results[0]
+            if isinstance(first_result, tuple) and len(first_result) > 0:
+                result_text = str(first_result[0])
+                if result_text.startswith("FSM action "):
+                    return result_text
+                raise FsmCallError(result_text)
+        raise FsmCallError(
+            f"FSM {action_name}: нет результата от fsm_perform_action"
+        )
 
-            if results and len(results) > 0:
-                first_result = results[0]
-                if isinstance(first_result, tuple) and len(first_result) > 0:
-                    result_text = str(first_result[0])
-                    if result_text.startswith("FSM action "):
-                        return True
-                    raise FsmCallError(result_text)
-            raise FsmCallError(
-                f"FSM {action_name}: нет результата от fsm_perform_action"
+    def call_fsm_actions_batch(
+        self, actions: List[Dict], atomic: bool = False
+    ) -> List[Dict]:
+        """
+        Выполнить пачку FSM-переходов на одном соединении из пула.
+
+        actions: [{"entity_type", "entity_id", "action_name", "user_id", "extra_id"}, ...]
+        atomic=False — каждый переход в своей транзакции, ошибка одного
+            не мешает остальным;
+        atomic=True — всё или ничего: на первой ошибке пачка откатывается,
+            оставшиеся переходы не выполняются.
+
+        Возвращает результат по каждому элементу в исходном порядке:
+        {"index", "entity_type", "entity_id", "action_name", "success", "message"}
+        """
+        results = [
+            {
+                "index": i,
+                "entity_type": item["entity_type"],
+                "entity_id": item["entity_id"],
+                "action_name": item["action_name"],
+                "success": False,
+                "message": "",
+            }
+            for i, item in enumerate(actions)
+        ]
+        if not actions:
+            return results
+        try:
+            if self._fsm_engine == "procedure":
+                failed = self._run_fsm_batch_procedure(actions, results, atomic)
+            else:
+                failed = self._run_fsm_batch_python(actions, results, atomic)
+        except (Error, SQLAlchemyError) as e:
+            raise FsmCallError(f"FSM batch: {e}") from e
+
+        if atomic and failed is not None:
+            for result in results:
+                if result["index"] == failed:
+                    continue
+                result["success"] = False
+                result["message"] = (
+                    f"Откат: ошибка в элементе {failed}"
+                    if result["message"]
+                    else f"Не выполнено: ошибка в элементе {failed}"
+                )
+
+        # Оба движка пишут в message один и тот же текст успешного перехода
+        applied = [
+            self._parse_fsm_message(result["message"], actions[result["index"]]["user_id"])
+            for result in results
+            if result["success"]
+        ]
+        self._notify_transitions([t for t in applied if t])
+        return results
+
+    def _run_fsm_batch_python(
+        self, actions: List[Dict], results: List[Dict], atomic: bool
+    ) -> Optional[int]:
+        """Пачка переходов движком в памяти. Возвращает индекс ошибки (для atomic)."""
+        fsm = self.get_fsm_table()
+        with self.engine.connect() as conn:
+            batch_trans = conn.begin() if atomic else None
+            failed: Optional[int] = None
+            for i, item in enumerate(actions):
+                entity_type = item["entity_type"]
+                entity_id = item["entity_id"]
+                action_name = item["action_name"]
+                user_id = item["user_id"]
+                try:
+                    self._check_fsm_action(fsm, entity_type, action_name)
+                    if atomic:
+                        from_state, to_state = self._apply_fsm_transition(
+                            conn, fsm, entity_type, entity_id, action_name, user_id
+                        )
+                    else:
+                        with conn.begin():
+                            from_state, to_state = self._apply_fsm_transition(
+                                conn, fsm, entity_type, entity_id, action_name, user_id
+                            )
+                    results[i]["success"] = True
+                    results[i]["message"] = self._fsm_success_message(
+                        entity_type, entity_id, action_name, from_state, to_state
+                    )
+                except (FsmCallError, SQLAlchemyError) as e:
+                    message = (
+                        str(e)
+                        if isinstance(e, FsmCallError)
+                        else f"FSM {action_name}: {e}"
+                    )
+                    results[i]["message"] = message
+                    self._log_fsm_error(
+                        message, entity_type, entity_id, action_name, user_id
+                    )
+                    if atomic:
+                        failed = i
+                        break
+            if batch_trans is not None:
+                if failed is None:
+                    batch_trans.commit()
+                else:
+                    batch_trans.rollback()
+        return failed
+
+    def _run_fsm_batch_procedure(
+        self, actions: List[Dict], results: List[Dict], atomic: bool
+    ) -> Optional[int]:
+        """Пачка переходов через fsm_perform_action. Возвращает индекс ошибки (для atomic)."""
+        failed: Optional[int] = None
+        with self._raw_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for i, item in enumerate(actions):
+                    action_name = item["action_name"]
+                    try:
+                        rows = self._callproc(
+                            cursor,
+                            "fsm_perform_action",
+                            [
+                                item["entity_type"],
+                                item["entity_id"],
+                                action_name,
+                                item["user_id"],
+                                item.get("extra_id") or None,
+                            ],
+                        )
+                        results[i]["message"] = self._fsm_procedure_message(
+                            rows, action_name
+                        )
+                        results[i]["success"] = True
+                    except (FsmCallError, Error) as e:
+                        results[i]["message"] = (
+                            str(e)
+                            if isinstance(e, FsmCallError)
+                            else f"FSM {action_name}: {e}"
+                        )
+                        if atomic:
+                            failed = i
+                            break
+                    if not atomic:
+                        # Процедура сама пишет ошибки в fsm_errors_log — фиксируем и их
+                        conn.commit()
+                if atomic:
+                    if failed is None:
+                        conn.commit()
+                    else:
+                        conn.rollback()
+            finally:
+                cursor.close()
+        return failed
+
+    # ==================== ПОДПИСКА НА ПЕРЕХОДЫ ====================
+
+    def add_transition_listener(self, listener: Callable[[List[Dict]], None]) -> None:
+        """
+        Подписаться на выполненные FSM-переходы этого процесса.
+
+        listener получает список закоммиченных переходов
+        [{"entity_type", "entity_id", "action_name", "from_state", "to_state",
+        "user_id"}] и вызывается в потоке, выполнившем переход, — он должен
+        быть быстрым и потокобезопасным. Переходы, сделанные другими
+        процессами (или напрямую в БД), сюда не попадают.
+        """
+        self._transition_listeners.append(listener)
+
+    def remove_transition_listener(self, listener: Callable[[List[Dict]], None]) -> None:
+        if listener in self._transition_listeners:
+            self._transition_listeners.remove(listener)
+
+    def _notify_transitions(self, transitions: List[Dict]) -> None:
+        if not transitions:
+            return
+        for listener in list(self._transition_listeners):
+            try:
+                listener(transitions)
+            except Exception:
+                # Ошибка подписчика не должна ломать уже выполненный переход
+                logger.exception("Ошибка подписчика FSM-переходов")
+
+    @staticmethod
+    def _parse_fsm_message(message: str, user_id: int) -> Optional[Dict]:
+        """Переход из текста успешного ответа FSM (None, если текст другой)."""
+        match = FSM_SUCCESS_MESSAGE.match(message or "")
+        if not match:
+            return None
+        transition: Dict = match.groupdict()
+        transition["entity_id"] = int(transition["entity_id"])
+        transition["user_id"] = user_id
+        return transition
+
+    # ==================== FSM ДВИЖОК В ПАМЯТИ ====================
+
+    def _load_cached(self, cls):
+        with self.engine.connect() as conn:
+            return cls.load(conn)
+
+    def get_fsm_table(self) -> FsmTransitionTable:
+        """Граф переходов из кэша (перечитывается из БД по истечении TTL)."""
+        return self._fsm_cache.get()
+
+    def invalidate_fsm_cache(self) -> None:
+        """Сбросить кэш графа переходов (после изменения fsm_transitions и т.п.)."""
+        self._fsm_cache.invalidate()
+
+    def reload_fsm_cache(self) -> Dict:
+        """Перечитать граф переходов немедленно."""
+        self.invalidate_fsm_cache()
+        table = self.get_fsm_table()
+        return {
+            "states": len(table.states),
+            "actions": len(table.actions),
+            "transitions": len(table),
+        }
+
+    def _perform_fsm_transition(
+        self, entity_type: str, entity_id: int, action_name: str, user_id: int
+    ) -> bool:
+        """
+        FSM-переход без хранимой процедуры.
+
+        Неизвестные entity_type / действия отклоняются без транзакции
+        (но с записью в fsm_errors_log, как в процедуре).
+        Дальше одна транзакция: чтение статуса, условный
+        UPDATE ... WHERE status = :expected и запись в fsm_action_logs.
+        """
+        try:
+            fsm = self.get_fsm_table()
+        except SQLAlchemyError as e:
+            raise FsmCallError(f"FSM {action_name}: {e}") from e
+
+        try:
+            self._check_fsm_action(fsm, entity_type, action_name)
+            with self.engine.begin() as conn:
+                from_state, to_state = self._apply_fsm_transition(
+                    conn, fsm, entity_type, entity_id, action_name, user_id
+                )
+        except FsmCallError as e:
+            self._log_fsm_error(str(e), entity_type, entity_id, action_name, user_id)
+            raise
+        except SQLAlchemyError as e:
+            self._log_fsm_error(
+                f"SQL Exception during {action_name}",
+                entity_type, entity_id, action_name, user_id,
             )
-        except Error as e:
             raise FsmCallError(f"FSM {action_name}: {e}") from e
 
+        self._notify_transitions([
+            {
+                "entity_type": entity_type,
+                "entity_id": entity_id,
+                "action_name": action_name,
+                "from_state": from_state,
+                "to_state": to_state,
+                "user_id": user_id,
+            }
+        ])
+        return True
+
+    @staticmethod
+    def _check_fsm_action(
+        fsm: FsmTransitionTable, entity_type: str, action_name: str
+    ) -> None:
+        """Проверки, не требующие БД: известны ли entity_type и действие."""
+        if entity_type not in FSM_ENTITY_TABLES:
+            raise FsmCallError(f"FSM {action_name}: Unknown entity_type: {entity_type}")
+        if action_name not in fsm.actions:
+            raise FsmCallError(f"FSM {action_name}: Unknown action: {action_name}")
+        if not fsm.from_states(action_name):
+            raise FsmCallError(
+                f"ERROR: No transition for {action_name} from any state"
+            )
+
+    @staticmethod
+    def _fsm_success_message(
+        entity_type: str, entity_id: int, action_name: str, from_state: str, to_state: str
+    ) -> str:
+        """Тот же текст, что возвращает fsm_perform_action при успехе."""
+        return (
+            f'FSM action "{action_name}" applied on {entity_type} #{entity_id}: '
+            f"{from_state} → {to_state}"
+        )
+
+    def _apply_fsm_transition(
+        self,
+        conn,
+        fsm: FsmTransitionTable,
+        entity_type: str,
+        entity_id: int,
+        action_name: str,
+        user_id: int,
+    ) -> Tuple[str, str]:
+        """Переход внутри уже открытой транзакции conn. Возвращает (from_state, to_state)."""
+        table_name = FSM_ENTITY_TABLES[entity_type]
+        columns = "status, active" if entity_type == "trip" else "status"
+        row = conn.execute(
+            text(f"SELECT {columns} FROM {table_name} WHERE id = :id"),
+            {"id": entity_id},
+        ).fetchone()
+        if not row:
+            raise FsmCallError(f"Entity not found: {entity_type} #{entity_id}")
+
+        current_status = row[0]
+        if current_status is None:
+            raise FsmCallError(f"Entity has NULL status: {entity_type} #{entity_id}")
+
+        if (
+            entity_type == "trip"
+            and action_name in TRIP_ACTIONS_REQUIRE_ACTIVE
+            and row[1] == 0
+        ):
+            raise FsmCallError(f"ERROR: Trip #{entity_id} not active yet")
+
+        next_status = fsm.next_state(current_status, action_name)
+        if next_status is None:
+            raise FsmCallError(
+                f"ERROR: No transition for {action_name} from state {current_status}"
+            )
+
+        updated = conn.execute(
+            text(
+                f"UPDATE {table_name} SET status = :next_status "
+                "WHERE id = :id AND status = :expected"
+            ),
+            {"next_status": next_status, "id": entity_id, "expected": current_status},
+        ).rowcount
+        if updated != 1:
+            raise FsmCallError(
+                f"ERROR: {entity_type} #{entity_id} changed state concurrently "
+                f"(expected {current_status})"
+            )
+
+        conn.execute(
+            text(
+                "INSERT INTO fsm_action_logs "
+                "(entity_type, entity_id, action_name, from_state, to_state, user_id, created_at) "
+                "VALUES (:entity_type, :entity_id, :action_name, :from_state, :to_state, :user_id, NOW())"
+            ),
+            {
+                "entity_type": entity_type,
+                "entity_id": entity_id,
+                "action_name": action_name,
+                "from_state": current_status,
+                "to_state": next_status,
+                "user_id": user_id,
+            },
+        )
+        return current_status, next_status
+
+    def _log_fsm_error(
+        self,
+        message: str,
+        entity_type: str,
+        entity_id: int,
+        action_name: str,
+        user_id: int,
+    ) -> None:
+        """Записать отказ перехода в fsm_errors_log (как это делает fsm_perform_action)."""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text(
+                        "INSERT IGNORE INTO fsm_errors_log "
+                        "(error_time, error_message, entity_type, entity_id, action_name, user_id) "
+                        "VALUES (NOW(), :message, :entity_type, :entity_id, :action_name, :user_id)"
+                    ),
+                    {
+                        "message": message,
+                        "entity_type": entity_type,
+                        "entity_id": entity_id,
+                        "action_name": action_name,
+                        "user_id": user_id,
+                    },
+                )
+        except SQLAlchemyError:
+            pass
+
     # ==================== FSM ОБЁРТКИ (TRIP / ORDER / LOCKER) ====================
 
     # ---------- TRIP / РЕЙСЫ ----------
@@ -396,11 +1474,19 @@ class DatabaseLayer:
 
     # ==================== КНОПКИ ====================
 
+    def get_button_matrix(self) -> ButtonMatrix:
+        """Таблица button_states из кэша (перечитывается по истечении TTL)."""
+        return self._button_cache.get()
+
+    def reload_button_cache(self) -> Dict:
+        """Перечитать button_states немедленно."""
+        self._button_cache.invalidate()
+        return {"buttons": len(self.get_button_matrix())}
+
     def get_buttons(
         self, user_role: str, entity_type: str, entity_id: int
     ) -> List[Dict]:
-        """Доступные кнопки для роли и статуса."""
-        session = self.session
+        """Доступные кнопки для роли и статуса (button_states — из кэша)."""
         status_query = {
             "order": text("SELECT status FROM orders WHERE id = :id"),
             "trip": text("SELECT status, active FROM trips WHERE id = :id"),
@@ -409,50 +1495,52 @@ class DatabaseLayer:
         if entity_type not in status_query:
             raise DbLayerError(f"Неизвестный entity_type: {entity_type}")
 
-        result = session.execute(
+        result = self.session.execute(
             status_query[entity_type], {"id": entity_id}
         ).fetchone()
         if not result:
             raise DbLayerError(f"Сущность {entity_type}/{entity_id} не найдена")
 
-        if entity_type == "trip":
-            current_status, active_flag = result
-            if active_flag == 0 and current_status in ["trip_created", "trip_assigned"]:
-                effective_state = current_status + "_inactive"
-            else:
-                effective_state = current_status
-        else:
-            effective_state = result[0]
+        active_flag = result[1] if entity_type == "trip" else None
+        return self.get_button_matrix().resolve(
+            user_role, entity_type, result[0], active_flag
+        )
 
-        rows = session.execute(
-            text(
-                "SELECT button_name, is_enabled "
-                "FROM button_states "
-                "WHERE user_role = :role AND entity_state = :state"
-            ),
-            {"role": user_role, "state": effective_state},
-        ).fetchall()
+    def get_buttons_bulk(
+        self, user_role: str, entities: List[Tuple[str, int]]
+    ) -> Dict[Tuple[str, int], List[Dict]]:
+        """
+        Кнопки роли сразу для многих сущностей.
 
-        # Fallback для неактивных рейсов
-        if not rows and entity_type == "trip" and "_inactive" in effective_state:
-            rows = session.execute(
+        Статусы читаются одним запросом IN (...) на каждый entity_type,
+        кнопки берутся из кэша button_states. Ключ результата —
+        (entity_type, entity_id); ненайденных сущностей в нём нет.
+        """
+        ids_by_type: Dict[str, List[int]] = {}
+        for entity_type, entity_id in entities:
+            if entity_type not in FSM_ENTITY_TABLES:
+                raise DbLayerError(f"Неизвестный entity_type: {entity_type}")
+            ids_by_type.setdefault(entity_type, []).append(entity_id)
+
+        matrix = self.get_button_matrix()
+        buttons: Dict[Tuple[str, int], List[Dict]] = {}
+        for entity_type, ids in ids_by_type.items():
+            unique_ids = list(dict.fromkeys(ids))
+            columns = "id, status, active" if entity_type == "trip" else "id, status"
+            placeholders = ", ".join(f":id{i}" for i in range(len(unique_ids)))
+            rows = self.session.execute(
                 text(
-                    "SELECT button_name, is_enabled "
-                    "FROM button_states "
-                    "WHERE user_role = :role AND entity_state = :state"
+                    f"SELECT {columns} FROM {FSM_ENTITY_TABLES[entity_type]} "
+                    f"WHERE id IN ({placeholders})"
                 ),
-                {"role": user_role, "state": current_status},
+                {f"id{i}": entity_id for i, entity_id in enumerate(unique_ids)},
             ).fetchall()
-
-        return [
-            {
-                "button_name": row[0],
-                "is_enabled": (
-                    row[1] == "active" if isinstance(row[1], str) else bool(row[1])
-                ),
-            }
-            for row in rows
-        ]
+            for row in rows:
+                active_flag = row[2] if entity_type == "trip" else None
+                buttons[(entity_type, row[0])] = matrix.resolve(
+                    user_role, entity_type, row[1], active_flag
+                )
+        return buttons
 
     def get_active_buttons(
         self, user_role: str, entity_type: str, entity_id: int
@@ -542,17 +1630,19 @@ class DatabaseLayer:
             self.session.execute(
                 text(
                     "INSERT IGNORE INTO lockers "
-                    "(id, model_id, locker_code, location_address) "
-                    "VALUES (:id, :model_id, :code, :address)"
+                    "(id, model_id, locker_code, location_address, city_id) "
+                    "VALUES (:id, :model_id, :code, :address, :city_id)"
                 ),
                 {
                     "id": locker_id,
                     "model_id": model_id,
                     "code": locker_code,
                     "address": location_address,
+                    "city_id": self.get_city_id(self._city_from_address(location_address)),
                 },
             )
             self.session.commit()
+            self.invalidate_city_cache()
             return True
         except Exception as e:
             self.session.rollback()
@@ -561,69 +1651,246 @@ class DatabaseLayer:
     def create_locker_cell(
         self, locker_id: int, cell_code: str, cell_type: str = "S"
     ) -> Optional[int]:
-        """Создать ячейку постамата (или вернуть существующую)."""
-        try:
-            existing = self.session.execute(
-                text(
-                    "SELECT id FROM locker_cells "
-                    "WHERE locker_id = :l_id AND cell_code = :c_code"
-                ),
-                {"l_id": locker_id, "c_code": cell_code},
-            ).fetchone()
-            if existing:
-                return existing[0]
+        """
+        Создать ячейку постамата (или вернуть существующую).
 
-            self.session.execute(
+        Один INSERT: для существующей пары (locker_id, cell_code)
+        ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id) отдаёт её id через
+        lastrowid, ничего не меняя.
+        """
+        try:
+            cell_id = self.session.execute(
                 text(
                     "INSERT INTO locker_cells "
                     "(locker_id, cell_code, cell_type, status) "
-                    "VALUES (:locker_id, :cell_code, :cell_type, 'locker_free')"
+                    "VALUES (:locker_id, :cell_code, :cell_type, 'locker_free') "
+                    "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)"
                 ),
                 {
                     "locker_id": locker_id,
                     "cell_code": cell_code,
                     "cell_type": cell_type,
                 },
-            )
-            row = self.session.execute(text("SELECT LAST_INSERT_ID()")).fetchone()
+            ).lastrowid
             self.session.commit()
-            return int(row[0]) if row and row[0] else None
+            self.invalidate_city_cache()
+            return int(cell_id) if cell_id else None
         except Exception as e:
             self.session.rollback()
             raise DbLayerError(f"Ячейка {cell_code}: {e}") from e
 
-    def find_free_cell(self, locker_id: int) -> Optional[int]:
-        """Найти любую свободную ячейку в постамате."""
-        row = self.session.execute(
-            text(
-                "SELECT id FROM locker_cells "
-                "WHERE locker_id = :locker_id AND status = 'locker_free' "
-                "LIMIT 1"
-            ),
-            {"locker_id": locker_id},
-        ).fetchone()
-        return row[0] if row else None   
+    @staticmethod
+    def model_cell_codes(counts: Dict[str, int]) -> List[Tuple[str, str]]:
+        """
+        Коды ячеек по модели постамата: {"S": 2, "M": 1} ->
+        [("S-01", "S"), ("S-02", "S"), ("M-01", "M")].
+        """
+        return [
+            (f"{cell_type}-{n:02d}", cell_type)
+            for cell_type in CELL_TYPE_COUNT_COLUMNS
+            for n in range(1, (counts.get(cell_type) or 0) + 1)
+        ]
 
-    def get_lockers(self) -> List[Dict]:
+    def provision_locker_cells(
+        self, locker_ids: Iterable[int], chunk_size: int = 1000
+    ) -> Dict[int, int]:
         """
-        Получить список всех постаматов.
+        Создать все ячейки постаматов по их моделям (cell_count_s/m/l/p).
 
-        Возвращает:
-            [
-                {
-                    "id": 1,
-                    "locker_code": "POST1",
-                    "location_address": "Москва, Точка #1",
-                    "status": "locker_active",
-                    "latitude": 55.123456,
-                    "longitude": 37.123456,
-                },
-                ...
-            ]
+        Ячейки вставляются многострочным INSERT ... ON DUPLICATE KEY UPDATE
+        (по chunk_size строк, одна транзакция), поэтому повторный вызов
+        ничего не ломает: существующие ячейки со статусами и заказами
+        остаются как есть. Лишние ячейки (модель уменьшили) не удаляются.
+
+        Returns:
+            {locker_id: число ячеек по модели}
         """
-        rows = self.session.execute(
-            text(
-                """
+        try:
+            with self.engine.begin() as conn:
+                counts = self._provision_cells(conn, locker_ids, chunk_size)
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Ячейки постаматов: {e}") from e
+        self.invalidate_city_cache()
+        return counts
+
+    def provision_lockers(
+        self,
+        lockers: List[Dict],
+        with_cells: bool = True,
+        chunk_size: int = 1000,
+    ) -> Dict:
+        """
+        Массово завести постаматы (и их ячейки) одной транзакцией.
+
+        lockers — [{"locker_id", "locker_code", "location_address", "model_id"}].
+        Постаматы пишутся многострочным INSERT ... ON DUPLICATE KEY UPDATE
+        (повторный вызов обновит адрес, модель и город), city_id — одним
+        get_city_ids на все адреса; затем ячейки по моделям, как в
+        provision_locker_cells. locker_code уникален: код, который уже
+        носит другой постамат (или повторён в запросе), — DbLayerError до
+        записи, иначе upsert переписал бы чужой постамат.
+
+        Returns:
+            {"lockers": n, "cells": n, "cells_by_locker": {locker_id: n}}
+        """
+        if not lockers:
+            return {"lockers": 0, "cells": 0, "cells_by_locker": {}}
+        rows = [
+            {
+                "id": locker["locker_id"],
+                "model_id": locker.get("model_id") or 1,
+                "locker_code": locker["locker_code"],
+                "location_address": locker["location_address"],
+                "city": self._city_from_address(locker["location_address"]),
+            }
+            for locker in lockers
+        ]
+        codes = _locker_codes(rows)
+        city_ids = self.get_city_ids({row["city"] for row in rows})
+        for row in rows:
+            row["city_id"] = city_ids.get(row["city"])
+
+        model_ids = sorted({row["model_id"] for row in rows})
+        try:
+            with self.engine.begin() as conn:
+                params = {f"model{i}": model_id for i, model_id in enumerate(model_ids)}
+                placeholders = ", ".join(f":{name}" for name in params)
+                known = {
+                    row[0]
+                    for row in conn.execute(
+                        text(f"SELECT id FROM locker_models WHERE id IN ({placeholders})"),
+                        params,
+                    ).fetchall()
+                }
+                unknown = [model_id for model_id in model_ids if model_id not in known]
+                if unknown:
+                    raise DbLayerError(f"Неизвестные модели постаматов: {unknown}")
+
+                taken: Dict[str, int] = {}
+                code_list = sorted({row["locker_code"] for row in rows})
+                for start in range(0, len(code_list), chunk_size):
+                    params = {
+                        f"code{i}": code
+                        for i, code in enumerate(code_list[start:start + chunk_size])
+                    }
+                    placeholders = ", ".join(f":{name}" for name in params)
+                    taken.update(
+                        (row[1], row[0])
+                        for row in conn.execute(
+                            text(
+                                "SELECT id, locker_code FROM lockers "
+                                f"WHERE locker_code IN ({placeholders}) FOR UPDATE"
+                            ),
+                            params,
+                        ).fetchall()
+                    )
+                _check_locker_codes(codes, taken)
+
+                columns = ("id", "model_id", "locker_code", "location_address", "city_id")
+                for start in range(0, len(rows), chunk_size):
+                    values, params = self._values_clause(columns, rows[start:start + chunk_size])
+                    conn.execute(
+                        text(
+                            f"INSERT INTO lockers ({', '.join(columns)}) VALUES {values} AS new "
+                            "ON DUPLICATE KEY UPDATE model_id = new.model_id, "
+                            "locker_code = new.locker_code, "
+                            "location_address = new.location_address, city_id = new.city_id"
+                        ),
+                        params,
+                    )
+                cells = (
+                    self._provision_cells(conn, [row["id"] for row in rows], chunk_size)
+                    if with_cells else {}
+                )
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Постаматы: {e}") from e
+        self.invalidate_city_cache()
+        return {
+            "lockers": len(rows),
+            "cells": sum(cells.values()),
+            "cells_by_locker": cells,
+        }
+
+    def _provision_cells(
+        self, conn, locker_ids: Iterable[int], chunk_size: int
+    ) -> Dict[int, int]:
+        """Ячейки постаматов по моделям внутри транзакции conn."""
+        locker_ids = sorted(set(locker_ids))
+        if not locker_ids:
+            return {}
+        params = {f"id{i}": locker_id for i, locker_id in enumerate(locker_ids)}
+        placeholders = ", ".join(f":{name}" for name in params)
+        count_columns = ", ".join(f"m.{column}" for column in CELL_TYPE_COUNT_COLUMNS.values())
+        models = {
+            row[0]: dict(zip(CELL_TYPE_COUNT_COLUMNS, row[1:]))
+            for row in conn.execute(
+                text(
+                    f"SELECT l.id, {count_columns} "
+                    "FROM lockers l JOIN locker_models m ON m.id = l.model_id "
+                    f"WHERE l.id IN ({placeholders})"
+                ),
+                params,
+            ).fetchall()
+        }
+        missing = [locker_id for locker_id in locker_ids if locker_id not in models]
+        if missing:
+            raise DbLayerError(f"Постаматы не найдены: {missing}")
+
+        cells = [
+            {"locker_id": locker_id, "cell_code": code, "cell_type": cell_type, "status": "locker_free"}
+            for locker_id in locker_ids
+            for code, cell_type in self.model_cell_codes(models[locker_id])
+        ]
+        columns = ("locker_id", "cell_code", "cell_type", "status")
+        for start in range(0, len(cells), chunk_size):
+            values, params = self._values_clause(columns, cells[start:start + chunk_size])
+            # Существующая ячейка (может быть занята или в резерве) не
+            # меняется: UPDATE без изменений вместо INSERT IGNORE, чтобы не
+            # глотать остальные ошибки
+            conn.execute(
+                text(
+                    f"INSERT INTO locker_cells ({', '.join(columns)}) VALUES {values} "
+                    "ON DUPLICATE KEY UPDATE cell_type = cell_type"
+                ),
+                params,
+            )
+        return {
+            locker_id: len(self.model_cell_codes(models[locker_id]))
+            for locker_id in locker_ids
+        }
+
+    def find_free_cell(self, locker_id: int) -> Optional[int]:
+        """Найти любую свободную ячейку в постамате."""
+        row = self.session.execute(
+            text(
+                "SELECT id FROM locker_cells "
+                "WHERE locker_id = :locker_id AND status = 'locker_free' "
+                "LIMIT 1"
+            ),
+            {"locker_id": locker_id},
+        ).fetchone()
+        return row[0] if row else None   
+
+    def get_lockers(self) -> List[Dict]:
+        """
+        Получить список всех постаматов.
+
+        Возвращает:
+            [
+                {
+                    "id": 1,
+                    "locker_code": "POST1",
+                    "location_address": "Москва, Точка #1",
+                    "status": "locker_active",
+                    "latitude": 55.123456,
+                    "longitude": 37.123456,
+                },
+                ...
+            ]
+        """
+        rows = self.session.execute(
+            text(
+                """
                 SELECT
                     id,
                     locker_code,
@@ -685,18 +1952,225 @@ class DatabaseLayer:
         Example:
             city = db.get_locker_city_by_cell(1)  # "Москва"
         """
-        result = self.session.execute(text("""
-            SELECT l.location_address 
-            FROM locker_cells lc
-            JOIN lockers l ON l.id = lc.locker_id
-            WHERE lc.id = :cell_id
-        """), {"cell_id": cell_id}).scalar()
-        
-        if not result:
+        city = self.get_cities_for_cells([cell_id]).get(cell_id)
+        if not city:
             raise DbLayerError(f"Ячейка {cell_id} не найдена или у постамата нет адреса")
-        
+        return city
+
+    def get_cities_for_cells(self, cell_ids: Iterable[int]) -> Dict[int, str]:
+        """
+        Города для нескольких ячеек: {cell_id: город}.
+
+        Сначала LRU-кэш, промахи — одним запросом locker_cells ⋈ lockers.
+        Ячеек без адреса постамата (или несуществующих) в ответе нет.
+        """
+        wanted = list(dict.fromkeys(cell_ids))
+        cities = self._city_cache.get_many(wanted)
+        missing = [cell_id for cell_id in wanted if cell_id not in cities]
+        if missing:
+            params = {f"cell{i}": cell_id for i, cell_id in enumerate(missing)}
+            placeholders = ", ".join(f":{name}" for name in params)
+            rows = self.session.execute(
+                text(
+                    "SELECT lc.id, c.name, l.location_address "
+                    "FROM locker_cells lc "
+                    "JOIN lockers l ON l.id = lc.locker_id "
+                    "LEFT JOIN cities c ON c.id = l.city_id "
+                    f"WHERE lc.id IN ({placeholders})"
+                ),
+                params,
+            ).fetchall()
+            loaded = self._cell_cities(rows)
+            self._city_cache.put_many(loaded)
+            cities.update(loaded)
+        return cities
+
+    def warm_city_cache(self) -> int:
+        """
+        Заполнить кэш городов одним запросом (не больше размера кэша).
+
+        Возвращает число загруженных ячеек.
+        """
+        rows = self.session.execute(
+            text(
+                "SELECT lc.id, c.name, l.location_address "
+                "FROM locker_cells lc "
+                "JOIN lockers l ON l.id = lc.locker_id "
+                "LEFT JOIN cities c ON c.id = l.city_id "
+                "WHERE l.city_id IS NOT NULL OR l.location_address IS NOT NULL "
+                "ORDER BY lc.id LIMIT :limit"
+            ),
+            {"limit": self._city_cache.maxsize},
+        ).fetchall()
+        loaded = self._cell_cities(rows)
+        self._city_cache.put_many(loaded)
+        return len(loaded)
+
+    def invalidate_city_cache(self) -> None:
+        """Сбросить кэш городов (после изменения постаматов/ячеек)."""
+        self._city_cache.invalidate()
+
+    def get_city_cache_stats(self) -> Dict:
+        return self._city_cache.stats()
+
+    @classmethod
+    def _cell_cities(cls, rows) -> Dict[int, str]:
+        """Строки (cell_id, cities.name, location_address) → {cell_id: город}."""
+        cities = {}
+        for cell_id, city_name, address in rows:
+            if city_name:
+                cities[cell_id] = city_name
+            elif address:
+                # Постамат ещё без city_id (до backfill) — разбираем адрес
+                cities[cell_id] = cls._city_from_address(address)
+        return cities
+
+    @staticmethod
+    def _city_from_address(address: str) -> str:
         # Парсим: "Москва, Ленина 10" → "Москва"
-        return result.split(",")[0].strip()
+        return normalize_city(address.split(",")[0])
+
+    # ==================== СПРАВОЧНИК ГОРОДОВ ====================
+
+    def get_city_ids(
+        self, names: Iterable[str], create: bool = True, conn=None
+    ) -> Dict[str, int]:
+        """
+        {имя как передано: cities.id} по нормализованным именам.
+
+        create=True — неизвестные города добавляются в справочник (отдельной
+        короткой транзакцией, чтобы id не пропал при откате вызывающего);
+        create=False — неизвестные города в ответ не попадают.
+        conn — искать и добавлять в транзакции вызывающего (шаг миграции);
+        такие id не кэшируются, пока она не закоммичена.
+        """
+        canonical = {name: normalize_city(name) for name in names if name}
+        canonical = {name: city for name, city in canonical.items() if city}
+        wanted = set(canonical.values())
+        with self._city_ids_lock:
+            ids = {city: self._city_ids[city] for city in wanted if city in self._city_ids}
+        missing = sorted(wanted - ids.keys())
+        if missing:
+            params = {f"city{i}": city for i, city in enumerate(missing)}
+            placeholders = ", ".join(f":{name}" for name in params)
+            with self._connection(conn) as tx:
+                if create:
+                    tx.execute(
+                        text("INSERT IGNORE INTO cities (name) VALUES (:name)"),
+                        [{"name": city} for city in missing],
+                    )
+                rows = tx.execute(
+                    text(f"SELECT id, name FROM cities WHERE name IN ({placeholders})"),
+                    params,
+                ).fetchall()
+            # Сравнение в MySQL регистронезависимое — сопоставляем так же
+            by_lower = {row[1].lower(): row[0] for row in rows}
+            loaded = {city: by_lower[city.lower()] for city in missing if city.lower() in by_lower}
+            if conn is None:
+                with self._city_ids_lock:
+                    self._city_ids.update(loaded)
+            ids.update(loaded)
+        return {name: ids[city] for name, city in canonical.items() if city in ids}
+
+    def get_city_id(self, name: Optional[str], create: bool = True) -> Optional[int]:
+        """cities.id для одного города (None для пустого/неизвестного при create=False)."""
+        if not name:
+            return None
+        return self.get_city_ids([name], create).get(name)
+
+    def _route_city_ids(
+        self, from_city: Optional[str], to_city: Optional[str]
+    ) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        """
+        id городов маршрута для фильтра (None в паре — город не задан).
+
+        None целиком — задан город, которого нет в справочнике: по такому
+        маршруту заведомо ничего нет.
+        """
+        ids = self.get_city_ids([c for c in (from_city, to_city) if c], create=False)
+        if (from_city and from_city not in ids) or (to_city and to_city not in ids):
+            return None
+        return (ids.get(from_city) if from_city else None, ids.get(to_city) if to_city else None)
+
+    def _route_ids(self, from_city: str, to_city: str) -> Dict[str, int]:
+        """
+        {"from_city_id", "to_city_id"} маршрута, города добавляются в справочник.
+
+        Пустой город или имя, которое не удалось записать в cities
+        (например, длиннее колонки), — DbLayerError.
+        """
+        ids = self.get_city_ids([from_city, to_city])
+        for city in (from_city, to_city):
+            if city not in ids:
+                raise DbLayerError(f"Некорректный город маршрута: '{city}'")
+        return {"from_city_id": ids[from_city], "to_city_id": ids[to_city]}
+
+    def backfill_city_ids(self, chunk_size: int = 1000, conn=None) -> Dict[str, int]:
+        """
+        Заполнить city_id у существующих постаматов, заказов и рейсов.
+
+        Идёт короткими транзакциями по chunk_size строк и трогает только
+        строки с NULL id, поэтому безопасен для повторного запуска.
+        conn — вся работа на этом соединении, в транзакции вызывающего
+        (шаг миграции не берёт из пула лишних соединений).
+
+        Returns:
+            {"lockers": n, "orders.from_city_id": n, ...} — сколько строк обновлено
+        """
+        counts: Dict[str, int] = {"lockers": 0}
+
+        last_id = 0
+        while True:
+            with self._connection(conn) as tx:
+                rows = tx.execute(
+                    text(
+                        "SELECT id, location_address FROM lockers "
+                        "WHERE city_id IS NULL AND location_address IS NOT NULL "
+                        "  AND id > :last_id ORDER BY id LIMIT :chunk_size"
+                    ),
+                    {"last_id": last_id, "chunk_size": chunk_size},
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                cities = {row[0]: self._city_from_address(row[1]) for row in rows}
+                city_ids = self.get_city_ids(cities.values(), conn=conn)
+                for locker_id, city in cities.items():
+                    counts["lockers"] += tx.execute(
+                        text("UPDATE lockers SET city_id = :city_id WHERE id = :id"),
+                        {"city_id": city_ids[city], "id": locker_id},
+                    ).rowcount
+
+        for table in ("orders", "trips"):
+            for column in ("from_city", "to_city"):
+                key = f"{table}.{column}_id"
+                counts[key] = 0
+                with self._connection(conn) as tx:
+                    names = [
+                        row[0]
+                        for row in tx.execute(
+                            text(
+                                f"SELECT DISTINCT {column} FROM {table} "
+                                f"WHERE {column}_id IS NULL AND {column} IS NOT NULL"
+                            )
+                        ).fetchall()
+                    ]
+                city_ids = self.get_city_ids(names, conn=conn)
+                for name in names:
+                    while True:
+                        with self._connection(conn) as tx:
+                            updated = tx.execute(
+                                text(
+                                    f"UPDATE {table} SET {column}_id = :city_id "
+                                    f"WHERE {column} = :name AND {column}_id IS NULL "
+                                    "LIMIT :chunk_size"
+                                ),
+                                {"city_id": city_ids[name], "name": name, "chunk_size": chunk_size},
+                            ).rowcount
+                        counts[key] += updated
+                        if updated < chunk_size:
+                            break
+        return counts
 
     def clear_locker_cells(self, locker_id: int) -> bool:
         """Удалить все ячейки постамата (осторожно)."""
@@ -706,6 +2180,7 @@ class DatabaseLayer:
                 {"locker_id": locker_id},
             )
             self.session.commit()
+            self.invalidate_city_cache()
             return True
         except Exception as e:
             self.session.rollback()
@@ -784,19 +2259,22 @@ class DatabaseLayer:
         Returns:
             ID созданного заказа
         """
+        city_ids = self.get_city_ids([from_city, to_city])
         try:
             self.session.execute(
                 text(
                     "INSERT INTO orders "
-                    "(description, from_city, to_city, source_cell_id, dest_cell_id, "
-                    "pickup_type, delivery_type, status) "
-                    "VALUES (:desc, :from_city, :to_city, :source_cell_id, :dest_cell_id, "
-                    ":pickup_type, :delivery_type, 'order_created')"
+                    "(description, from_city, to_city, from_city_id, to_city_id, "
+                    "source_cell_id, dest_cell_id, pickup_type, delivery_type, status) "
+                    "VALUES (:desc, :from_city, :to_city, :from_city_id, :to_city_id, "
+                    ":source_cell_id, :dest_cell_id, :pickup_type, :delivery_type, 'order_created')"
                 ),
                 {
                     "desc": description,
                     "from_city": from_city,
                     "to_city": to_city,
+                    "from_city_id": city_ids.get(from_city),
+                    "to_city_id": city_ids.get(to_city),
                     "source_cell_id": source_cell_id,
                     "dest_cell_id": dest_cell_id,
                     "pickup_type": pickup_type,
@@ -810,6 +2288,126 @@ class DatabaseLayer:
             self.session.rollback()
             raise DbLayerError(f"Заказ '{description}': {e}") from e
 
+    def create_orders_bulk(
+        self,
+        rows: List[Dict],
+        auto_assign_trip: bool = True,
+        max_orders: int = TRIP_MAX_ORDERS,
+        chunk_size: int = 500,
+    ) -> Dict:
+        """
+        Массовое создание заказов (импорт мерчанта).
+
+        Строка — {"description", "from_city", "to_city", "source_cell_id",
+        "dest_cell_id", "pickup_type", "delivery_type"}; если город не задан,
+        он берётся по ячейке (один запрос на все ячейки, см.
+        get_cities_for_cells), id городов — одним get_city_ids.
+        Заказы вставляются многострочными INSERT по chunk_size строк; каждая
+        пачка — одна транзакция вместе с раскладкой её заказов по рейсам
+        (_pack_orders_into_trips). Ошибка БД проваливает только свою пачку.
+
+        Returns:
+            {"results": [...], "created": n, "failed": n, "new_trip_ids": [...]},
+            results — в порядке rows: {"order_id", "trip_id"} или {"error"}.
+        """
+        results: List[Optional[Dict]] = [None] * len(rows)
+
+        cell_ids = {
+            row.get(key)
+            for row in rows
+            for key in ("source_cell_id", "dest_cell_id")
+            if row.get(key) is not None
+        }
+        cell_cities = self.get_cities_for_cells(cell_ids) if cell_ids else {}
+
+        prepared: List[Tuple[int, Dict]] = []
+        for index, row in enumerate(rows):
+            from_city = row.get("from_city") or cell_cities.get(row.get("source_cell_id"))
+            to_city = row.get("to_city") or cell_cities.get(row.get("dest_cell_id"))
+            pickup_type = row.get("pickup_type") or "courier"
+            delivery_type = row.get("delivery_type") or "courier"
+            if not row.get("description"):
+                error = "Не задано описание заказа"
+            elif not normalize_city(from_city or "") or not normalize_city(to_city or ""):
+                error = "Не удалось определить маршрут: нужны from_city/to_city или ячейки постаматов с адресом"
+            elif pickup_type not in ORDER_HANDOFF_TYPES:
+                error = f"Неизвестный pickup_type '{pickup_type}'"
+            elif delivery_type not in ORDER_HANDOFF_TYPES:
+                error = f"Неизвестный delivery_type '{delivery_type}'"
+            else:
+                error = None
+            if error:
+                results[index] = {"error": error}
+                continue
+            prepared.append((index, {
+                "description": row["description"],
+                "from_city": from_city,
+                "to_city": to_city,
+                "source_cell_id": row.get("source_cell_id"),
+                "dest_cell_id": row.get("dest_cell_id"),
+                "pickup_type": pickup_type,
+                "delivery_type": delivery_type,
+                "status": "order_created",
+            }))
+
+        city_ids = self.get_city_ids(
+            {values["from_city"] for _, values in prepared}
+            | {values["to_city"] for _, values in prepared}
+        )
+        routed: List[Tuple[int, Dict]] = []
+        for index, values in prepared:
+            missing = [
+                city for city in (values["from_city"], values["to_city"]) if city not in city_ids
+            ]
+            if missing:
+                results[index] = {"error": f"Некорректный город маршрута: '{missing[0]}'"}
+                continue
+            values["from_city_id"] = city_ids[values["from_city"]]
+            values["to_city_id"] = city_ids[values["to_city"]]
+            routed.append((index, values))
+        prepared = routed
+
+        new_trip_ids: List[int] = []
+        for start in range(0, len(prepared), chunk_size):
+            chunk = prepared[start:start + chunk_size]
+            trips: Dict[int, int] = {}
+            created: List[int] = []
+            try:
+                with self._slot_transaction() as conn:
+                    order_ids = self._insert_values(
+                        conn,
+                        "orders",
+                        ("description", "from_city", "to_city", "from_city_id", "to_city_id",
+                         "source_cell_id", "dest_cell_id", "pickup_type", "delivery_type", "status"),
+                        [values for _, values in chunk],
+                    )
+                    if auto_assign_trip:
+                        trips, created = self._pack_orders_into_trips(
+                            conn,
+                            [
+                                {"id": order_id, **values}
+                                for order_id, (_, values) in zip(order_ids, chunk)
+                            ],
+                            max_orders,
+                        )
+            except SQLAlchemyError as e:
+                # Без текста SQL: он повторил бы всю пачку в каждой строке ответа
+                reason = getattr(e, "orig", None) or e
+                for index, _ in chunk:
+                    results[index] = {"error": f"Ошибка БД: {reason}"}
+                continue
+            new_trip_ids.extend(created)
+            for order_id, (index, _) in zip(order_ids, chunk):
+                results[index] = {"order_id": order_id, "trip_id": trips.get(order_id)}
+
+        created = sum(1 for result in results if "order_id" in result)
+        return {
+            "results": results,
+            "created": created,
+            "failed": len(results) - created,
+            "new_trip_ids": new_trip_ids,
+        }
+
     def get_order(self, order_id: int) -> Optional[Dict]:
         """Вернуть заказ по ID."""
         row = self.session.execute(
@@ -834,36 +2432,36 @@ class DatabaseLayer:
             }
         return None
 
+    def get_order_routes(self, order_ids: List[int]) -> Dict[int, Dict]:
+        """
+        Маршрут и способы передачи заказов одним запросом:
+        {order_id: {from_city, to_city, from_city_id, to_city_id, pickup_type, delivery_type}}.
+        """
+        if not order_ids:
+            return {}
+        params = {f"id{i}": order_id for i, order_id in enumerate(order_ids)}
+        placeholders = ", ".join(f":{name}" for name in params)
+        rows = self.session.execute(
+            text(
+                "SELECT id, from_city, to_city, from_city_id, to_city_id, "
+                "pickup_type, delivery_type "
+                f"FROM orders WHERE id IN ({placeholders})"
+            ),
+            params,
+        ).fetchall()
+        return {row[0]: dict(zip(ORDER_ROUTE_COLUMNS, row[1:])) for row in rows}
+
     def get_orders_for_route(
         self, from_city: str, to_city: str, statuses: Optional[List[str]] = None
     ) -> List[Dict]:
         """Вернуть заказы по маршруту (опционально фильтруя по статусам)."""
-        params: Dict[str, object] = {"from_city": from_city, "to_city": to_city}
-        query = (
-            "SELECT id, status, description, pickup_type, delivery_type, from_city, to_city, "
-            "source_cell_id, dest_cell_id "
-            "FROM orders WHERE from_city = :from_city AND to_city = :to_city"
-        )
-        if statuses:
-            placeholders = ", ".join([f":status{i}" for i in range(len(statuses))])
-            query += f" AND status IN ({placeholders})"
-            params.update({f"status{i}": s for i, s in enumerate(statuses)})
-
+        route = self._route_city_ids(from_city, to_city)
+        if route is None:
+            return []
+        where, params = self._orders_filter(statuses, *route)
+        query, params = self._orders_query(where, params)
         rows = self.session.execute(text(query), params).fetchall()
-        return [
-            {
-                "id": row[0],
-                "status": row[1],
-                "description": row[2],
-                "pickup_type": row[3],
-                "delivery_type": row[4],
-                "from_city": row[5],
-                "to_city": row[6],
-                "source_cell_id": row[7],
-                "dest_cell_id": row[8],
-            }
-            for row in rows
-        ]
+        return [dict(zip(ORDER_LIST_COLUMNS, row)) for row in rows]
 
     def get_all_orders(
         self,
@@ -873,43 +2471,141 @@ class DatabaseLayer:
         Получить список всех заказов (без привязки к маршруту).
         Optionally: фильтр по статусам.
         """
-        query = """
-            SELECT
-                id,
-                status,
-                description,
-                pickup_type,
-                delivery_type,
-                from_city,
-                to_city,
-                source_cell_id,
-                dest_cell_id
-            FROM orders
-            WHERE 1 = 1
+        where, params = self._orders_filter(statuses)
+        query, params = self._orders_query(where, params)
+        rows = self.session.execute(text(query), params).fetchall()
+        return [dict(zip(ORDER_LIST_COLUMNS, row)) for row in rows]
+
+    def get_orders_page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        statuses: Optional[List[str]] = None,
+        from_city: Optional[str] = None,
+        to_city: Optional[str] = None,
+    ) -> Dict:
         """
-        params: Dict[str, object] = {}
+        Страница заказов по ключу id (keyset): WHERE id > :after_id LIMIT n.
 
-        if statuses:
-            placeholders = ", ".join(f":status{i}" for i in range(len(statuses)))
-            query += f" AND status IN ({placeholders})"
-            params.update({f"status{i}": s for i, s in enumerate(statuses)})
+        Стоимость страницы не зависит от её номера, в отличие от OFFSET.
 
+        Returns:
+            {"orders": [...], "next_cursor": str | None}
+        """
+        after_id = None
+        if cursor:
+            after_id = _decode_cursor(cursor, ["id"])["id"]
+            if not isinstance(after_id, int):
+                raise DbLayerError(f"Некорректный cursor: {cursor}")
+        route = self._route_city_ids(from_city, to_city)
+        if route is None:
+            return {"orders": [], "next_cursor": None}
+        where, params = self._orders_filter(statuses, *route)
+        query, params = self._orders_query(where, params, after_id, limit + 1)
         rows = self.session.execute(text(query), params).fetchall()
 
-        return [
-            {
-                "id": row[0],
-                "status": row[1],
-                "description": row[2],
-                "pickup_type": row[3],
-                "delivery_type": row[4],
-                "from_city": row[5],
-                "to_city": row[6],
-                "source_cell_id": row[7],
-                "dest_cell_id": row[8],
-            }
-            for row in rows
-        ]
+        orders = [dict(zip(ORDER_LIST_COLUMNS, row)) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = _encode_cursor({"id": orders[-1]["id"]})
+        return {"orders": orders, "next_cursor": next_cursor}
+
+    def iter_orders(
+        self,
+        statuses: Optional[List[str]] = None,
+        from_city: Optional[str] = None,
+        to_city: Optional[str] = None,
+        batch_size: int = 500,
+    ) -> Iterator[Dict]:
+        """
+        Потоковое чтение заказов без загрузки всей выборки в память.
+
+        Идёт через небуферизованный курсор mysql-connector: строки приходят с
+        сервера пачками по batch_size по мере чтения. Соединение занято, пока
+        генератор не дочитан или не закрыт.
+
+        Запрос идёт мимо событий engine, поэтому время execute и fetchmany
+        отдаётся подписчикам add_raw_query_listener().
+        """
+        route = self._route_city_ids(from_city, to_city)
+        if route is None:
+            return
+        where, params = self._orders_filter(statuses, *route)
+        query, params = self._orders_query(where, params)
+        compiled = text(query).bindparams(**params).compile(dialect=self.engine.dialect)
+        statement = str(compiled)
+
+        conn = self.engine.raw_connection()
+        finished = False
+        seconds = 0.0
+        error: Optional[BaseException] = None
+        try:
+            cursor = conn.cursor(buffered=False)
+            started = time.perf_counter()
+            try:
+                cursor.execute(statement, compiled.params)
+            finally:
+                seconds += time.perf_counter() - started
+            while True:
+                started = time.perf_counter()
+                try:
+                    rows = cursor.fetchmany(batch_size)
+                finally:
+                    seconds += time.perf_counter() - started
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(ORDER_LIST_COLUMNS, row))
+            cursor.close()
+            finished = True
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if not finished:
+                # Недочитанный результат висит на соединении — в пул его не возвращаем
+                conn.invalidate()
+            conn.close()
+            self._notify_raw_query(statement, seconds, error)
+
+    @staticmethod
+    def _orders_filter(
+        statuses: Optional[List[str]] = None,
+        from_city_id: Optional[int] = None,
+        to_city_id: Optional[int] = None,
+    ) -> Tuple[str, Dict[str, object]]:
+        """WHERE-часть листингов заказов и её параметры."""
+        conditions = ["1 = 1"]
+        params: Dict[str, object] = {}
+        if from_city_id is not None:
+            conditions.append("from_city_id = :from_city_id")
+            params["from_city_id"] = from_city_id
+        if to_city_id is not None:
+            conditions.append("to_city_id = :to_city_id")
+            params["to_city_id"] = to_city_id
+        if statuses:
+            placeholders = ", ".join(f":status{i}" for i in range(len(statuses)))
+            conditions.append(f"status IN ({placeholders})")
+            params.update({f"status{i}": s for i, s in enumerate(statuses)})
+        return " AND ".join(conditions), params
+
+    @staticmethod
+    def _orders_query(
+        where: str,
+        params: Dict[str, object],
+        after_id: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> Tuple[str, Dict[str, object]]:
+        params = dict(params)
+        query = f"SELECT {', '.join(ORDER_LIST_COLUMNS)} FROM orders WHERE {where}"
+        if after_id is not None:
+            query += " AND id > :after_id"
+            params["after_id"] = after_id
+        query += " ORDER BY id"
+        if limit is not None:
+            query += " LIMIT :limit"
+            params["limit"] = limit
+        return query, params
 
     def get_orders_for_courier(self, courier_id: int) -> List[int]:
         """IDs заказов, в которых участвует курьер (courier1 или courier2)."""
@@ -947,12 +2643,18 @@ class DatabaseLayer:
         if pickup_type == "self":
             # Клиент сам несёт
             action = "order_reserve_for_client_A_to_B"
-            print(f"[DEBUG] Заказ {order_id}: клиент сам несёт (pickup_type='self')")
+            logger.debug(
+                "Заказ %s: клиент сам несёт", order_id,
+                extra={"order_id": order_id, "pickup_type": pickup_type, "action": action},
+            )
         
         elif pickup_type == "courier":
             # Курьер забирает
             action = "order_reserve_for_courier_A_to_B"
-            print(f"[DEBUG] Заказ {order_id}: назначен курьер1 для забора (pickup_type='courier')")
+            logger.debug(
+                "Заказ %s: назначен курьер1 для забора", order_id,
+                extra={"order_id": order_id, "pickup_type": pickup_type, "action": action},
+            )
         
         else:
             raise DbLayerError(f"Неизвестный pickup_type: {pickup_type}")
@@ -981,11 +2683,17 @@ class DatabaseLayer:
         delivery_type = order.get("delivery_type", "self")
 
         if delivery_type == "self":
-            print(f"[DEBUG] Заказ {order_id}: в постамате2, ожидает самовывоз получателем")
-            print("[DEBUG] Доступное действие: order_pickup_poluchatel")
+            logger.debug(
+                "Заказ %s: в постамате2, ожидает самовывоз получателем", order_id,
+                extra={"order_id": order_id, "delivery_type": delivery_type,
+                       "available_action": "order_pickup_poluchatel"},
+            )
         elif delivery_type == "courier":
-            print(f"[DEBUG] Заказ {order_id}: в постамате2, доступен на бирже для курьера2")
-            print("[DEBUG] Доступное действие: order_assign_courier2_to_order")
+            logger.debug(
+                "Заказ %s: в постамате2, доступен на бирже для курьера2", order_id,
+                extra={"order_id": order_id, "delivery_type": delivery_type,
+                       "available_action": "order_assign_courier2_to_order"},
+            )
         else:
             raise DbLayerError(f"Неизвестный delivery_type: {delivery_type}")
 
@@ -1000,40 +2708,7 @@ class DatabaseLayer:
         - Статус: order_courier_reserved_post1_and_post2
         - pickup_type: courier
         """
-        query = """
-            SELECT o.id, o.status, o.description, o.from_city, o.to_city,
-                l.location_address as source_address,
-                lc.cell_code as source_cell_code,
-                lc.cell_type as cell_size
-            FROM orders o
-            JOIN locker_cells lc ON lc.id = o.source_cell_id
-            JOIN lockers l ON l.id = lc.locker_id
-            WHERE o.status = 'order_courier_reserved_post1_and_post2'  # ← ПРАВИЛЬНЫЙ СТАТУС
-            AND o.pickup_type = 'courier'
-        """
-        
-        params = {}
-        if city:
-            query += " AND o.from_city = :city"
-            params["city"] = city
-        
-        query += " ORDER BY o.created_at ASC"
-        
-        result = self.session.execute(text(query), params).fetchall()
-        
-        return [
-            {
-                "id": row[0],
-                "status": row[1],
-                "description": row[2],
-                "from_city": row[3],
-                "to_city": row[4],
-                "source_address": row[5],
-                "source_cell_code": row[6],
-                "cell_size": row[7],
-            }
-            for row in result
-        ]
+        return self.get_exchange_orders("pickup", city)["orders"]
 
 
     def get_available_orders_for_courier2(self, city: str = None) -> List[Dict]:
@@ -1048,40 +2723,127 @@ class DatabaseLayer:
         Returns:
             List[dict]: Список заказов для курьера2
         """
-        query = """
+        return self.get_exchange_orders("delivery", city)["orders"]
+
+    def get_exchange_orders(
+        self,
+        exchange: str,
+        city: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        since: Optional[str] = None,
+    ) -> Dict:
+        """
+        Биржа курьеров: страница по ключу или инкрементальный опрос.
+
+        Args:
+            exchange: "pickup" (курьер1) или "delivery" (курьер2)
+            city: город отправления (pickup) / назначения (delivery)
+            limit: размер страницы (None — вся биржа)
+            cursor: next_cursor предыдущей страницы (порядок created_at, id)
+            since: режим опроса — "0" для старта или since из прошлого
+                ответа; отдаются заказы с (updated_at, id) больше курсора,
+                в порядке updated_at. Старт отдаёт заказы на бирже; дальше
+                статус не фильтруется: изменившиеся заказы, которых на бирже
+                уже нет (взял курьер, отмена, таймаут), приходят id в removed.
+                Возвращаемый since не уходит дальше NOW() минус
+                EXCHANGE_POLL_LAG_SECONDS: изменения последних секунд (в том
+                числе закоммиченные позже опроса или в ту же секунду с
+                меньшим id) приходят повторно, клиент сводит их по id
+
+        Returns:
+            {"orders": [...], "removed": [id, ...], "next_cursor": str | None,
+             "since": str | None}
+        """
+        spec = EXCHANGES.get(exchange)
+        if spec is None:
+            raise DbLayerError(f"Неизвестная биржа: {exchange}")
+        prefix = spec["prefix"]
+
+        # Опрос после старта видит и ушедшие с биржи заказы (removed)
+        changes = since is not None and since != "0"
+        params: Dict[str, object] = {"status": spec["status"], "lag": EXCHANGE_POLL_LAG_SECONDS}
+        query = f"""
             SELECT o.id, o.status, o.description, o.from_city, o.to_city,
-                   l.location_address as dest_address,
-                   lc.cell_code as dest_cell_code,
-                   lc.cell_type as cell_size
+                   l.location_address AS {prefix}_address,
+                   lc.cell_code AS {prefix}_cell_code,
+                   lc.cell_type AS cell_size,
+                   o.created_at, o.updated_at,
+                   NOW() - INTERVAL :lag SECOND AS horizon
             FROM orders o
-            JOIN locker_cells lc ON lc.id = o.dest_cell_id
-            JOIN lockers l ON l.id = lc.locker_id
-            WHERE o.status = 'order_parcel_confirmed_post2'
-              AND o.delivery_type = 'courier'
+            {"LEFT JOIN" if changes else "JOIN"} locker_cells lc ON lc.id = o.{spec["cell_column"]}
+            {"LEFT JOIN" if changes else "JOIN"} lockers l ON l.id = lc.locker_id
+            WHERE o.{spec["type_column"]} = 'courier'
         """
-        
-        params = {}
+        if not changes:
+            query += " AND o.status = :status"
         if city:
-            query += " AND o.to_city = :city"
-            params["city"] = city
-        
-        query += " ORDER BY o.created_at ASC"
-        
-        result = self.session.execute(text(query), params).fetchall()
-        
-        return [
+            city_id = self.get_city_id(city, create=False)
+            if city_id is None:
+                return {"orders": [], "removed": [], "next_cursor": None, "since": since}
+            query += f" AND o.{spec['city_id_column']} = :city_id"
+            params["city_id"] = city_id
+
+        # Режим опроса идёт по updated_at, листинг — по created_at
+        key_column = "updated_at" if since is not None else "created_at"
+        token = since if since is not None else cursor
+        if token and token != "0":
+            key = _decode_cursor(token, ["ts", "id"], "since" if since is not None else "cursor")
+            query += (
+                f" AND (o.{key_column} > :key_ts"
+                f"      OR (o.{key_column} = :key_ts AND o.id > :key_id))"
+            )
+            params.update({"key_ts": key["ts"], "key_id": key["id"]})
+        query += f" ORDER BY o.{key_column} ASC, o.id ASC"
+        if limit is not None:
+            query += " LIMIT :limit"
+            params["limit"] = limit + 1
+
+        rows = self.session.execute(text(query), params).fetchall()
+        has_more = limit is not None and len(rows) > limit
+        if has_more:
+            rows = rows[:limit]
+
+        orders = [
             {
                 "id": row[0],
                 "status": row[1],
                 "description": row[2],
                 "from_city": row[3],
                 "to_city": row[4],
-                "dest_address": row[5],
-                "dest_cell_code": row[6],
+                f"{prefix}_address": row[5],
+                f"{prefix}_cell_code": row[6],
                 "cell_size": row[7],
             }
-            for row in result
+            for row in rows
+            if row[1] == spec["status"] and row[5] is not None
         ]
+        removed = [row[0] for row in rows if row[1] != spec["status"] or row[5] is None]
+
+        last_key = None
+        if rows:
+            last = rows[-1]
+            if since is None:
+                last_key = _encode_cursor({"ts": last[8], "id": last[0]})
+            else:
+                # Не дальше горизонта: (horizon, 0) перечитает всё с updated_at >= horizon
+                last_ts, last_id = min((last[9], last[0]), (last[10], 0))
+                last_key = _encode_cursor({"ts": last_ts, "id": last_id})
+
+        if since is not None:
+            # Пустой ответ — курсор опроса не двигается
+            return {
+                "orders": orders,
+                "removed": removed,
+                "next_cursor": None,
+                "since": last_key or since,
+            }
+        return {
+            "orders": orders,
+            "removed": [],
+            "next_cursor": last_key if has_more else None,
+            "since": None,
+        }
 
     # ==================== РЕЙСЫ ====================
 
@@ -1094,17 +2856,22 @@ class DatabaseLayer:
         active: int = 0,
     ) -> int:
         """Создать рейс."""
+        city_ids = self.get_city_ids([from_city, to_city])
         try:
             self.session.execute(
                 text(
                     "INSERT INTO trips "
-                    "(driver_user_id, from_city, to_city, status, description, active) "
-                    "VALUES (:driver_user_id, :from_city, :to_city, 'trip_created', :description, :active)"
+                    "(driver_user_id, from_city, to_city, from_city_id, to_city_id, "
+                    "status, description, active) "
+                    "VALUES (:driver_user_id, :from_city, :to_city, :from_city_id, :to_city_id, "
+                    "'trip_created', :description, :active)"
                 ),
                 {
                     "driver_user_id": driver_user_id,
                     "from_city": from_city,
                     "to_city": to_city,
+                    "from_city_id": city_ids.get(from_city),
+                    "to_city_id": city_ids.get(to_city),
                     "description": description,
                     "active": active,
                 },
@@ -1140,14 +2907,17 @@ class DatabaseLayer:
         self, from_city: str, to_city: str
     ) -> List[Dict]:
         """Незавершённые рейсы по маршруту."""
+        route = self._route_city_ids(from_city, to_city)
+        if route is None:
+            return []
         rows = self.session.execute(
             text(
-                "SELECT id, status, active, from_city, to_city, driver_user_id "
+                "SELECT id, status, active, from_city, to_city, driver_user_id, order_count "
                 "FROM trips "
-                "WHERE from_city = :from_city AND to_city = :to_city "
+                "WHERE from_city_id = :from_city_id AND to_city_id = :to_city_id "
                 "  AND status != 'trip_completed'"
             ),
-            {"from_city": from_city, "to_city": to_city},
+            {"from_city_id": route[0], "to_city_id": route[1]},
         ).fetchall()
         return [
             {
@@ -1157,6 +2927,7 @@ class DatabaseLayer:
                 "from_city": row[3],
                 "to_city": row[4],
                 "driver_user_id": row[5],
+                "order_count": row[6],
             }
             for row in rows
         ]
@@ -1192,141 +2963,444 @@ class DatabaseLayer:
         ).fetchall()
         return [row[0] for row in rows]
 
+    def recount_trip_order_counts(self, chunk_size: int = 1000, conn=None) -> int:
+        """
+        Пересчитать trips.order_count по stage_orders.
+
+        Нужен после добавления колонки и как ремонт: удаление заказа
+        (ON DELETE CASCADE в stage_orders) счётчик не уменьшает. Идёт по
+        рейсам пачками по id, каждая пачка — короткая транзакция
+        (conn — все пачки на этом соединении, в транзакции вызывающего).
+
+        Returns:
+            Сколько рейсов исправлено.
+        """
+        fixed = 0
+        last_id = 0
+        while True:
+            with self._connection(conn) as tx:
+                ids = [
+                    row[0]
+                    for row in tx.execute(
+                        text("SELECT id FROM trips WHERE id > :last_id ORDER BY id LIMIT :chunk_size"),
+                        {"last_id": last_id, "chunk_size": chunk_size},
+                    ).fetchall()
+                ]
+                if not ids:
+                    break
+                fixed += tx.execute(
+                    text(
+                        "UPDATE trips SET order_count = ("
+                        "  SELECT COUNT(*) FROM stage_orders so WHERE so.trip_id = trips.id"
+                        ") "
+                        "WHERE id BETWEEN :first_id AND :last_id "
+                        "  AND order_count <> ("
+                        "  SELECT COUNT(*) FROM stage_orders so WHERE so.trip_id = trips.id"
+                        ")"
+                    ),
+                    {"first_id": ids[0], "last_id": ids[-1]},
+                ).rowcount
+                last_id = ids[-1]
+        return fixed
+
     def assign_order_to_trip(
-        self, order_id: int, trip_id: int
+        self, order_id: int, trip_id: int, max_orders: int = TRIP_MAX_ORDERS
     ) -> Tuple[bool, str]:
-        """Привязать заказ к рейсу с валидацией."""
-        session = self.session
+        """
+        Привязать заказ к рейсу с валидацией.
+
+        Место в рейсе занимается условным UPDATE trips.order_count, поэтому
+        параллельные привязки к одному рейсу не переполняют его.
+        """
         try:
-            # 1. Заказ не должен быть в активном рейсе
-            count = session.execute(
-                text(
-                    "SELECT COUNT(*) "
-                    "FROM stage_orders so "
-                    "JOIN trips t ON t.id = so.trip_id "
-                    "WHERE so.order_id = :order_id "
-                    "  AND t.status NOT IN ('trip_completed', 'trip_failed')"
-                ),
-                {"order_id": order_id},
-            ).scalar()
-            if count and count > 0:
-                return False, "Заказ уже привязан к активному рейсу"
+            with self._slot_transaction() as conn:
+                # 1. Заказ не должен быть в активном рейсе
+                if self._active_trip_of_order(conn, order_id) is not None:
+                    return False, "Заказ уже привязан к активному рейсу"
 
-            # 2. Проверка статуса рейса
-            trip_status = session.execute(
-                text("SELECT status FROM trips WHERE id = :trip_id"),
-                {"trip_id": trip_id},
-            ).scalar()
-            if not trip_status:
-                return False, f"Рейс {trip_id} не найден"
-            if trip_status not in ("trip_created", "trip_assigned"):
-                return (
-                    False,
-                    f"Нельзя привязать к рейсу в статусе '{trip_status}'",
+                # 2. Место в рейсе нужного статуса
+                taken = conn.execute(
+                    text(
+                        "UPDATE trips SET order_count = order_count + 1 "
+                        "WHERE id = :trip_id "
+                        "  AND status IN ('trip_created', 'trip_assigned') "
+                        "  AND order_count < :max_orders"
+                    ),
+                    {"trip_id": trip_id, "max_orders": max_orders},
+                ).rowcount
+                if not taken:
+                    trip_status = conn.execute(
+                        text("SELECT status FROM trips WHERE id = :trip_id"),
+                        {"trip_id": trip_id},
+                    ).scalar()
+                    if not trip_status:
+                        return False, f"Рейс {trip_id} не найден"
+                    if trip_status not in ("trip_created", "trip_assigned"):
+                        return (
+                            False,
+                            f"Нельзя привязать к рейсу в статусе '{trip_status}'",
+                        )
+                    return False, f"На рейсе уже {max_orders} заказов"
+
+                # 3. Вставка
+                conn.execute(
+                    text(
+                        "INSERT INTO stage_orders (trip_id, order_id) "
+                        "VALUES (:trip_id, :order_id)"
+                    ),
+                    {"trip_id": trip_id, "order_id": order_id},
                 )
-
-            # 3. Лимит 5 заказов на рейс
-            trip_count = session.execute(
-                text("SELECT COUNT(*) FROM stage_orders WHERE trip_id = :trip_id"),
-                {"trip_id": trip_id},
-            ).scalar()
-            if trip_count is not None and trip_count >= 5:
-                return False, "На рейсе уже 5 заказов"
-
-            # 4. Вставка
-            session.execute(
-                text(
-                    "INSERT INTO stage_orders (trip_id, order_id) "
-                    "VALUES (:trip_id, :order_id)"
-                ),
-                {"trip_id": trip_id, "order_id": order_id},
-            )
-            session.commit()
             return True, "Заказ привязан к рейсу"
-        except Exception as e:
-            session.rollback()
+        except SQLAlchemyError as e:
             raise DbLayerError(f"Ошибка привязки заказа {order_id} к рейсу {trip_id}: {e}") from e
 
     def assign_order_to_trip_smart(
-        self, order_id: int, order_from_city: str, order_to_city: str
+        self,
+        order_id: int,
+        order_from_city: str,
+        order_to_city: str,
+        max_orders: int = TRIP_MAX_ORDERS,
     ) -> Tuple[int, bool, str]:
         """
         Умная привязка заказа к рейсу:
-        - ищет существующий рейс по маршруту с <5 заказов
-        - если не находит, создаёт новый
+        - занимает место в открытом рейсе по маршруту (_allocate_trip_slot)
+        - если мест нет, создаёт новый рейс
+
+        Returns:
+            (trip_id, success, message); если заказ уже в активном рейсе —
+            id этого рейса и success=False.
         """
-        session = self.session
+        route = self._route_ids(order_from_city, order_to_city)
         try:
-            # 1. Проверка маршрута заказа
-            order_route = session.execute(
+            with self._slot_transaction() as conn:
+                # 1. Проверка маршрута заказа
+                order_route = conn.execute(
+                    text(
+                        "SELECT from_city, to_city "
+                        "FROM orders WHERE id = :order_id"
+                    ),
+                    {"order_id": order_id},
+                ).fetchone()
+                if not order_route or (
+                    normalize_city(order_route[0] or "") != normalize_city(order_from_city)
+                    or normalize_city(order_route[1] or "") != normalize_city(order_to_city)
+                ):
+                    raise DbLayerError(f"Маршрут заказа {order_id} не совпадает")
+
+                current_trip = self._active_trip_of_order(conn, order_id)
+                if current_trip is not None:
+                    return current_trip, False, "Заказ уже привязан к активному рейсу"
+
+                # 2. Место в рейсе (существующем или новом)
+                trip_id, is_new_trip = self._allocate_trip_slot(
+                    conn, order_from_city, order_to_city, route, max_orders
+                )
+
+                # 3. Привязываем заказ
+                conn.execute(
+                    text(
+                        "INSERT INTO stage_orders (trip_id, order_id) "
+                        "VALUES (:trip_id, :order_id)"
+                    ),
+                    {"trip_id": trip_id, "order_id": order_id},
+                )
+            logger.debug(
+                "Заказ %s привязан к рейсу %s", order_id, trip_id,
+                extra={"order_id": order_id, "trip_id": trip_id, "new_trip": is_new_trip},
+            )
+            if is_new_trip:
+                return trip_id, True, "Заказ привязан к новому рейсу"
+            return trip_id, True, "Заказ привязан к рейсу"
+        except DbLayerError:
+            raise
+        except Exception as e:
+            raise DbLayerError(
+                f"Ошибка умной привязки заказа {order_id}: {e}"
+            ) from e
+
+    @staticmethod
+    def _active_trip_of_order(conn, order_id: int) -> Optional[int]:
+        """Рейс (не завершённый и не проваленный), к которому уже привязан заказ."""
+        return conn.execute(
+            text(
+                "SELECT so.trip_id "
+                "FROM stage_orders so "
+                "JOIN trips t ON t.id = so.trip_id "
+                "WHERE so.order_id = :order_id "
+                "  AND t.status NOT IN ('trip_completed', 'trip_failed') "
+                "LIMIT 1"
+            ),
+            {"order_id": order_id},
+        ).scalar()
+
+    def _allocate_trip_slot(
+        self,
+        conn,
+        from_city: str,
+        to_city: str,
+        route: Dict[str, int],
+        max_orders: int = TRIP_MAX_ORDERS,
+    ) -> Tuple[int, bool]:
+        """
+        Занять место в открытом рейсе маршрута внутри транзакции conn
+        (_slot_transaction). Блокировка рейса держится до её COMMIT.
+
+        Место занимает условный UPDATE ... SET order_count = order_count + 1
+        WHERE order_count < max_orders, так что рейс не переполняется ни при
+        какой гонке. Кандидат ищется по порядку:
+        1. FOR UPDATE SKIP LOCKED — параллельные транзакции расходятся по
+           разным рейсам с местами и не ждут друг друга;
+        2. FOR UPDATE — все рейсы с местами заняты чужими транзакциями: ждём
+           первый из них, а не заводим полупустой рейс;
+        3. мест нет — под блокировкой строки города отправления (чтобы
+           рейсы маршрута создавались по одному) ищем ещё раз и только
+           затем создаём рейс сразу с order_count = 1.
+
+        Returns:
+            (trip_id, is_new_trip)
+        """
+        params = {**route, "max_orders": max_orders}
+
+        def find(lock: str) -> Optional[int]:
+            return conn.execute(
                 text(
-                    "SELECT from_city, to_city "
-                    "FROM orders WHERE id = :order_id"
+                    "SELECT id FROM trips "
+                    "WHERE from_city_id = :from_city_id AND to_city_id = :to_city_id "
+                    "  AND status IN ('trip_created', 'trip_assigned') "
+                    "  AND order_count < :max_orders "
+                    f"ORDER BY id LIMIT 1 {lock}"
                 ),
-                {"order_id": order_id},
-            ).fetchone()
-            if not order_route or (
-                order_route[0] != order_from_city
-                or order_route[1] != order_to_city
-            ):
-                raise DbLayerError(f"Маршрут заказа {order_id} не совпадает")
-
-            # 2. Ищем существующий рейс (<5 заказов)
-            potential_trip = session.execute(
+                params,
+            ).scalar()
+
+        def take(trip_id: int) -> bool:
+            return conn.execute(
                 text(
-                    """
-                    SELECT t.id
-                    FROM trips t
-                    LEFT JOIN (
-                        SELECT trip_id, COUNT(*) AS cnt
-                        FROM stage_orders
-                        GROUP BY trip_id
-                    ) so ON so.trip_id = t.id
-                    WHERE t.from_city = :from_city
-                      AND t.to_city = :to_city
-                      AND t.status IN ('trip_created', 'trip_assigned')
-                      AND (so.cnt IS NULL OR so.cnt < 5)
-                    LIMIT 1
-                    """
+                    "UPDATE trips SET order_count = order_count + 1 "
+                    "WHERE id = :trip_id AND order_count < :max_orders"
                 ),
-                {"from_city": order_from_city, "to_city": order_to_city},
-            ).fetchone()
+                {"trip_id": trip_id, "max_orders": max_orders},
+            ).rowcount == 1
+
+        route_locked = False
+        while True:
+            locks = ("FOR UPDATE",) if route_locked else ("FOR UPDATE SKIP LOCKED", "FOR UPDATE")
+            trip_id = None
+            for lock in locks:
+                trip_id = find(lock)
+                if trip_id is not None:
+                    break
+            if trip_id is not None:
+                if take(trip_id):
+                    return trip_id, False
+                # Рейс заполнился, пока ждали блокировку — ищем заново
+                continue
+            if route_locked:
+                break
+            conn.execute(
+                text("SELECT id FROM cities WHERE id = :from_city_id FOR UPDATE"),
+                route,
+            )
+            route_locked = True
 
-            if potential_trip:
-                trip_id = potential_trip[0]
-                print(f"[DEBUG smart] Используем существующий рейс: {trip_id}")
-            else:
-                # 3. Создаём новый рейс без водителя
-                trip_id = self.create_trip(
-                    order_from_city, order_to_city, driver_user_id=None, active=0
+        trip_id = conn.execute(
+            text(
+                "INSERT INTO trips "
+                "(driver_user_id, from_city, to_city, from_city_id, to_city_id, "
+                "status, description, active, order_count) "
+                "VALUES (NULL, :from_city, :to_city, :from_city_id, :to_city_id, "
+                "'trip_created', NULL, 0, 1)"
+            ),
+            {"from_city": from_city, "to_city": to_city, **route},
+        ).lastrowid
+        return trip_id, True
+
+    def _pack_orders_into_trips(
+        self,
+        conn,
+        orders: List[Dict],
+        max_orders: int = TRIP_MAX_ORDERS,
+    ) -> Tuple[Dict[int, int], List[int]]:
+        """
+        Разложить новые заказы по рейсам за один проход (внутри conn).
+
+        orders — [{"id", "from_city", "to_city", "from_city_id", "to_city_id"}].
+        По каждому маршруту: открытые рейсы с местами берутся FOR UPDATE
+        SKIP LOCKED (занятые другими транзакциями пропускаются) и
+        добиваются одним UPDATE order_count на рейс; остаток — новыми
+        рейсами по max_orders заказов одним многострочным INSERT. Затем
+        один INSERT в stage_orders на все заказы.
+
+        Returns:
+            ({order_id: trip_id}, [id новых рейсов])
+        """
+        routes: Dict[Tuple[int, int], List[Dict]] = {}
+        for order in orders:
+            routes.setdefault((order["from_city_id"], order["to_city_id"]), []).append(order)
+
+        links: List[Dict] = []
+        new_trip_ids: List[int] = []
+        # Маршруты по порядку id — одинаковый порядок блокировок у всех импортов
+        for (from_city_id, to_city_id), route_orders in sorted(routes.items()):
+            pending = [order["id"] for order in route_orders]
+            open_trips = conn.execute(
+                text(
+                    "SELECT id, order_count FROM trips "
+                    "WHERE from_city_id = :from_city_id AND to_city_id = :to_city_id "
+                    "  AND status IN ('trip_created', 'trip_assigned') "
+                    "  AND order_count < :max_orders "
+                    "ORDER BY id LIMIT :need FOR UPDATE SKIP LOCKED"
+                ),
+                {
+                    "from_city_id": from_city_id,
+                    "to_city_id": to_city_id,
+                    "max_orders": max_orders,
+                    "need": len(pending),
+                },
+            ).fetchall()
+            for trip_id, order_count in open_trips:
+                take = min(max_orders - order_count, len(pending))
+                if take <= 0:
+                    break
+                conn.execute(
+                    text(
+                        "UPDATE trips SET order_count = order_count + :take "
+                        "WHERE id = :trip_id"
+                    ),
+                    {"take": take, "trip_id": trip_id},
                 )
-                print(f"[DEBUG smart] Создан новый рейс: {trip_id}")
-
-            # 4. Привязываем заказ
-            success, msg = self.assign_order_to_trip(order_id, trip_id)
-            if (not success) and ("5 заказов" in msg):
-                print("[DEBUG smart] Рейс полон, создаём новый рейс")
-                trip_id = self.create_trip(
-                    order_from_city, order_to_city, driver_user_id=None, active=0
+                links.extend({"trip_id": trip_id, "order_id": oid} for oid in pending[:take])
+                pending = pending[take:]
+
+            if pending:
+                groups = [pending[i:i + max_orders] for i in range(0, len(pending), max_orders)]
+                first = route_orders[0]
+                trip_ids = self._insert_values(
+                    conn,
+                    "trips",
+                    ("from_city", "to_city", "from_city_id", "to_city_id",
+                     "status", "active", "order_count"),
+                    [
+                        {
+                            "from_city": first["from_city"],
+                            "to_city": first["to_city"],
+                            "from_city_id": from_city_id,
+                            "to_city_id": to_city_id,
+                            "status": "trip_created",
+                            "active": 0,
+                            "order_count": len(group),
+                        }
+                        for group in groups
+                    ],
                 )
-                success, msg = self.assign_order_to_trip(order_id, trip_id)
+                for trip_id, group in zip(trip_ids, groups):
+                    links.extend({"trip_id": trip_id, "order_id": oid} for oid in group)
+                new_trip_ids.extend(trip_ids)
 
-            return trip_id, success, msg
-        except Exception as e:
-            session.rollback()
-            raise DbLayerError(
-                f"Ошибка умной привязки заказа {order_id}: {e}"
-            ) from e
+        self._insert_values(conn, "stage_orders", ("trip_id", "order_id"), links)
+        return {link["order_id"]: link["trip_id"] for link in links}, new_trip_ids
 
-    
-    def update_trip_active_flags(self, max_orders: int = 5, wait_hours: float = 24.0) -> int:
+    def create_order_and_assign(
+        self,
+        description: str,
+        source_cell_id: int,
+        dest_cell_id: int,
+        pickup_type: str = "courier",
+        delivery_type: str = "courier",
+        auto_assign_trip: bool = True,
+        max_orders: int = TRIP_MAX_ORDERS,
+    ) -> Dict:
+        """
+        Создание заказа по ячейкам и привязка к рейсу одной транзакцией.
+
+        То же, что create-smart делал цепочкой get_locker_city_by_cell ×2 +
+        create_order + assign_order_to_trip_smart, но без повторных чтений:
+        города берутся из кэша, id — из cursor.lastrowid, место в рейсе
+        занимает _allocate_trip_slot (SKIP LOCKED + условный инкремент
+        trips.order_count). При прогретом кэше — INSERT заказа, SELECT и
+        UPDATE рейса, INSERT в stage_orders и COMMIT.
+
+        Returns:
+            {"order_id", "trip_id", "is_new_trip", "from_city", "to_city", "message"}
+        """
+        cities = self.get_cities_for_cells([source_cell_id, dest_cell_id])
+        for cell_id in (source_cell_id, dest_cell_id):
+            if not cities.get(cell_id):
+                raise DbLayerError(f"Ячейка {cell_id} не найдена или у постамата нет адреса")
+        from_city = cities[source_cell_id]
+        to_city = cities[dest_cell_id]
+        route = self._route_ids(from_city, to_city)
+
+        try:
+            with self._slot_transaction() as conn:
+                order_id = conn.execute(
+                    text(
+                        "INSERT INTO orders "
+                        "(description, from_city, to_city, from_city_id, to_city_id, "
+                        "source_cell_id, dest_cell_id, pickup_type, delivery_type, status) "
+                        "VALUES (:desc, :from_city, :to_city, :from_city_id, :to_city_id, "
+                        ":source_cell_id, :dest_cell_id, :pickup_type, :delivery_type, 'order_created')"
+                    ),
+                    {
+                        "desc": description,
+                        "from_city": from_city,
+                        "to_city": to_city,
+                        **route,
+                        "source_cell_id": source_cell_id,
+                        "dest_cell_id": dest_cell_id,
+                        "pickup_type": pickup_type,
+                        "delivery_type": delivery_type,
+                    },
+                ).lastrowid
+
+                trip_id = None
+                is_new_trip = False
+                message = "Order created without trip assignment"
+                if auto_assign_trip:
+                    trip_id, is_new_trip = self._allocate_trip_slot(
+                        conn, from_city, to_city, route, max_orders
+                    )
+                    conn.execute(
+                        text(
+                            "INSERT INTO stage_orders (trip_id, order_id) "
+                            "VALUES (:trip_id, :order_id)"
+                        ),
+                        {"trip_id": trip_id, "order_id": order_id},
+                    )
+                    message = "Заказ привязан к новому рейсу" if is_new_trip else "Заказ привязан к рейсу"
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Заказ '{description}': {e}") from e
+
+        return {
+            "order_id": order_id,
+            "trip_id": trip_id,
+            "is_new_trip": is_new_trip,
+            "from_city": from_city,
+            "to_city": to_city,
+            "message": message,
+        }
+
+    def update_trip_active_flags(
+        self, max_orders: int = 5, wait_hours: float = 24.0, chunk_size: int = 1000
+    ) -> List[int]:
         """
         Активация рейсов с учётом ТОЛЬКО активных заказов.
         
         Исключает заказы в статусах: cancelled, completed, failed.
+        Отбор делает сама БД (GROUP BY ... HAVING); активных заказов не
+        больше trips.order_count, поэтому рейсы, которым не хватает мест
+        и которые ещё не заждались, отсекаются до JOIN. Затем рейсы включаются
+        одним UPDATE ... WHERE id IN (...) на каждые chunk_size id.
+
+        Кандидаты каждой пачки перечитываются с FOR UPDATE: рейс, который
+        уже включил параллельный вызов (планировщик, /api/timeouts/process,
+        другая реплика), отсеивается и не попадает в результат дважды.
+
+        Returns:
+            Список id рейсов, активированных этим вызовом.
         """
         if max_orders <= 0 and wait_hours <= 0:
-            return 0
+            return []
 
         session = self.session
         threshold = datetime.now() - timedelta(hours=wait_hours)
@@ -1335,83 +3409,211 @@ class DatabaseLayer:
         rows = session.execute(
             text(
                 """
-                SELECT t.id, t.created_at, COUNT(o.id) AS order_count
+                SELECT t.id
                 FROM trips t
                 LEFT JOIN stage_orders so ON so.trip_id = t.id
                 LEFT JOIN orders o ON o.id = so.order_id 
                     AND o.status NOT IN ('order_cancelled', 'order_completed', 'order_failed')
                 WHERE t.status = 'trip_created' AND t.active = 0
+                  AND ((:max_orders > 0 AND t.order_count >= :max_orders)
+                    OR (:wait_hours > 0 AND t.created_at < :threshold))
                 GROUP BY t.id, t.created_at
+                HAVING (:max_orders > 0 AND COUNT(o.id) >= :max_orders)
+                    OR (:wait_hours > 0 AND t.created_at < :threshold)
+                ORDER BY t.id
                 """
-            )
+            ),
+            {"max_orders": max_orders, "wait_hours": wait_hours, "threshold": threshold},
         ).fetchall()
+        trip_ids = [row[0] for row in rows]
+        if not trip_ids:
+            return []
+
+        activated: List[int] = []
+        for start in range(0, len(trip_ids), chunk_size):
+            chunk = trip_ids[start:start + chunk_size]
+            params = {f"id{i}": trip_id for i, trip_id in enumerate(chunk)}
+            placeholders = ", ".join(f":{name}" for name in params)
+            locked = [
+                row[0]
+                for row in session.execute(
+                    text(
+                        f"SELECT id FROM trips "
+                        f"WHERE id IN ({placeholders}) AND active = 0 AND status = 'trip_created' "
+                        f"ORDER BY id FOR UPDATE"
+                    ),
+                    params,
+                ).fetchall()
+            ]
+            if not locked:
+                continue
+            params = {f"id{i}": trip_id for i, trip_id in enumerate(locked)}
+            placeholders = ", ".join(f":{name}" for name in params)
+            session.execute(
+                text(f"UPDATE trips SET active = 1 WHERE id IN ({placeholders})"),
+                params,
+            )
+            activated.extend(locked)
+        session.commit()
+        logger.debug("Активировано %d рейсов", len(activated), extra={"trip_ids": activated})
 
-        updated = 0
-        for trip_id, created_at, order_count in rows:
-            make_active = False
-
-            if max_orders > 0 and order_count >= max_orders:
-                make_active = True
-                print(f"[DEBUG active] Рейс {trip_id}: {order_count} активных заказов → активируем")
-            elif wait_hours > 0 and created_at and created_at < threshold:
-                make_active = True
-                print(f"[DEBUG active] Рейс {trip_id}: ожидание более {wait_hours} ч.")
-
-            if make_active:
-                session.execute(
-                    text("UPDATE trips SET active = 1 WHERE id = :trip_id"),
-                    {"trip_id": trip_id},
-                )
-                updated += 1
-
-        if updated > 0:
-            session.commit()
-            print(f"[DEBUG active] Активировано {updated} рейсов")
-
-        return updated
+        return activated
 
     # ==================== АВТОМАТИЧЕСКАЯ ОБРАБОТКА ТАЙМАУТОВ ====================
 
-    def check_and_process_reservation_timeouts(self, timeout_seconds: int = 30) -> int:
+    def check_and_process_reservation_timeouts(
+        self, timeout_seconds: int = 30, chunk_size: int = 500
+    ) -> Dict[str, List[int]]:
         """
-        Находит просроченные резервы и автоматически вызывает order_timeout_reservation.
-        
+        Переводит просроченные резервы по order_timeout_reservation пачками.
+
+        Каждая пачка (до chunk_size заказов) — одна транзакция:
+        SELECT ... FOR UPDATE по условию created_at < NOW() - INTERVAL
+        (может идти по индексу), один UPDATE на всю пачку и один
+        многострочный INSERT в fsm_action_logs.
+
         Returns:
-            Количество обработанных заказов
+            {"processed": [order_id, ...], "failed": [order_id, ...]}
         """
-        # Находим просроченные заказы
-        expired_orders = self.session.execute(text("""
-            SELECT id FROM orders
-            WHERE status IN ('order_courier_reserved_post1_and_post2', 'order_client_reserved_post1_and_post2')
-              AND TIMESTAMPDIFF(SECOND, created_at, NOW()) > :timeout
-        """), {"timeout": timeout_seconds}).fetchall()
-
-        processed = 0
-        for (oid,) in expired_orders:
+        action_name = "order_timeout_reservation"
+        fsm = self.get_fsm_table()
+        targets = {
+            status: fsm.next_state(status, action_name)
+            for status in RESERVATION_STATUSES
+        }
+        status_params = {f"status{i}": s for i, s in enumerate(RESERVATION_STATUSES)}
+        status_placeholders = ", ".join(f":{name}" for name in status_params)
+
+        processed: List[int] = []
+        failed: List[int] = []
+        last_id = 0
+        while True:
+            rows: List = []
+            chunk_ids: List[int] = []
             try:
-                # Автоматически вызываем таймаут
-                self.call_fsm_action("order", oid, "order_timeout_reservation", 0)  # system user_id=0
-                processed += 1
-            except Exception as e:
-                print(f"Ошибка обработки таймаута заказа {oid}: {e}")
+                with self.engine.begin() as conn:
+                    rows = conn.execute(
+                        text(
+                            "SELECT id, status FROM orders "
+                            f"WHERE status IN ({status_placeholders}) "
+                            "  AND created_at < NOW() - INTERVAL :timeout SECOND "
+                            "  AND id > :last_id "
+                            "ORDER BY id LIMIT :chunk_size "
+                            "FOR UPDATE"
+                        ),
+                        {
+                            **status_params,
+                            "timeout": timeout_seconds,
+                            "last_id": last_id,
+                            "chunk_size": chunk_size,
+                        },
+                    ).fetchall()
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+
+                    movable = [(oid, status) for oid, status in rows if targets.get(status)]
+                    failed.extend(oid for oid, status in rows if not targets.get(status))
+                    if movable:
+                        chunk_ids = [oid for oid, _ in movable]
+                        self._bulk_transition(
+                            conn, "order", action_name, movable, targets, user_id=0
+                        )
+            except SQLAlchemyError as e:
+                logger.error(
+                    "Ошибка обработки таймаутов заказов: %s", e, extra={"order_ids": chunk_ids}
+                )
+                if not rows:
+                    # Не удалось даже выбрать пачку — дальше идти некуда
+                    break
+                failed.extend(chunk_ids)
+                chunk_ids = []
+            processed.extend(chunk_ids)
+            if chunk_ids:
+                self._notify_transitions([
+                    {
+                        "entity_type": "order",
+                        "entity_id": oid,
+                        "action_name": action_name,
+                        "from_state": status,
+                        "to_state": targets[status],
+                        "user_id": 0,
+                    }
+                    for oid, status in movable
+                ])
+            if len(rows) < chunk_size:
+                break
+
+        return {"processed": processed, "failed": failed}
+
+    def _bulk_transition(
+        self,
+        conn,
+        entity_type: str,
+        action_name: str,
+        entities: List[Tuple[int, str]],
+        targets: Dict[str, Optional[str]],
+        user_id: int,
+    ) -> None:
+        """
+        Один и тот же FSM-переход для многих уже заблокированных сущностей.
 
-        return processed
+        entities — [(id, текущий статус)], targets — {статус: новый статус}.
+        Один UPDATE ... CASE status и один многострочный INSERT в лог.
+        """
+        table_name = FSM_ENTITY_TABLES[entity_type]
+        params: Dict[str, object] = {
+            "entity_type": entity_type,
+            "action_name": action_name,
+            "user_id": user_id,
+        }
+        cases = []
+        for i, status in enumerate(sorted({status for _, status in entities})):
+            params[f"from{i}"] = status
+            params[f"to{i}"] = targets[status]
+            cases.append(f"WHEN :from{i} THEN :to{i}")
+        from_list = ", ".join(f":from{i}" for i in range(len(cases)))
+        id_list = ", ".join(f":id{i}" for i in range(len(entities)))
+        params.update({f"id{i}": entity_id for i, (entity_id, _) in enumerate(entities)})
+
+        conn.execute(
+            text(
+                f"UPDATE {table_name} SET status = CASE status {' '.join(cases)} END "
+                f"WHERE id IN ({id_list}) AND status IN ({from_list})"
+            ),
+            params,
+        )
+
+        values = []
+        log_params: Dict[str, object] = {
+            "entity_type": entity_type,
+            "action_name": action_name,
+            "user_id": user_id,
+        }
+        for i, (entity_id, status) in enumerate(entities):
+            values.append(
+                f"(:entity_type, :eid{i}, :action_name, :fs{i}, :ts{i}, :user_id, NOW())"
+            )
+            log_params.update(
+                {f"eid{i}": entity_id, f"fs{i}": status, f"ts{i}": targets[status]}
+            )
+        conn.execute(
+            text(
+                "INSERT INTO fsm_action_logs "
+                "(entity_type, entity_id, action_name, from_state, to_state, user_id, created_at) "
+                f"VALUES {', '.join(values)}"
+            ),
+            log_params,
+        )
 
     # ==================== СЕРВИСНЫЕ ПРОЦЕДУРЫ ====================
 
     def clear_test_data(self) -> bool:
         """Вызвать хранимую процедуру clear_test_data()."""
         try:
-            conn = mysql.connector.connect(**self._raw_config)
-            cursor = conn.cursor()
-            cursor.callproc("clear_test_data")
-            for result in cursor.stored_results():
-                _ = result.fetchall()
-            conn.commit()
-            cursor.close()
-            conn.close()
+            self._call_procedure("clear_test_data")
             return True
-        except Error as e:
+        except (Error, SQLAlchemyError) as e:
             raise DbLayerError(f"clear_test_data: {e}") from e
 
     def get_log_counters(self) -> Tuple[int, int, int]:
@@ -1428,10 +3630,84 @@ class DatabaseLayer:
             ).scalar()
             return int(error_count or 0), int(fsm_count or 0), int(hw_count or 0)
         except Exception as e:
-            print(f"⚠ Счётчики логов: {e}")
+            logger.warning("Счётчики логов: %s", e)
             return 0, 0, 0
 
     def close(self) -> None:
-        """Закрыть сессию SQLAlchemy."""
-        if self.session:
-            self.session.close()
+        """Закрыть сессию SQLAlchemy и соединения пула."""
+        self._thread_session.remove()
+        self.engine.dispose()
+
+
+class AsyncDatabaseLayer:
+    """
+    Асинхронная обёртка над DatabaseLayer для FastAPI.
+
+    Любой метод DatabaseLayer доступен как корутина: вызов уходит в
+    отдельный пул потоков, event loop в это время обслуживает другие
+    запросы. По умолчанию потоков столько же, сколько соединений может
+    выдать пул engine (pool_size + max_overflow) — больше всё равно
+    ждали бы соединение.
+
+    Использование:
+    adb = AsyncDatabaseLayer(DatabaseLayer(port=3307))
+    order = await adb.get_order(1)
+    """
+
+    def __init__(self, db: DatabaseLayer, max_workers: Optional[int] = None):
+        self.db = db
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or db.pool_capacity,
+            thread_name_prefix="db",
+        )
+
+    async def run(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        """Выполнить блокирующую функцию в пуле потоков (с текущими contextvars)."""
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self._executor, lambda: ctx.run(self._call, func, *args, **kwargs)
+        )
+
+    def _call(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # Вызов вне session_scope — отдельная единица работы: не держим
+            # открытую транзакцию (и снапшот REPEATABLE READ) в потоке
+            self.db.release_session()
+
+    @asynccontextmanager
+    async def session_scope(self):
+        """
+        Async-версия DatabaseLayer.session_scope() — сессия на HTTP-запрос.
+
+        Сессия привязывается к contextvars текущей задачи, а run() переносит
+        их в поток, поэтому все await-вызовы внутри блока идут через неё.
+        """
+        session = self.db._session_factory()
+        token = self.db._scoped.set(session)
+        try:
+            yield session
+        except Exception:
+            await self.run(session.rollback)
+            raise
+        finally:
+            await self.run(session.close)
+            self.db._scoped.reset(token)
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args: Any, **kwargs: Any) -> Any:
+            return await self.run(attr, *args, **kwargs)
+
+        method.__name__ = name
+        return method
+
+    def close(self) -> None:
+        """Дождаться запущенных вызовов и закрыть DatabaseLayer."""
+        self._executor.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,209 @@
+"""
+Push-лента бирж курьеров (Server-Sent Events).
+
+Вместо опроса /api/courier/exchange-pickup и /exchange-delivery клиент
+держит одно соединение GET /api/courier/exchange/stream и получает
+событие, когда заказ попадает на биржу или уходит с неё.
+
+События берутся из FSM-переходов этого процесса
+(DatabaseLayer.add_transition_listener): слушатель вызывается в потоке БД,
+отбирает переходы в/из статусов бирж и через call_soon_threadsafe
+передаёт их в event loop. Там диспетчер дочитывает маршрут и способ
+передачи заказа, отбрасывает заказы без передачи курьером (их нет и в
+листинге биржи) и раскладывает событие по очередям подписчиков с фильтром
+по бирже и городу.
+
+Формат события:
+event: enter | leave
+data: {"exchange": "pickup", "order_id": 42, "from_city": "Msk", "to_city": "Spb",
+       "status": "...", "action_name": "...", "ts": "..."}
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from db_layer import EXCHANGES, AsyncDatabaseLayer, normalize_city
+
+logger = logging.getLogger(__name__)
+
+# Статус биржи -> её имя
+EXCHANGE_BY_STATUS = {spec["status"]: name for name, spec in EXCHANGES.items()}
+
+# Сигнал подписчику: событий потеряно, перечитать биржу и переподключиться
+RESET = {"event": "reset"}
+
+
+class Subscriber:
+    """
+    Очередь событий одного клиента и его фильтр.
+
+    Город сравнивается как в листинге бирж: по cities.id, а для заказа
+    без id города — по нормализованному имени ("Msk" = "Москва").
+    """
+
+    def __init__(
+        self,
+        exchange: Optional[str],
+        city: Optional[str],
+        max_queue: int,
+        city_id: Optional[int] = None,
+    ):
+        self.exchange = exchange
+        self.city = normalize_city(city) if city else None
+        self.city_id = city_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.overflowed = False
+
+    def wants(self, event: Dict, route: Dict) -> bool:
+        if self.exchange and event["exchange"] != self.exchange:
+            return False
+        if self.city:
+            spec = EXCHANGES[event["exchange"]]
+            order_city_id = route.get(spec["city_id_column"])
+            if self.city_id is not None and order_city_id is not None:
+                return order_city_id == self.city_id
+            return normalize_city(route.get(spec["city_column"]) or "") == self.city
+        return True
+
+
+class ExchangeFeed:
+    """
+    Раздача событий бирж подписчикам внутри процесса.
+
+    Использование (см. main.lifespan):
+    feed = ExchangeFeed(adb)
+    feed.start()
+    ...
+    async for chunk in feed.sse(exchange="pickup", city="Msk"):
+        ...
+    await feed.stop()
+    """
+
+    def __init__(self, adb: AsyncDatabaseLayer, max_queue: int = 1000, heartbeat: float = 15.0):
+        self.adb = adb
+        self.max_queue = max_queue
+        self.heartbeat = heartbeat
+        self.subscribers: Set[Subscriber] = set()
+        self.events_sent = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._incoming: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._incoming = asyncio.Queue()
+        self._task = asyncio.create_task(self._dispatch(), name="exchange_feed")
+        self.adb.db.add_transition_listener(self._on_transitions)
+
+    async def stop(self) -> None:
+        self.adb.db.remove_transition_listener(self._on_transitions)
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {"subscribers": len(self.subscribers), "events_sent": self.events_sent}
+
+    # ---------- поток БД ----------
+
+    def _on_transitions(self, transitions: List[Dict]) -> None:
+        """Слушатель DatabaseLayer: вызывается в потоке, выполнившем переход."""
+        events = []
+        for t in transitions:
+            if t["entity_type"] != "order":
+                continue
+            left = EXCHANGE_BY_STATUS.get(t["from_state"])
+            entered = EXCHANGE_BY_STATUS.get(t["to_state"])
+            if left == entered:
+                continue
+            if left:
+                events.append(("leave", left, t))
+            if entered:
+                events.append(("enter", entered, t))
+        if events and self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._incoming.put_nowait, events)
+
+    # ---------- event loop ----------
+
+    async def _dispatch(self) -> None:
+        while True:
+            events = await self._incoming.get()
+            if not self.subscribers:
+                continue
+            order_ids = sorted({t["entity_id"] for _, _, t in events})
+            try:
+                routes = await self.adb.get_order_routes(order_ids)
+            except Exception as e:
+                # Без типа и города заказа фильтр не проверить — подписчики
+                # перечитывают биржу сами
+                logger.warning(
+                    "Лента бирж: не удалось прочитать маршруты: %s", e, extra={"order_ids": order_ids}
+                )
+                self._reset_all()
+                continue
+            now = datetime.now().isoformat()
+            for kind, exchange, t in events:
+                route = routes.get(t["entity_id"])
+                # На бирже только заказы с передачей курьером (как в листинге)
+                if route is None or route[EXCHANGES[exchange]["type_column"]] != "courier":
+                    continue
+                self._publish({
+                    "event": kind,
+                    "exchange": exchange,
+                    "order_id": t["entity_id"],
+                    "from_city": route["from_city"],
+                    "to_city": route["to_city"],
+                    "status": t["to_state"],
+                    "action_name": t["action_name"],
+                    "ts": now,
+                }, route)
+
+    def _publish(self, event: Dict, route: Dict) -> None:
+        for sub in list(self.subscribers):
+            if sub.overflowed or not sub.wants(event, route):
+                continue
+            try:
+                sub.queue.put_nowait(event)
+                self.events_sent += 1
+            except asyncio.QueueFull:
+                # Клиент не успевает читать — закрываем ему поток, пусть
+                # перечитает биржу страницей и переподключится
+                sub.overflowed = True
+
+    def _reset_all(self) -> None:
+        for sub in list(self.subscribers):
+            if sub.overflowed:
+                continue
+            sub.overflowed = True
+            try:
+                sub.queue.put_nowait(RESET)
+            except asyncio.QueueFull:
+                pass
+
+    async def sse(self, exchange: Optional[str] = None, city: Optional[str] = None) -> AsyncIterator[str]:
+        """Поток text/event-stream для одного клиента."""
+        city_id = await self.adb.get_city_id(city, create=False) if city else None
+        sub = Subscriber(exchange, city, self.max_queue, city_id)
+        self.subscribers.add(sub)
+        try:
+            yield "event: ready\ndata: {}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is RESET:
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+                data = {k: v for k, v in event.items() if k != "event"}
+                yield f"event: {event['event']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                if sub.overflowed and sub.queue.empty():
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+        finally:
+            self.subscribers.discard(sub)
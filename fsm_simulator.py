@@ -0,0 +1,2010 @@
+"""
+FSM-симулятор: DatabaseLayer без MySQL.
+
+Граф переходов, button_states и справочники (пользователи, модели
+постаматов, постаматы, ячейки, тестовые заказы и рейсы) читаются из дампа
+database/*.sql, дальше все таблицы живут в словарях процесса. Переходы
+повторяют fsm_perform_action и триггеры БД:
+- статус заказа / ячейки должен быть в fsm_states;
+- вход в order_client_reserved / order_courier_reserved выставляет
+  delivery_type (set_delivery_type_before_update);
+- вход в order_courier1_assigned / order_courier2_assigned требует
+  courier1_user_id / courier2_user_id в stage_orders.
+Нарушения ключей и триггеров поднимаются как sqlalchemy DatabaseError с
+текстом ошибки MySQL, поэтому код DatabaseLayer, который их ловит,
+ведёт себя так же, как с настоящей БД.
+
+Нужен для нагрузочных прогонов и фаззинга жизненного цикла без БД:
+DB_BACKEND=memory uvicorn main:app            # API поверх симулятора
+python fsm_simulator.py simulate --orders 1000 --steps 1000000
+
+Данные не сохраняются между запусками. Методы, которым нужен настоящий
+SQL (миграции, движок procedure), в симуляторе недоступны.
+"""
+
+import argparse
+import bisect
+import contextvars
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy.exc import DatabaseError, SQLAlchemyError
+
+from db_layer import (
+    CELL_TYPE_COUNT_COLUMNS,
+    EXCHANGES,
+    EXCHANGE_POLL_LAG_SECONDS,
+    FSM_ENTITY_TABLES,
+    ORDER_HANDOFF_TYPES,
+    ORDER_LIST_COLUMNS,
+    ORDER_ROUTE_COLUMNS,
+    RESERVATION_STATUSES,
+    TRIP_ACTIONS_REQUIRE_ACTIVE,
+    TRIP_MAX_ORDERS,
+    ButtonMatrix,
+    DatabaseLayer,
+    DbLayerError,
+    FsmCallError,
+    FsmTransitionTable,
+    _LruCache,
+    _TtlCache,
+    _check_locker_codes,
+    _decode_cursor,
+    _encode_cursor,
+    _locker_codes,
+    normalize_city,
+)
+
+DATABASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database")
+
+# Значения по умолчанию колонок (как в CREATE TABLE дампа и миграциях)
+COLUMN_DEFAULTS: Dict[str, Dict[str, Any]] = {
+    "users": {"id": None, "name": None, "role_name": "client"},
+    "cities": {"id": None, "name": None},
+    "locker_models": {
+        "id": None, "model_name": None, "description": None,
+        "cell_count_s": 0, "cell_count_m": 0, "cell_count_l": 0, "cell_count_p": 0,
+        "created_at": None,
+    },
+    "lockers": {
+        "id": None, "model_id": None, "locker_code": None, "location_address": None,
+        "latitude": None, "longitude": None, "status": "locker_inactive",
+        "created_at": None, "city_id": None,
+    },
+    "locker_cells": {
+        "id": None, "locker_id": None, "cell_code": None, "cell_type": None,
+        "status": "locker_free", "reservation_expires_at": None, "code_expires_at": None,
+        "unlock_code": None, "reserved_for_user_id": None, "current_order_id": None,
+        "failed_open_attempts": 0, "created_at": None, "updated_at": None,
+    },
+    "orders": {
+        "id": None, "status": "order_created", "description": None,
+        "delivery_type": None, "pickup_type": "courier",
+        "from_city": None, "to_city": None, "from_city_id": None, "to_city_id": None,
+        "source_cell_id": None, "dest_cell_id": None,
+        "updated_at": None, "created_at": None,
+    },
+    "trips": {
+        "id": None, "driver_user_id": None, "from_city": None, "to_city": None,
+        "from_city_id": None, "to_city_id": None, "status": "trip_created",
+        "description": None, "active": 1, "order_count": 0, "created_at": None,
+    },
+    "stage_orders": {
+        "trip_id": None, "order_id": None, "courier1_user_id": None, "courier2_user_id": None,
+    },
+    "fsm_states": {"id": None, "name": None, "description": None},
+    "fsm_actions": {"id": None, "name": None, "description": None},
+    "fsm_transitions": {"id": None, "from_state_id": None, "action_id": None, "to_state_id": None},
+    "button_states": {
+        "id": None, "button_name": None, "button_label": None, "user_role": None,
+        "entity_state": None, "is_enabled": "inactive",
+    },
+}
+
+# DEFAULT CURRENT_TIMESTAMP (updated_at — ещё и ON UPDATE)
+TIMESTAMP_COLUMNS = {
+    "locker_models": ("created_at",),
+    "lockers": ("created_at",),
+    "locker_cells": ("created_at", "updated_at"),
+    "orders": ("created_at", "updated_at"),
+    "trips": ("created_at",),
+}
+
+# Внешние ключи: таблица -> [(колонка, таблица-родитель)]
+FOREIGN_KEYS = {
+    "lockers": (("model_id", "locker_models"),),
+    "locker_cells": (("locker_id", "lockers"),),
+    "orders": (("source_cell_id", "locker_cells"), ("dest_cell_id", "locker_cells")),
+    "trips": (("driver_user_id", "users"),),
+    "stage_orders": (
+        ("trip_id", "trips"),
+        ("order_id", "orders"),
+        ("courier1_user_id", "users"),
+        ("courier2_user_id", "users"),
+    ),
+}
+
+# Уникальные ключи кроме первичного: таблица -> (имя ключа, колонки)
+UNIQUE_KEYS = {
+    "lockers": ("locker_code", ("locker_code",)),
+    "locker_cells": ("locker_id", ("locker_id", "cell_code")),
+    "cities": ("uq_cities_name", ("name",)),
+}
+
+# Таблицы, которые чистит процедура clear_test_data
+TEST_DATA_TABLES = ("stage_orders", "orders", "trips")
+
+# Заказы в этих статусах не считаются при активации рейса
+INACTIVE_ORDER_STATUSES = ("order_cancelled", "order_completed", "order_failed")
+
+# Рейс принимает заказы только в этих статусах
+TRIP_OPEN_STATUSES = ("trip_created", "trip_assigned")
+
+
+class SimulatedSqlError(Exception):
+    """Ошибка «сервера» симулятора (orig у DatabaseError), текст как у MySQL."""
+
+
+def _sql_error(message: str) -> DatabaseError:
+    return DatabaseError(None, None, SimulatedSqlError(message))
+
+
+_clock: List[Any] = [None, None]
+
+
+def _now() -> datetime:
+    """NOW() с точностью DATETIME (секунда); объект переиспользуется в пределах секунды."""
+    second = int(time.time())
+    if _clock[0] != second:
+        _clock[:] = [second, datetime.fromtimestamp(second)]
+    return _clock[1]
+
+
+# ==================== РАЗБОР ДАМПА ====================
+
+_CREATE_TABLE = re.compile(r"^CREATE TABLE `(\w+)` \(")
+_COLUMN_DEF = re.compile(r"^\s+`(\w+)` ")
+_INSERT = re.compile(r"^INSERT\s+(?:IGNORE\s+)?INTO `(\w+)` VALUES (.*);$")
+_SQL_TOKEN = re.compile(
+    r"\s*(?:(\()|(\))|(,)|'((?:[^'\\]|\\.|'')*)'|(NULL)|(-?\d+\.\d+|-?\d+))"
+)
+_SQL_ESCAPE = re.compile(r"\\(.)|''")
+_ESCAPED_CHARS = {"0": "\0", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+
+
+def default_dump_path() -> str:
+    """Последний по имени дамп в database/."""
+    dumps = sorted(glob.glob(os.path.join(DATABASE_DIR, "*.sql")))
+    if not dumps:
+        raise DbLayerError(f"В {DATABASE_DIR} нет дампа *.sql")
+    return dumps[-1]
+
+
+def _sql_string(raw: str) -> str:
+    return _SQL_ESCAPE.sub(
+        lambda m: "'" if m.group(1) is None else _ESCAPED_CHARS.get(m.group(1), m.group(1)),
+        raw,
+    )
+
+
+def _parse_values(values: str) -> List[tuple]:
+    """Строки из "(1,'a',NULL),(2,'b',3.5)"."""
+    rows: List[tuple] = []
+    row: List[Any] = []
+    values = values.strip()
+    pos = 0
+    while pos < len(values):
+        match = _SQL_TOKEN.match(values, pos)
+        if not match:
+            raise DbLayerError(f"Не удалось разобрать VALUES: {values[pos:pos + 40]}")
+        pos = match.end()
+        opened, closed, comma, string, null, number = match.groups()
+        if opened:
+            row = []
+        elif closed:
+            rows.append(tuple(row))
+        elif comma:
+            continue
+        elif string is not None:
+            row.append(_sql_string(string))
+        elif null:
+            row.append(None)
+        else:
+            row.append(float(number) if "." in number else int(number))
+    return rows
+
+
+def load_dump(path: str) -> Dict[str, List[Dict]]:
+    """
+    Данные mysqldump: {таблица: [{колонка: значение}]}.
+
+    Колонки берутся из CREATE TABLE того же файла, строки — из
+    INSERT [IGNORE] INTO `t` VALUES (...) (в том числе многострочных).
+    """
+    columns: Dict[str, List[str]] = {}
+    tables: Dict[str, List[Dict]] = {}
+    current: Optional[str] = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            match = _CREATE_TABLE.match(line)
+            if match:
+                current = match.group(1)
+                columns[current] = []
+                continue
+            if current is not None:
+                match = _COLUMN_DEF.match(line)
+                if match:
+                    columns[current].append(match.group(1))
+                elif line.startswith(")"):
+                    current = None
+                continue
+            match = _INSERT.match(line)
+            if match:
+                table = match.group(1)
+                if table not in columns:
+                    raise DbLayerError(f"Дамп {path}: INSERT в {table} до CREATE TABLE")
+                tables.setdefault(table, []).extend(
+                    dict(zip(columns[table], row)) for row in _parse_values(match.group(2))
+                )
+    return tables
+
+
+def _parse_datetime(value: Any) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+# ==================== ХРАНИЛИЩЕ ====================
+
+class _Journal:
+    """Журнал отката «транзакции» симулятора: обратные операции по порядку."""
+
+    def __init__(self):
+        self.undo: List[Callable[[], None]] = []
+
+    def rollback(self) -> None:
+        while self.undo:
+            self.undo.pop()()
+
+
+class _NullSession:
+    """Заглушка Session для AsyncDatabaseLayer.session_scope()."""
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class InMemoryDatabaseLayer(DatabaseLayer):
+    """
+    DatabaseLayer поверх словарей процесса.
+
+    Тот же интерфейс, что у DatabaseLayer, поэтому работает под
+    AsyncDatabaseLayer, ExchangeFeed и Scheduler. Все операции идут под
+    одной RLock; «транзакция» — журнал отката (_transaction), так что
+    ошибка посреди пачки откатывает её целиком, как в InnoDB.
+
+    action_log / error_log — последние log_limit записей fsm_action_logs /
+    fsm_errors_log; id записей растут дальше, как AUTO_INCREMENT.
+
+    Использование:
+    db = InMemoryDatabaseLayer()
+    order_id = db.create_order("Заказ", 1, 12, "Msk", "Spb")
+    db.start_order_flow(order_id)
+    """
+
+    def __init__(
+        self,
+        dump_path: Optional[str] = None,
+        seed_data: bool = True,
+        log_limit: int = 10000,
+        workers: int = 8,
+        city_cache_size: int = 10000,
+    ):
+        """
+        dump_path: дамп, из которого берутся граф, кнопки и данные
+            (по умолчанию — последний database/*.sql)
+        seed_data: загрузить и данные дампа (пользователи, постаматы,
+            ячейки, заказы, рейсы); False — только граф и кнопки
+        log_limit: сколько последних записей логов держать в памяти
+        workers: сколько потоков даст AsyncDatabaseLayer
+        """
+        self.dump_path = dump_path or default_dump_path()
+        self.pool_capacity = workers
+        self._fsm_engine = "python"
+
+        self._lock = threading.RLock()
+        self._tables: Dict[str, Dict[Any, Dict]] = {table: {} for table in COLUMN_DEFAULTS}
+        self._next_ids: Dict[str, int] = {table: 1 for table in COLUMN_DEFAULTS}
+        self._unique: Dict[str, Dict[Any, Any]] = {table: {} for table in UNIQUE_KEYS}
+        self._order_ids: List[int] = []
+        self._orders_by_status: Dict[str, set] = {}
+        self._route_trips: Dict[Tuple[int, int], List[int]] = {}
+        # (маршрут, max_orders) -> индекс в _route_trips, до которого рейсы
+        # заведомо не принимают заказы (order_count только растёт, а из
+        # trip_created / trip_assigned рейс не возвращается)
+        self._route_scan: Dict[Tuple[Tuple[int, int], int], int] = {}
+        self._trip_orders: Dict[int, List[int]] = {}
+        self._order_trips: Dict[int, List[int]] = {}
+        self._locker_cells: Dict[int, List[int]] = {}
+
+        self.action_log: deque = deque(maxlen=log_limit)
+        self.error_log: deque = deque(maxlen=log_limit)
+        self._log_ids = {"fsm_errors_log": 0, "fsm_action_logs": 0, "hardware_command_log": 0}
+        self._advisory_locks: Dict[str, threading.Lock] = {}
+
+        # Для AsyncDatabaseLayer.session_scope()
+        self._session_factory = _NullSession
+        self._scoped: contextvars.ContextVar = contextvars.ContextVar(
+            f"sim_session_{id(self)}", default=None
+        )
+        self._fsm_cache = _TtlCache(lambda: self._load_cached(FsmTransitionTable), 0)
+        self._button_cache = _TtlCache(lambda: self._load_cached(ButtonMatrix), 0)
+        self._city_cache = _LruCache(city_cache_size)
+        self._transition_listeners: List[Callable[[List[Dict]], None]] = []
+        self._procedure_listeners: List[Callable[[str, float, Optional[BaseException]], None]] = []
+        self._raw_query_listeners: List[Callable[[str, float, Optional[BaseException]], None]] = []
+
+        self._load(load_dump(self.dump_path), seed_data)
+
+    def _load(self, dump: Dict[str, List[Dict]], seed_data: bool) -> None:
+        for table in ("fsm_states", "fsm_actions", "fsm_transitions", "button_states"):
+            for row in dump.get(table, []):
+                self._insert(table, row)
+        if not seed_data:
+            return
+
+        for table in ("users", "locker_models"):
+            for row in dump.get(table, []):
+                self._insert(table, row)
+        for row in dump.get("lockers", []):
+            self._insert("lockers", {
+                **row,
+                "city_id": self._city_id_for_address(row.get("location_address")),
+            })
+        for row in dump.get("locker_cells", []):
+            self._insert("locker_cells", row)
+        for table in ("orders", "trips"):
+            for row in dump.get(table, []):
+                row = dict(row)
+                for column in ("from_city", "to_city"):
+                    row[f"{column}_id"] = self.get_city_id(row.get(column))
+                self._insert(table, row)
+        for row in dump.get("stage_orders", []):
+            self._insert("stage_orders", row)
+        for trip_id, order_ids in self._trip_orders.items():
+            self._tables["trips"][trip_id]["order_count"] = len(order_ids)
+
+        for row in dump.get("fsm_action_logs", []):
+            self.action_log.append(row)
+        for table in ("fsm_action_logs", "fsm_errors_log", "hardware_command_log"):
+            self._log_ids[table] = max((row["id"] for row in dump.get(table, [])), default=0)
+
+    # ==================== СЕССИИ / ПУЛ ====================
+
+    @property
+    def engine(self):
+        raise DbLayerError("В симуляторе нет SQL engine (DB_BACKEND=memory)")
+
+    @property
+    def session(self):
+        raise DbLayerError("В симуляторе нет SQL-сессии (DB_BACKEND=memory)")
+
+    @contextmanager
+    def session_scope(self):
+        yield _NullSession()
+
+    def release_session(self) -> None:
+        pass
+
+    def get_pool_stats(self) -> Dict:
+        return {"backend": "memory", "workers": self.pool_capacity}
+
+    @contextmanager
+    def advisory_lock(self, name: str, timeout: int = 0):
+        """GET_LOCK внутри процесса: именованная threading.Lock."""
+        with self._lock:
+            lock = self._advisory_locks.setdefault(name, threading.Lock())
+        acquired = lock.acquire(timeout=timeout) if timeout > 0 else lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+
+    def close(self) -> None:
+        pass
+
+    @contextmanager
+    def _transaction(self):
+        """Транзакция симулятора: RLock на всё время блока и журнал отката."""
+        with self._lock:
+            journal = _Journal()
+            try:
+                yield journal
+            except BaseException:
+                journal.rollback()
+                raise
+
+    @contextmanager
+    def _slot_transaction(self):
+        with self._transaction() as journal:
+            yield journal
+
+    # ==================== СТРОКИ И ИНДЕКСЫ ====================
+
+    @staticmethod
+    def _key(table: str, row: Dict) -> Any:
+        if table == "stage_orders":
+            return (row["trip_id"], row["order_id"])
+        return row["id"]
+
+    @staticmethod
+    def _unique_value(table: str, row: Dict) -> Any:
+        _, columns = UNIQUE_KEYS[table]
+        values = tuple(row[column] for column in columns)
+        if table == "cities":
+            # Сравнение в MySQL регистронезависимое
+            return values[0].lower()
+        return values
+
+    def _check_foreign_keys(self, table: str, row: Dict, columns: Optional[Iterable[str]] = None) -> None:
+        for column, parent in FOREIGN_KEYS.get(table, ()):
+            if columns is not None and column not in columns:
+                continue
+            value = row.get(column)
+            if value is not None and value not in self._tables[parent]:
+                raise _sql_error(
+                    "1452 (23000): Cannot add or update a child row: a foreign key "
+                    f"constraint fails ({table}.{column} -> {parent}.id = {value})"
+                )
+
+    def _check_unique(self, table: str, row: Dict, key: Any) -> None:
+        if key in self._tables[table]:
+            raise _sql_error(f"1062 (23000): Duplicate entry '{key}' for key '{table}.PRIMARY'")
+        if table in UNIQUE_KEYS:
+            value = self._unique_value(table, row)
+            owner = self._unique[table].get(value)
+            if owner is not None and owner != key:
+                raise _sql_error(
+                    f"1062 (23000): Duplicate entry '{value}' for key "
+                    f"'{table}.{UNIQUE_KEYS[table][0]}'"
+                )
+
+    def _insert(
+        self,
+        table: str,
+        values: Dict,
+        journal: Optional[_Journal] = None,
+        ignore: bool = False,
+    ) -> Any:
+        """
+        INSERT одной строки; возвращает её ключ (id).
+
+        ignore=True — как INSERT IGNORE: при нарушении ключа строка
+        не вставляется и возвращается None.
+        """
+        row = dict(COLUMN_DEFAULTS[table])
+        row.update({column: value for column, value in values.items() if column in row})
+        for column in TIMESTAMP_COLUMNS.get(table, ()):
+            row[column] = _parse_datetime(row[column]) or _now()
+        try:
+            self._check_foreign_keys(table, row)
+            if table != "stage_orders" and row["id"] is None:
+                row["id"] = self._next_ids[table]
+            key = self._key(table, row)
+            self._check_unique(table, row, key)
+        except DatabaseError:
+            if ignore:
+                return None
+            raise
+        if table != "stage_orders":
+            # AUTO_INCREMENT не откатывается вместе с транзакцией
+            self._next_ids[table] = max(self._next_ids[table], row["id"] + 1)
+        self._link(table, key, row)
+        if journal is not None:
+            journal.undo.append(lambda: self._unlink(table, key, row))
+        return key
+
+    def _insert_values(self, conn, table: str, columns, rows: List[Dict]) -> List[int]:
+        """Многострочный INSERT: в симуляторе conn — журнал _transaction."""
+        return [
+            self._insert(table, {column: row[column] for column in columns}, conn)
+            for row in rows
+        ]
+
+    def _link(self, table: str, key: Any, row: Dict) -> None:
+        self._tables[table][key] = row
+        if table in UNIQUE_KEYS:
+            self._unique[table][self._unique_value(table, row)] = key
+        if table == "orders":
+            if not self._order_ids or key > self._order_ids[-1]:
+                self._order_ids.append(key)
+            else:
+                bisect.insort(self._order_ids, key)
+            self._orders_by_status.setdefault(row["status"], set()).add(key)
+        elif table == "trips":
+            route = (row["from_city_id"], row["to_city_id"])
+            bisect.insort(self._route_trips.setdefault(route, []), key)
+        elif table == "stage_orders":
+            self._trip_orders.setdefault(row["trip_id"], []).append(row["order_id"])
+            self._order_trips.setdefault(row["order_id"], []).append(row["trip_id"])
+        elif table == "locker_cells":
+            self._locker_cells.setdefault(row["locker_id"], []).append(key)
+
+    def _unlink(self, table: str, key: Any, row: Dict) -> None:
+        del self._tables[table][key]
+        if table in UNIQUE_KEYS:
+            self._unique[table].pop(self._unique_value(table, row), None)
+        if table == "orders":
+            self._order_ids.remove(key)
+            self._orders_by_status[row["status"]].discard(key)
+        elif table == "trips":
+            route = (row["from_city_id"], row["to_city_id"])
+            self._route_trips[route].remove(key)
+            for scan_key in [k for k in self._route_scan if k[0] == route]:
+                del self._route_scan[scan_key]
+        elif table == "stage_orders":
+            self._trip_orders[row["trip_id"]].remove(row["order_id"])
+            self._order_trips[row["order_id"]].remove(row["trip_id"])
+        elif table == "locker_cells":
+            self._locker_cells[row["locker_id"]].remove(key)
+
+    def _update(
+        self,
+        table: str,
+        row: Dict,
+        changes: Dict,
+        journal: Optional[_Journal] = None,
+        check: bool = True,
+    ) -> bool:
+        """UPDATE одной строки; False, если значения не изменились (rowcount = 0)."""
+        changes = {column: value for column, value in changes.items() if row[column] != value}
+        if not changes:
+            return False
+        key = self._key(table, row)
+        if check:
+            self._check_foreign_keys(table, {**row, **changes}, changes)
+            if table in UNIQUE_KEYS:
+                new_row = {**row, **changes}
+                owner = self._unique[table].get(self._unique_value(table, new_row))
+                if owner is not None and owner != key:
+                    raise _sql_error(
+                        f"1062 (23000): Duplicate entry '{self._unique_value(table, new_row)}' "
+                        f"for key '{table}.{UNIQUE_KEYS[table][0]}'"
+                    )
+        if "updated_at" in TIMESTAMP_COLUMNS.get(table, ()) and "updated_at" not in changes:
+            changes["updated_at"] = _now()
+        old = {column: row[column] for column in changes}
+
+        if table in UNIQUE_KEYS:
+            self._unique[table].pop(self._unique_value(table, row), None)
+        if table == "orders" and "status" in changes:
+            self._orders_by_status[row["status"]].discard(key)
+            self._orders_by_status.setdefault(changes["status"], set()).add(key)
+        row.update(changes)
+        if table in UNIQUE_KEYS:
+            self._unique[table][self._unique_value(table, row)] = key
+
+        if journal is not None:
+            journal.undo.append(lambda: self._update(table, row, old, check=False))
+        return True
+
+    def get_status(self, entity_type: str, entity_id: int) -> Optional[str]:
+        """Текущий статус сущности FSM (None, если её нет)."""
+        row = self._tables[FSM_ENTITY_TABLES[entity_type]].get(entity_id)
+        return row["status"] if row else None
+
+    # ==================== FSM ====================
+
+    def _load_cached(self, cls):
+        """Граф переходов и button_states — из таблиц симулятора."""
+        with self._lock:
+            if cls is FsmTransitionTable:
+                states = {row["id"]: row["name"] for row in self._tables["fsm_states"].values()}
+                actions = {row["id"]: row["name"] for row in self._tables["fsm_actions"].values()}
+                transitions = [
+                    (states[t["from_state_id"]], actions[t["action_id"]], states[t["to_state_id"]])
+                    for _, t in sorted(self._tables["fsm_transitions"].items())
+                    if t["from_state_id"] in states
+                    and t["action_id"] in actions
+                    and t["to_state_id"] in states
+                ]
+                return FsmTransitionTable(states.values(), actions.values(), transitions)
+            rows = [
+                (row["user_role"], row["entity_state"], row["button_name"], row["is_enabled"])
+                for _, row in sorted(self._tables["button_states"].items())
+            ]
+            return ButtonMatrix(rows)
+
+    def _perform_fsm_transition(
+        self, entity_type: str, entity_id: int, action_name: str, user_id: int
+    ) -> bool:
+        fsm = self.get_fsm_table()
+        try:
+            self._check_fsm_action(fsm, entity_type, action_name)
+            with self._transaction() as journal:
+                from_state, to_state = self._apply_fsm_transition(
+                    journal, fsm, entity_type, entity_id, action_name, user_id
+                )
+        except FsmCallError as e:
+            self._log_fsm_error(str(e), entity_type, entity_id, action_name, user_id)
+            raise
+        except SQLAlchemyError as e:
+            self._log_fsm_error(
+                f"SQL Exception during {action_name}",
+                entity_type, entity_id, action_name, user_id,
+            )
+            raise FsmCallError(f"FSM {action_name}: {e}") from e
+
+        self._notify_transitions([
+            {
+                "entity_type": entity_type,
+                "entity_id": entity_id,
+                "action_name": action_name,
+                "from_state": from_state,
+                "to_state": to_state,
+                "user_id": user_id,
+            }
+        ])
+        return True
+
+    def _run_fsm_batch_python(
+        self, actions: List[Dict], results: List[Dict], atomic: bool
+    ) -> Optional[int]:
+        fsm = self.get_fsm_table()
+        failed: Optional[int] = None
+        with self._lock:
+            batch = _Journal()
+            for i, item in enumerate(actions):
+                entity_type = item["entity_type"]
+                entity_id = item["entity_id"]
+                action_name = item["action_name"]
+                user_id = item["user_id"]
+                try:
+                    self._check_fsm_action(fsm, entity_type, action_name)
+                    if atomic:
+                        from_state, to_state = self._apply_fsm_transition(
+                            batch, fsm, entity_type, entity_id, action_name, user_id
+                        )
+                    else:
+                        with self._transaction() as journal:
+                            from_state, to_state = self._apply_fsm_transition(
+                                journal, fsm, entity_type, entity_id, action_name, user_id
+                            )
+                    results[i]["success"] = True
+                    results[i]["message"] = self._fsm_success_message(
+                        entity_type, entity_id, action_name, from_state, to_state
+                    )
+                except (FsmCallError, SQLAlchemyError) as e:
+                    message = (
+                        str(e)
+                        if isinstance(e, FsmCallError)
+                        else f"FSM {action_name}: {e}"
+                    )
+                    results[i]["message"] = message
+                    self._log_fsm_error(
+                        message, entity_type, entity_id, action_name, user_id
+                    )
+                    if atomic:
+                        failed = i
+                        break
+            if failed is not None:
+                batch.rollback()
+        return failed
+
+    def _apply_fsm_transition(
+        self,
+        conn,
+        fsm: FsmTransitionTable,
+        entity_type: str,
+        entity_id: int,
+        action_name: str,
+        user_id: int,
+    ) -> Tuple[str, str]:
+        """То же, что DatabaseLayer._apply_fsm_transition; conn — журнал _transaction."""
+        table_name = FSM_ENTITY_TABLES[entity_type]
+        row = self._tables[table_name].get(entity_id)
+        if not row:
+            raise FsmCallError(f"Entity not found: {entity_type} #{entity_id}")
+
+        current_status = row["status"]
+        if current_status is None:
+            raise FsmCallError(f"Entity has NULL status: {entity_type} #{entity_id}")
+
+        if (
+            entity_type == "trip"
+            and action_name in TRIP_ACTIONS_REQUIRE_ACTIVE
+            and row["active"] == 0
+        ):
+            raise FsmCallError(f"ERROR: Trip #{entity_id} not active yet")
+
+        next_status = fsm.next_state(current_status, action_name)
+        if next_status is None:
+            raise FsmCallError(
+                f"ERROR: No transition for {action_name} from state {current_status}"
+            )
+
+        changes = self._status_triggers(fsm, entity_type, row, next_status)
+        self._update(table_name, row, changes, conn)
+        self._log_action(
+            conn, entity_type, entity_id, action_name, current_status, next_status, user_id
+        )
+        return current_status, next_status
+
+    def _status_triggers(
+        self, fsm: FsmTransitionTable, entity_type: str, row: Dict, next_status: str
+    ) -> Dict:
+        """
+        Триггеры UPDATE статуса из дампа; возвращает итоговые изменения строки.
+
+        set_delivery_type_before_update, trg_order_status_check,
+        trg_locker_cell_status_check, trg_order_courier_assignment_check.
+        """
+        changes: Dict[str, Any] = {"status": next_status}
+        if entity_type == "trip":
+            return changes
+        old_status = row["status"]
+        if entity_type == "order":
+            if next_status == "order_client_reserved" and old_status != next_status:
+                changes["delivery_type"] = "self"
+            elif next_status == "order_courier_reserved" and old_status != next_status:
+                changes["delivery_type"] = "courier"
+        if next_status not in fsm.states:
+            subject = "order" if entity_type == "order" else "locker cell"
+            raise _sql_error(f"1644 (45000): Invalid {subject} status: not in fsm_states")
+        if entity_type == "order":
+            for status, column in (
+                ("order_courier1_assigned", "courier1_user_id"),
+                ("order_courier2_assigned", "courier2_user_id"),
+            ):
+                if next_status != status or old_status == status:
+                    continue
+                stages = self._tables["stage_orders"]
+                if not any(
+                    stages[(trip_id, row["id"])][column] is not None
+                    for trip_id in self._order_trips.get(row["id"], ())
+                ):
+                    raise _sql_error(
+                        f"1644 (45000): Transition to {status} requires {column} in stage_orders"
+                    )
+        return changes
+
+    def _log_action(
+        self,
+        journal: Optional[_Journal],
+        entity_type: str,
+        entity_id: int,
+        action_name: str,
+        from_state: str,
+        to_state: str,
+        user_id: int,
+    ) -> None:
+        self._log_ids["fsm_action_logs"] += 1
+        entry = {
+            "id": self._log_ids["fsm_action_logs"],
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "action_name": action_name,
+            "from_state": from_state,
+            "to_state": to_state,
+            "user_id": user_id,
+            "created_at": _now(),
+        }
+        self.action_log.append(entry)
+        if journal is not None:
+            journal.undo.append(lambda: self._drop_log_entry(self.action_log, entry))
+
+    @staticmethod
+    def _drop_log_entry(log: deque, entry: Dict) -> None:
+        try:
+            log.remove(entry)
+        except ValueError:
+            pass
+
+    def _log_fsm_error(
+        self,
+        message: str,
+        entity_type: str,
+        entity_id: int,
+        action_name: str,
+        user_id: int,
+    ) -> None:
+        with self._lock:
+            self._log_ids["fsm_errors_log"] += 1
+            self.error_log.append({
+                "id": self._log_ids["fsm_errors_log"],
+                "error_time": _now(),
+                "error_message": message,
+                "entity_type": entity_type,
+                "entity_id": entity_id,
+                "action_name": action_name,
+                "user_id": user_id,
+            })
+
+    def set_courier1_in_stage(self, order_id: int, courier_id: int):
+        self._set_stage_courier(order_id, "courier1_user_id", courier_id)
+
+    def set_courier2_in_stage(self, order_id: int, courier_id: int):
+        self._set_stage_courier(order_id, "courier2_user_id", courier_id)
+
+    def _set_stage_courier(self, order_id: int, column: str, courier_id: int) -> None:
+        with self._transaction() as journal:
+            stages = self._tables["stage_orders"]
+            for trip_id in list(self._order_trips.get(order_id, ())):
+                self._update("stage_orders", stages[(trip_id, order_id)], {column: courier_id}, journal)
+
+    # ==================== КНОПКИ ====================
+
+    def get_buttons(
+        self, user_role: str, entity_type: str, entity_id: int
+    ) -> List[Dict]:
+        if entity_type not in FSM_ENTITY_TABLES:
+            raise DbLayerError(f"Неизвестный entity_type: {entity_type}")
+        row = self._tables[FSM_ENTITY_TABLES[entity_type]].get(entity_id)
+        if not row:
+            raise DbLayerError(f"Сущность {entity_type}/{entity_id} не найдена")
+        active_flag = row["active"] if entity_type == "trip" else None
+        return self.get_button_matrix().resolve(
+            user_role, entity_type, row["status"], active_flag
+        )
+
+    def get_buttons_bulk(
+        self, user_role: str, entities: List[Tuple[str, int]]
+    ) -> Dict[Tuple[str, int], List[Dict]]:
+        for entity_type, _ in entities:
+            if entity_type not in FSM_ENTITY_TABLES:
+                raise DbLayerError(f"Неизвестный entity_type: {entity_type}")
+        matrix = self.get_button_matrix()
+        buttons: Dict[Tuple[str, int], List[Dict]] = {}
+        with self._lock:
+            for entity_type, entity_id in dict.fromkeys(entities):
+                row = self._tables[FSM_ENTITY_TABLES[entity_type]].get(entity_id)
+                if row:
+                    active_flag = row["active"] if entity_type == "trip" else None
+                    buttons[(entity_type, entity_id)] = matrix.resolve(
+                        user_role, entity_type, row["status"], active_flag
+                    )
+        return buttons
+
+    # ==================== ПОЛЬЗОВАТЕЛИ / ПОСТАМАТЫ ====================
+
+    def create_user(self, user_id: int, name: str, role: str) -> bool:
+        with self._lock:
+            self._insert("users", {"id": user_id, "name": name, "role_name": role}, ignore=True)
+        return True
+
+    def get_user_role(self, user_id: int) -> Optional[str]:
+        row = self._tables["users"].get(user_id)
+        return row["role_name"] if row else None
+
+    def create_locker_model(
+        self,
+        model_id: int,
+        model_name: str,
+        cell_count_s: int = 10,
+        cell_count_m: int = 5,
+        cell_count_l: int = 2,
+        cell_count_p: int = 1,
+    ) -> bool:
+        with self._lock:
+            self._insert(
+                "locker_models",
+                {
+                    "id": model_id,
+                    "model_name": model_name,
+                    "cell_count_s": cell_count_s,
+                    "cell_count_m": cell_count_m,
+                    "cell_count_l": cell_count_l,
+                    "cell_count_p": cell_count_p,
+                },
+                ignore=True,
+            )
+        return True
+
+    def _city_id_for_address(self, address: Optional[str]) -> Optional[int]:
+        return self.get_city_id(self._city_from_address(address)) if address else None
+
+    def create_locker(
+        self, locker_id: int, locker_code: str, location_address: str, model_id: int = 1
+    ) -> bool:
+        with self._lock:
+            self._insert(
+                "lockers",
+                {
+                    "id": locker_id,
+                    "model_id": model_id,
+                    "locker_code": locker_code,
+                    "location_address": location_address,
+                    "city_id": self._city_id_for_address(location_address),
+                },
+                ignore=True,
+            )
+        self.invalidate_city_cache()
+        return True
+
+    def create_locker_cell(
+        self, locker_id: int, cell_code: str, cell_type: str = "S"
+    ) -> Optional[int]:
+        with self._lock:
+            existing = self._unique["locker_cells"].get((locker_id, cell_code))
+            if existing is not None:
+                return existing
+            try:
+                cell_id = self._insert(
+                    "locker_cells",
+                    {"locker_id": locker_id, "cell_code": cell_code, "cell_type": cell_type},
+                )
+            except SQLAlchemyError as e:
+                raise DbLayerError(f"Ячейка {cell_code}: {e}") from e
+        self.invalidate_city_cache()
+        return cell_id
+
+    def provision_locker_cells(
+        self, locker_ids: Iterable[int], chunk_size: int = 1000
+    ) -> Dict[int, int]:
+        with self._transaction() as journal:
+            counts = self._provision_cells(journal, locker_ids, chunk_size)
+        self.invalidate_city_cache()
+        return counts
+
+    def provision_lockers(
+        self,
+        lockers: List[Dict],
+        with_cells: bool = True,
+        chunk_size: int = 1000,
+    ) -> Dict:
+        if not lockers:
+            return {"lockers": 0, "cells": 0, "cells_by_locker": {}}
+        rows = [
+            {
+                "id": locker["locker_id"],
+                "model_id": locker.get("model_id") or 1,
+                "locker_code": locker["locker_code"],
+                "location_address": locker["location_address"],
+                "city_id": self._city_id_for_address(locker["location_address"]),
+            }
+            for locker in lockers
+        ]
+        unknown = sorted({
+            row["model_id"] for row in rows if row["model_id"] not in self._tables["locker_models"]
+        })
+        if unknown:
+            raise DbLayerError(f"Неизвестные модели постаматов: {unknown}")
+        codes = _locker_codes(rows)
+        try:
+            with self._transaction() as journal:
+                _check_locker_codes(codes, {
+                    locker["locker_code"]: locker["id"]
+                    for locker in self._tables["lockers"].values()
+                    if locker["locker_code"] and locker["locker_code"].lower() in codes
+                })
+                for row in rows:
+                    existing = self._tables["lockers"].get(row["id"])
+                    if existing is None:
+                        self._insert("lockers", row, journal)
+                    else:
+                        self._update("lockers", existing, row, journal)
+                cells = (
+                    self._provision_cells(journal, [row["id"] for row in rows], chunk_size)
+                    if with_cells else {}
+                )
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Постаматы: {e}") from e
+        self.invalidate_city_cache()
+        return {
+            "lockers": len(rows),
+            "cells": sum(cells.values()),
+            "cells_by_locker": cells,
+        }
+
+    def _provision_cells(
+        self, conn, locker_ids: Iterable[int], chunk_size: int
+    ) -> Dict[int, int]:
+        locker_ids = sorted(set(locker_ids))
+        lockers = self._tables["lockers"]
+        models = self._tables["locker_models"]
+        missing = [
+            locker_id for locker_id in locker_ids
+            if locker_id not in lockers or lockers[locker_id]["model_id"] not in models
+        ]
+        if missing:
+            raise DbLayerError(f"Постаматы не найдены: {missing}")
+
+        counts = {}
+        for locker_id in locker_ids:
+            model = models[lockers[locker_id]["model_id"]]
+            codes = self.model_cell_codes(
+                {cell_type: model[column] for cell_type, column in CELL_TYPE_COUNT_COLUMNS.items()}
+            )
+            for code, cell_type in codes:
+                if (locker_id, code) not in self._unique["locker_cells"]:
+                    self._insert(
+                        "locker_cells",
+                        {"locker_id": locker_id, "cell_code": code, "cell_type": cell_type},
+                        conn,
+                    )
+            counts[locker_id] = len(codes)
+        return counts
+
+    def find_free_cell(self, locker_id: int) -> Optional[int]:
+        with self._lock:
+            cells = self._tables["locker_cells"]
+            for cell_id in self._locker_cells.get(locker_id, ()):
+                if cells[cell_id]["status"] == "locker_free":
+                    return cell_id
+        return None
+
+    def get_lockers(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    "id": row["id"],
+                    "locker_code": row["locker_code"],
+                    "location_address": row["location_address"],
+                    "status": row["status"],
+                    "latitude": row["latitude"],
+                    "longitude": row["longitude"],
+                }
+                for _, row in sorted(self._tables["lockers"].items())
+            ]
+
+    def get_locker_cells_by_status(
+        self, locker_id: int, status: str
+    ) -> List[Dict]:
+        with self._lock:
+            cells = self._tables["locker_cells"]
+            return [
+                {
+                    "id": cell["id"],
+                    "cell_code": cell["cell_code"],
+                    "cell_type": cell["cell_type"],
+                    "status": cell["status"],
+                    "current_order_id": cell["current_order_id"],
+                }
+                for cell in (cells[cell_id] for cell_id in self._locker_cells.get(locker_id, ()))
+                if cell["status"] == status
+            ]
+
+    def _cell_city_rows(self, cell_ids: Iterable[int]) -> List[Tuple[int, Optional[str], Optional[str]]]:
+        """Строки (cell_id, cities.name, location_address), как JOIN в DatabaseLayer."""
+        cells = self._tables["locker_cells"]
+        lockers = self._tables["lockers"]
+        cities = self._tables["cities"]
+        rows = []
+        for cell_id in cell_ids:
+            cell = cells.get(cell_id)
+            locker = lockers.get(cell["locker_id"]) if cell else None
+            if locker is None:
+                continue
+            city = cities.get(locker["city_id"])
+            rows.append((cell_id, city["name"] if city else None, locker["location_address"]))
+        return rows
+
+    def get_cities_for_cells(self, cell_ids: Iterable[int]) -> Dict[int, str]:
+        wanted = list(dict.fromkeys(cell_ids))
+        cities = self._city_cache.get_many(wanted)
+        missing = [cell_id for cell_id in wanted if cell_id not in cities]
+        if missing:
+            with self._lock:
+                loaded = self._cell_cities(self._cell_city_rows(missing))
+            self._city_cache.put_many(loaded)
+            cities.update(loaded)
+        return cities
+
+    def warm_city_cache(self) -> int:
+        with self._lock:
+            cell_ids = sorted(self._tables["locker_cells"])
+            loaded = self._cell_cities(
+                self._cell_city_rows(cell_ids)[:self._city_cache.maxsize]
+            )
+        self._city_cache.put_many(loaded)
+        return len(loaded)
+
+    def get_city_ids(self, names: Iterable[str], create: bool = True, conn=None) -> Dict[str, int]:
+        canonical = {name: normalize_city(name) for name in names if name}
+        canonical = {name: city for name, city in canonical.items() if city}
+        ids: Dict[str, int] = {}
+        with self._lock:
+            for city in set(canonical.values()):
+                city_id = self._unique["cities"].get(city.lower())
+                if city_id is None and create:
+                    city_id = self._insert("cities", {"name": city})
+                if city_id is not None:
+                    ids[city] = city_id
+        return {name: ids[city] for name, city in canonical.items() if city in ids}
+
+    def backfill_city_ids(self, chunk_size: int = 1000, conn=None) -> Dict[str, int]:
+        """В симуляторе city_id проставляются при вставке — заполнять нечего."""
+        counts = {"lockers": 0}
+        for table in ("orders", "trips"):
+            for column in ("from_city", "to_city"):
+                counts[f"{table}.{column}_id"] = 0
+        return counts
+
+    def clear_locker_cells(self, locker_id: int) -> bool:
+        try:
+            with self._transaction() as journal:
+                cells = self._tables["locker_cells"]
+                referenced = {
+                    cell_id
+                    for order in self._tables["orders"].values()
+                    for cell_id in (order["source_cell_id"], order["dest_cell_id"])
+                }
+                for cell_id in list(self._locker_cells.get(locker_id, ())):
+                    if cell_id in referenced:
+                        raise _sql_error(
+                            "1451 (23000): Cannot delete or update a parent row: "
+                            f"a foreign key constraint fails (orders -> locker_cells.id = {cell_id})"
+                        )
+                    row = cells[cell_id]
+                    self._unlink("locker_cells", cell_id, row)
+                    journal.undo.append(
+                        lambda cell_id=cell_id, row=row: self._link("locker_cells", cell_id, row)
+                    )
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Ячейки постамата {locker_id}: {e}") from e
+        self.invalidate_city_cache()
+        return True
+
+    def reserve_cells_for_order(
+        self,
+        order_id: int,
+        source_cell_id: int,
+        dest_cell_id: int,
+        source_code: Optional[str] = None,
+        dest_code: Optional[str] = None,
+    ) -> bool:
+        try:
+            with self._transaction() as journal:
+                cells = self._tables["locker_cells"]
+                for cell_id, code in ((source_cell_id, source_code), (dest_cell_id, dest_code)):
+                    cell = cells.get(cell_id)
+                    if cell is None:
+                        continue
+                    changes: Dict[str, Any] = {"status": "locker_reserved", "current_order_id": order_id}
+                    if code:
+                        changes["unlock_code"] = code
+                    self._update("locker_cells", cell, changes, journal)
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Резерв ячеек для заказа {order_id}: {e}") from e
+        return True
+
+    # ==================== ЗАКАЗЫ ====================
+
+    def create_order(
+        self,
+        description: str,
+        source_cell_id: Optional[int],
+        dest_cell_id: Optional[int],
+        from_city: str,
+        to_city: str,
+        pickup_type: str = "courier",
+        delivery_type: str = "courier",
+    ) -> int:
+        city_ids = self.get_city_ids([from_city, to_city])
+        try:
+            with self._transaction() as journal:
+                return self._insert(
+                    "orders",
+                    {
+                        "description": description,
+                        "from_city": from_city,
+                        "to_city": to_city,
+                        "from_city_id": city_ids.get(from_city),
+                        "to_city_id": city_ids.get(to_city),
+                        "source_cell_id": source_cell_id,
+                        "dest_cell_id": dest_cell_id,
+                        "pickup_type": pickup_type,
+                        "delivery_type": delivery_type,
+                    },
+                    journal,
+                )
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Заказ '{description}': {e}") from e
+
+    @staticmethod
+    def _order_dict(order: Dict) -> Dict:
+        return {column: order[column] for column in ORDER_LIST_COLUMNS}
+
+    def get_order(self, order_id: int) -> Optional[Dict]:
+        order = self._tables["orders"].get(order_id)
+        return self._order_dict(order) if order else None
+
+    def get_order_routes(self, order_ids: List[int]) -> Dict[int, Dict]:
+        orders = self._tables["orders"]
+        return {
+            order_id: {column: orders[order_id][column] for column in ORDER_ROUTE_COLUMNS}
+            for order_id in order_ids
+            if order_id in orders
+        }
+
+    def _select_orders(
+        self,
+        statuses: Optional[List[str]] = None,
+        from_city_id: Optional[int] = None,
+        to_city_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict]:
+        """Листинг заказов по id (как _orders_filter + _orders_query)."""
+        with self._lock:
+            if statuses:
+                ids = sorted(set().union(*(self._orders_by_status.get(s, ()) for s in statuses)))
+            else:
+                ids = self._order_ids
+            start = bisect.bisect_right(ids, after_id) if after_id is not None else 0
+            orders = self._tables["orders"]
+            selected = []
+            for order_id in ids[start:] if start else ids:
+                order = orders[order_id]
+                if from_city_id is not None and order["from_city_id"] != from_city_id:
+                    continue
+                if to_city_id is not None and order["to_city_id"] != to_city_id:
+                    continue
+                selected.append(self._order_dict(order))
+                if limit is not None and len(selected) >= limit:
+                    break
+            return selected
+
+    def get_orders_for_route(
+        self, from_city: str, to_city: str, statuses: Optional[List[str]] = None
+    ) -> List[Dict]:
+        route = self._route_city_ids(from_city, to_city)
+        if route is None:
+            return []
+        return self._select_orders(statuses, *route)
+
+    def get_all_orders(self, statuses: Optional[List[str]] = None) -> List[Dict]:
+        return self._select_orders(statuses)
+
+    def get_orders_page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        statuses: Optional[List[str]] = None,
+        from_city: Optional[str] = None,
+        to_city: Optional[str] = None,
+    ) -> Dict:
+        after_id = None
+        if cursor:
+            after_id = _decode_cursor(cursor, ["id"])["id"]
+            if not isinstance(after_id, int):
+                raise DbLayerError(f"Некорректный cursor: {cursor}")
+        route = self._route_city_ids(from_city, to_city)
+        if route is None:
+            return {"orders": [], "next_cursor": None}
+        rows = self._select_orders(statuses, *route, after_id=after_id, limit=limit + 1)
+        orders = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = _encode_cursor({"id": orders[-1]["id"]})
+        return {"orders": orders, "next_cursor": next_cursor}
+
+    def iter_orders(
+        self,
+        statuses: Optional[List[str]] = None,
+        from_city: Optional[str] = None,
+        to_city: Optional[str] = None,
+        batch_size: int = 500,
+    ) -> Iterator[Dict]:
+        route = self._route_city_ids(from_city, to_city)
+        if route is None:
+            return
+        after_id = None
+        while True:
+            rows = self._select_orders(statuses, *route, after_id=after_id, limit=batch_size)
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after_id = rows[-1]["id"]
+
+    def get_orders_for_courier(self, courier_id: int) -> List[int]:
+        with self._lock:
+            return list(dict.fromkeys(
+                stage["order_id"]
+                for stage in self._tables["stage_orders"].values()
+                if courier_id in (stage["courier1_user_id"], stage["courier2_user_id"])
+            ))
+
+    def get_exchange_orders(
+        self,
+        exchange: str,
+        city: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        since: Optional[str] = None,
+    ) -> Dict:
+        spec = EXCHANGES.get(exchange)
+        if spec is None:
+            raise DbLayerError(f"Неизвестная биржа: {exchange}")
+        prefix = spec["prefix"]
+
+        city_id = None
+        if city:
+            city_id = self.get_city_id(city, create=False)
+            if city_id is None:
+                return {"orders": [], "removed": [], "next_cursor": None, "since": since}
+
+        changes = since is not None and since != "0"
+        key_column = "updated_at" if since is not None else "created_at"
+        token = since if since is not None else cursor
+        after = None
+        if token and token != "0":
+            param = "since" if since is not None else "cursor"
+            key = _decode_cursor(token, ["ts", "id"], param)
+            try:
+                after = (_parse_datetime(key["ts"]), key["id"])
+            except (TypeError, ValueError) as e:
+                raise DbLayerError(f"Некорректный {param}: {token}") from e
+
+        with self._lock:
+            orders = self._tables["orders"]
+            cells = self._tables["locker_cells"]
+            lockers = self._tables["lockers"]
+            rows = []
+            candidates = orders if changes else self._orders_by_status.get(spec["status"], ())
+            for order_id in candidates:
+                order = orders[order_id]
+                if order[spec["type_column"]] != "courier":
+                    continue
+                if city_id is not None and order[spec["city_id_column"]] != city_id:
+                    continue
+                sort_key = (order[key_column], order_id)
+                if after is not None and sort_key <= after:
+                    continue
+                cell = cells.get(order[spec["cell_column"]])
+                locker = lockers.get(cell["locker_id"]) if cell else None
+                if locker is None and not changes:
+                    continue
+                rows.append((sort_key, order, cell, locker))
+        rows.sort(key=lambda item: item[0])
+        has_more = limit is not None and len(rows) > limit
+        if has_more:
+            rows = rows[:limit]
+
+        result = [
+            {
+                "id": order["id"],
+                "status": order["status"],
+                "description": order["description"],
+                "from_city": order["from_city"],
+                "to_city": order["to_city"],
+                f"{prefix}_address": locker["location_address"],
+                f"{prefix}_cell_code": cell["cell_code"],
+                "cell_size": cell["cell_type"],
+            }
+            for _, order, cell, locker in rows
+            if order["status"] == spec["status"] and locker is not None
+        ]
+        removed = [
+            order["id"]
+            for _, order, _, locker in rows
+            if order["status"] != spec["status"] or locker is None
+        ]
+        last_key = None
+        if rows:
+            last_ts, last_id = rows[-1][0]
+            if since is not None:
+                horizon = _now() - timedelta(seconds=EXCHANGE_POLL_LAG_SECONDS)
+                last_ts, last_id = min((last_ts, last_id), (horizon, 0))
+            last_key = _encode_cursor({"ts": last_ts, "id": last_id})
+
+        if since is not None:
+            return {
+                "orders": result,
+                "removed": removed,
+                "next_cursor": None,
+                "since": last_key or since,
+            }
+        return {
+            "orders": result,
+            "removed": [],
+            "next_cursor": last_key if has_more else None,
+            "since": None,
+        }
+
+    # ==================== РЕЙСЫ ====================
+
+    def create_trip(
+        self,
+        from_city: str,
+        to_city: str,
+        driver_user_id: Optional[int] = None,
+        description: Optional[str] = None,
+        active: int = 0,
+    ) -> int:
+        city_ids = self.get_city_ids([from_city, to_city])
+        try:
+            with self._transaction() as journal:
+                return self._insert(
+                    "trips",
+                    {
+                        "driver_user_id": driver_user_id,
+                        "from_city": from_city,
+                        "to_city": to_city,
+                        "from_city_id": city_ids.get(from_city),
+                        "to_city_id": city_ids.get(to_city),
+                        "description": description,
+                        "active": active,
+                    },
+                    journal,
+                )
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Рейс '{from_city}→{to_city}': {e}") from e
+
+    @staticmethod
+    def _trip_dict(trip: Dict) -> Dict:
+        return {
+            "id": trip["id"],
+            "status": trip["status"],
+            "active": trip["active"],
+            "from_city": trip["from_city"],
+            "to_city": trip["to_city"],
+            "driver_user_id": trip["driver_user_id"],
+        }
+
+    def get_trip(self, trip_id: int) -> Optional[Dict]:
+        trip = self._tables["trips"].get(trip_id)
+        return self._trip_dict(trip) if trip else None
+
+    def get_open_trips_for_route(self, from_city: str, to_city: str) -> List[Dict]:
+        route = self._route_city_ids(from_city, to_city)
+        if route is None:
+            return []
+        with self._lock:
+            trips = self._tables["trips"]
+            return [
+                {**self._trip_dict(trip), "order_count": trip["order_count"]}
+                for trip in (trips[trip_id] for trip_id in self._route_trips.get(route, ()))
+                if trip["status"] != "trip_completed"
+            ]
+
+    def get_active_trips_for_driver(self, driver_id: int) -> List[Dict]:
+        with self._lock:
+            return [
+                self._trip_dict(trip)
+                for _, trip in sorted(self._tables["trips"].items())
+                if trip["driver_user_id"] == driver_id
+                and trip["active"] == 1
+                and trip["status"] != "trip_completed"
+            ]
+
+    def get_trip_orders(self, trip_id: int) -> List[int]:
+        with self._lock:
+            return sorted(self._trip_orders.get(trip_id, ()))
+
+    def recount_trip_order_counts(self, chunk_size: int = 1000, conn=None) -> int:
+        fixed = 0
+        with self._lock:
+            for trip_id, trip in self._tables["trips"].items():
+                count = len(self._trip_orders.get(trip_id, ()))
+                if self._update("trips", trip, {"order_count": count}):
+                    fixed += 1
+            # Счётчики могли уменьшиться — сканы маршрутов начинаем заново
+            self._route_scan.clear()
+        return fixed
+
+    def assign_order_to_trip(
+        self, order_id: int, trip_id: int, max_orders: int = TRIP_MAX_ORDERS
+    ) -> Tuple[bool, str]:
+        try:
+            with self._slot_transaction() as journal:
+                if self._active_trip_of_order(journal, order_id) is not None:
+                    return False, "Заказ уже привязан к активному рейсу"
+
+                trip = self._tables["trips"].get(trip_id)
+                if not trip:
+                    return False, f"Рейс {trip_id} не найден"
+                if trip["status"] not in TRIP_OPEN_STATUSES:
+                    return False, f"Нельзя привязать к рейсу в статусе '{trip['status']}'"
+                if trip["order_count"] >= max_orders:
+                    return False, f"На рейсе уже {max_orders} заказов"
+
+                self._update("trips", trip, {"order_count": trip["order_count"] + 1}, journal)
+                self._insert("stage_orders", {"trip_id": trip_id, "order_id": order_id}, journal)
+            return True, "Заказ привязан к рейсу"
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Ошибка привязки заказа {order_id} к рейсу {trip_id}: {e}") from e
+
+    def assign_order_to_trip_smart(
+        self,
+        order_id: int,
+        order_from_city: str,
+        order_to_city: str,
+        max_orders: int = TRIP_MAX_ORDERS,
+    ) -> Tuple[int, bool, str]:
+        route = self._route_ids(order_from_city, order_to_city)
+        try:
+            with self._slot_transaction() as journal:
+                order = self._tables["orders"].get(order_id)
+                if not order or (
+                    normalize_city(order["from_city"] or "") != normalize_city(order_from_city)
+                    or normalize_city(order["to_city"] or "") != normalize_city(order_to_city)
+                ):
+                    raise DbLayerError(f"Маршрут заказа {order_id} не совпадает")
+
+                current_trip = self._active_trip_of_order(journal, order_id)
+                if current_trip is not None:
+                    return current_trip, False, "Заказ уже привязан к активному рейсу"
+
+                trip_id, is_new_trip = self._allocate_trip_slot(
+                    journal, order_from_city, order_to_city, route, max_orders
+                )
+                self._insert("stage_orders", {"trip_id": trip_id, "order_id": order_id}, journal)
+            if is_new_trip:
+                return trip_id, True, "Заказ привязан к новому рейсу"
+            return trip_id, True, "Заказ привязан к рейсу"
+        except DbLayerError:
+            raise
+        except Exception as e:
+            raise DbLayerError(
+                f"Ошибка умной привязки заказа {order_id}: {e}"
+            ) from e
+
+    def _active_trip_of_order(self, conn, order_id: int) -> Optional[int]:
+        trips = self._tables["trips"]
+        for trip_id in self._order_trips.get(order_id, ()):
+            if trips[trip_id]["status"] not in ("trip_completed", "trip_failed"):
+                return trip_id
+        return None
+
+    def _open_trips(self, route: Tuple[int, int], max_orders: int) -> Iterator[Dict]:
+        """Рейсы маршрута с местами по порядку id (вызывать под _lock)."""
+        trip_ids = self._route_trips.get(route, [])
+        trips = self._tables["trips"]
+        scan_key = (route, max_orders)
+        start = self._route_scan.get(scan_key, 0)
+        for index in range(start, len(trip_ids)):
+            trip = trips[trip_ids[index]]
+            if trip["status"] in TRIP_OPEN_STATUSES and trip["order_count"] < max_orders:
+                self._route_scan[scan_key] = index
+                yield trip
+                # Рейс могли заполнить, пока генератор стоял на нём
+                if trip["order_count"] < max_orders:
+                    return
+        self._route_scan[scan_key] = len(trip_ids)
+
+    def _allocate_trip_slot(
+        self,
+        conn,
+        from_city: str,
+        to_city: str,
+        route: Dict[str, int],
+        max_orders: int = TRIP_MAX_ORDERS,
+    ) -> Tuple[int, bool]:
+        """Место в первом рейсе маршрута с местами или новый рейс (под _lock)."""
+        for trip in self._open_trips((route["from_city_id"], route["to_city_id"]), max_orders):
+            self._update("trips", trip, {"order_count": trip["order_count"] + 1}, conn)
+            return trip["id"], False
+        trip_id = self._insert(
+            "trips",
+            {
+                "from_city": from_city,
+                "to_city": to_city,
+                **route,
+                "status": "trip_created",
+                "active": 0,
+                "order_count": 1,
+            },
+            conn,
+        )
+        return trip_id, True
+
+    def _pack_orders_into_trips(
+        self,
+        conn,
+        orders: List[Dict],
+        max_orders: int = TRIP_MAX_ORDERS,
+    ) -> Tuple[Dict[int, int], List[int]]:
+        routes: Dict[Tuple[int, int], List[Dict]] = {}
+        for order in orders:
+            routes.setdefault((order["from_city_id"], order["to_city_id"]), []).append(order)
+
+        links: List[Dict] = []
+        new_trip_ids: List[int] = []
+        for route, route_orders in sorted(routes.items()):
+            pending = [order["id"] for order in route_orders]
+            while pending:
+                trip = next(self._open_trips(route, max_orders), None)
+                if trip is None:
+                    break
+                take = min(max_orders - trip["order_count"], len(pending))
+                self._update("trips", trip, {"order_count": trip["order_count"] + take}, conn)
+                links.extend({"trip_id": trip["id"], "order_id": oid} for oid in pending[:take])
+                pending = pending[take:]
+
+            first = route_orders[0]
+            for start in range(0, len(pending), max_orders):
+                group = pending[start:start + max_orders]
+                trip_id = self._insert(
+                    "trips",
+                    {
+                        "from_city": first["from_city"],
+                        "to_city": first["to_city"],
+                        "from_city_id": route[0],
+                        "to_city_id": route[1],
+                        "status": "trip_created",
+                        "active": 0,
+                        "order_count": len(group),
+                    },
+                    conn,
+                )
+                links.extend({"trip_id": trip_id, "order_id": oid} for oid in group)
+                new_trip_ids.append(trip_id)
+
+        self._insert_values(conn, "stage_orders", ("trip_id", "order_id"), links)
+        return {link["order_id"]: link["trip_id"] for link in links}, new_trip_ids
+
+    def create_order_and_assign(
+        self,
+        description: str,
+        source_cell_id: int,
+        dest_cell_id: int,
+        pickup_type: str = "courier",
+        delivery_type: str = "courier",
+        auto_assign_trip: bool = True,
+        max_orders: int = TRIP_MAX_ORDERS,
+    ) -> Dict:
+        cities = self.get_cities_for_cells([source_cell_id, dest_cell_id])
+        for cell_id in (source_cell_id, dest_cell_id):
+            if not cities.get(cell_id):
+                raise DbLayerError(f"Ячейка {cell_id} не найдена или у постамата нет адреса")
+        from_city = cities[source_cell_id]
+        to_city = cities[dest_cell_id]
+        route = self._route_ids(from_city, to_city)
+
+        try:
+            with self._slot_transaction() as journal:
+                order_id = self._insert(
+                    "orders",
+                    {
+                        "description": description,
+                        "from_city": from_city,
+                        "to_city": to_city,
+                        **route,
+                        "source_cell_id": source_cell_id,
+                        "dest_cell_id": dest_cell_id,
+                        "pickup_type": pickup_type,
+                        "delivery_type": delivery_type,
+                    },
+                    journal,
+                )
+                trip_id = None
+                is_new_trip = False
+                message = "Order created without trip assignment"
+                if auto_assign_trip:
+                    trip_id, is_new_trip = self._allocate_trip_slot(
+                        journal, from_city, to_city, route, max_orders
+                    )
+                    self._insert("stage_orders", {"trip_id": trip_id, "order_id": order_id}, journal)
+                    message = "Заказ привязан к новому рейсу" if is_new_trip else "Заказ привязан к рейсу"
+        except SQLAlchemyError as e:
+            raise DbLayerError(f"Заказ '{description}': {e}") from e
+
+        return {
+            "order_id": order_id,
+            "trip_id": trip_id,
+            "is_new_trip": is_new_trip,
+            "from_city": from_city,
+            "to_city": to_city,
+            "message": message,
+        }
+
+    def update_trip_active_flags(
+        self, max_orders: int = 5, wait_hours: float = 24.0, chunk_size: int = 1000
+    ) -> List[int]:
+        if max_orders <= 0 and wait_hours <= 0:
+            return []
+        threshold = datetime.now() - timedelta(hours=wait_hours)
+        activated = []
+        with self._lock:
+            orders = self._tables["orders"]
+            for trip_id, trip in self._tables["trips"].items():
+                if trip["active"] != 0 or trip["status"] != "trip_created":
+                    continue
+                waited = wait_hours > 0 and trip["created_at"] < threshold
+                if not waited:
+                    if max_orders <= 0 or trip["order_count"] < max_orders:
+                        continue
+                    active_orders = sum(
+                        1
+                        for order_id in self._trip_orders.get(trip_id, ())
+                        if orders[order_id]["status"] not in INACTIVE_ORDER_STATUSES
+                    )
+                    if active_orders < max_orders:
+                        continue
+                self._update("trips", trip, {"active": 1})
+                activated.append(trip_id)
+        return sorted(activated)
+
+    def check_and_process_reservation_timeouts(
+        self, timeout_seconds: int = 30, chunk_size: int = 500
+    ) -> Dict[str, List[int]]:
+        action_name = "order_timeout_reservation"
+        fsm = self.get_fsm_table()
+        targets = {
+            status: fsm.next_state(status, action_name)
+            for status in RESERVATION_STATUSES
+        }
+        threshold = _now() - timedelta(seconds=timeout_seconds)
+
+        with self._lock:
+            orders = self._tables["orders"]
+            expired = sorted(
+                order_id
+                for status in RESERVATION_STATUSES
+                for order_id in self._orders_by_status.get(status, ())
+                if orders[order_id]["created_at"] < threshold
+            )
+
+        processed: List[int] = []
+        failed: List[int] = []
+        for start in range(0, len(expired), chunk_size):
+            moved: List[Dict] = []
+            try:
+                with self._transaction() as journal:
+                    for order_id in expired[start:start + chunk_size]:
+                        order = self._tables["orders"][order_id]
+                        status = order["status"]
+                        target = targets.get(status)
+                        if status not in targets:
+                            # Статус сменился после выборки — заказ уже не в резерве
+                            continue
+                        if not target:
+                            failed.append(order_id)
+                            continue
+                        changes = self._status_triggers(fsm, "order", order, target)
+                        self._update("orders", order, changes, journal)
+                        self._log_action(journal, "order", order_id, action_name, status, target, 0)
+                        moved.append({
+                            "entity_type": "order",
+                            "entity_id": order_id,
+                            "action_name": action_name,
+                            "from_state": status,
+                            "to_state": target,
+                            "user_id": 0,
+                        })
+            except SQLAlchemyError:
+                failed.extend(t["entity_id"] for t in moved)
+                continue
+            processed.extend(t["entity_id"] for t in moved)
+            self._notify_transitions(moved)
+        return {"processed": processed, "failed": failed}
+
+    # ==================== СЕРВИСНОЕ ====================
+
+    def clear_test_data(self) -> bool:
+        """Как процедура clear_test_data(): TRUNCATE заказов, рейсов и логов."""
+        with self._lock:
+            for table in TEST_DATA_TABLES:
+                self._tables[table].clear()
+                self._next_ids[table] = 1
+            self._order_ids.clear()
+            self._orders_by_status.clear()
+            self._route_trips.clear()
+            self._route_scan.clear()
+            self._trip_orders.clear()
+            self._order_trips.clear()
+            self.action_log.clear()
+            self.error_log.clear()
+            for table in self._log_ids:
+                self._log_ids[table] = 0
+        return True
+
+    def get_log_counters(self) -> Tuple[int, int, int]:
+        return (
+            self._log_ids["fsm_errors_log"],
+            self._log_ids["fsm_action_logs"],
+            self._log_ids["hardware_command_log"],
+        )
+
+
+# ==================== ПРОГОН СИМУЛЯЦИИ ====================
+
+def _error_kind(message: str) -> str:
+    """Текст ошибки без id сущностей — для группировки."""
+    return re.sub(r"#\d+", "#N", message.split("\n")[0])[:120]
+
+
+def check_invariants(db: InMemoryDatabaseLayer, max_orders: int) -> List[str]:
+    """Нарушения инвариантов хранилища (пустой список — всё в порядке)."""
+    problems = []
+    states = db.get_fsm_table().states
+    with db._lock:
+        for entity_type, table in FSM_ENTITY_TABLES.items():
+            if entity_type == "trip":
+                continue
+            for row in db._tables[table].values():
+                if row["status"] not in states:
+                    problems.append(f"{entity_type} #{row['id']}: статус {row['status']} не в fsm_states")
+        for trip_id, trip in db._tables["trips"].items():
+            linked = len(db._trip_orders.get(trip_id, ()))
+            if trip["order_count"] != linked:
+                problems.append(f"trip #{trip_id}: order_count {trip['order_count']} != {linked}")
+            if linked > max_orders and trip["order_count"] > 0:
+                problems.append(f"trip #{trip_id}: {linked} заказов > {max_orders}")
+        for status, ids in db._orders_by_status.items():
+            for order_id in ids:
+                if db._tables["orders"][order_id]["status"] != status:
+                    problems.append(f"order #{order_id}: индекс статусов расходится")
+    return problems
+
+
+def run_simulation(
+    db: InMemoryDatabaseLayer,
+    orders: int = 1000,
+    steps: int = 100000,
+    invalid: float = 0.05,
+    threads: int = 1,
+    seed: int = 1,
+    max_orders: int = TRIP_MAX_ORDERS,
+) -> Dict:
+    """
+    Случайные блуждания по графу FSM.
+
+    Создаёт orders заказов на ячейках постаматов (с раскладкой по рейсам),
+    затем steps раз выбирает случайную сущность (заказ, рейс, ячейку) и
+    разрешённое из её статуса действие; с вероятностью invalid — любое
+    действие графа, чтобы прогнать и ветки ошибок. Перед назначением
+    курьера в stage_orders пишется курьер (в 10% случаев — нет, чтобы
+    сработал триггер). Сущность в конечном статусе заменяется новым
+    заказом; набравшие заказы рейсы периодически активируются.
+    """
+    rng = random.Random(seed)
+    fsm = db.get_fsm_table()
+    all_actions = sorted(fsm.actions)
+    cell_ids = [
+        cell_id for cell_id, city in db.get_cities_for_cells(sorted(db._tables["locker_cells"])).items()
+        if city
+    ]
+    if len(cell_ids) < 2:
+        raise DbLayerError("Для симуляции нужны хотя бы 2 ячейки постаматов с адресом")
+    couriers = [uid for uid, user in db._tables["users"].items() if user["role_name"] == "courier"] or [0]
+
+    started = time.perf_counter()
+    for i in range(orders):
+        source, dest = rng.sample(cell_ids, 2)
+        db.create_order_and_assign(
+            f"sim #{i}", source, dest,
+            pickup_type=rng.choice(ORDER_HANDOFF_TYPES),
+            delivery_type=rng.choice(ORDER_HANDOFF_TYPES),
+            max_orders=max_orders,
+        )
+    setup_sec = time.perf_counter() - started
+
+    entities = (
+        [("order", order_id) for order_id in list(db._tables["orders"])]
+        + [("trip", trip_id) for trip_id in list(db._tables["trips"])]
+        + [("locker", cell_id) for cell_id in list(db._tables["locker_cells"])]
+    )
+    applied_before = db.get_log_counters()[1]
+    ok = 0
+    recycled = 0
+    errors: Counter = Counter()
+    lock = threading.Lock()
+
+    def walker(worker: int, count: int) -> None:
+        nonlocal ok, recycled
+        local_rng = random.Random(seed * 1000 + worker)
+        local_ok = 0
+        local_recycled = 0
+        local_errors: Counter = Counter()
+        for step in range(count):
+            if step % 1000 == 0:
+                db.update_trip_active_flags(max_orders, 0)
+            slot = local_rng.randrange(len(entities))
+            entity_type, entity_id = entities[slot]
+            actions = fsm.actions_from(db.get_status(entity_type, entity_id) or "")
+            if not actions:
+                # Сущность в конечном статусе — на её место новый заказ
+                source, dest = local_rng.sample(cell_ids, 2)
+                created = db.create_order_and_assign(
+                    "sim", source, dest,
+                    pickup_type=local_rng.choice(ORDER_HANDOFF_TYPES),
+                    delivery_type=local_rng.choice(ORDER_HANDOFF_TYPES),
+                    max_orders=max_orders,
+                )
+                entities[slot] = ("order", created["order_id"])
+                local_recycled += 1
+                continue
+            if local_rng.random() < invalid:
+                action = local_rng.choice(all_actions)
+            else:
+                action = local_rng.choice(actions)
+            if action == "order_assign_courier1_to_order" and local_rng.random() < 0.9:
+                db.set_courier1_in_stage(entity_id, local_rng.choice(couriers))
+            elif action == "order_assign_courier2_to_order" and local_rng.random() < 0.9:
+                db.set_courier2_in_stage(entity_id, local_rng.choice(couriers))
+            try:
+                db.call_fsm_action(entity_type, entity_id, action, 0)
+                local_ok += 1
+            except FsmCallError as e:
+                local_errors[_error_kind(str(e))] += 1
+        with lock:
+            ok += local_ok
+            recycled += local_recycled
+            errors.update(local_errors)
+
+    per_thread = [steps // threads + (1 if i < steps % threads else 0) for i in range(threads)]
+    started = time.perf_counter()
+    workers = [threading.Thread(target=walker, args=(i, n)) for i, n in enumerate(per_thread)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    states: Dict[str, Counter] = {}
+    for entity_type, table in FSM_ENTITY_TABLES.items():
+        states[entity_type] = Counter(row["status"] for row in db._tables[table].values())
+    logged = db.get_log_counters()[1] - applied_before
+    problems = check_invariants(db, max_orders)
+    if logged != ok:
+        problems.append(f"fsm_action_logs: {logged} записей на {ok} переходов")
+
+    return {
+        "orders": orders,
+        "trips": len(db._tables["trips"]),
+        "cells": len(db._tables["locker_cells"]),
+        "setup_sec": round(setup_sec, 3),
+        "steps": steps,
+        "threads": threads,
+        "transitions": ok,
+        "rejected": sum(errors.values()),
+        "recycled": recycled,
+        "elapsed_sec": round(elapsed, 3),
+        "actions_per_sec": round(steps / elapsed, 1) if elapsed > 0 else 0.0,
+        "transitions_per_min": round(ok / elapsed * 60) if elapsed > 0 else 0,
+        "errors": dict(errors.most_common(20)),
+        "states": {entity_type: dict(counter.most_common()) for entity_type, counter in states.items()},
+        "invariant_violations": problems[:20],
+        "ok": not problems,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="FSM-симулятор без MySQL")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    simulate = sub.add_parser("simulate", help="случайные переходы по графу FSM")
+    simulate.add_argument("--orders", "-n", type=int, default=1000)
+    simulate.add_argument("--steps", "-s", type=int, default=100000)
+    simulate.add_argument("--invalid", type=float, default=0.05,
+                          help="доля заведомо случайных действий")
+    simulate.add_argument("--threads", "-t", type=int, default=1)
+    simulate.add_argument("--seed", type=int, default=1)
+    simulate.add_argument("--max-orders", type=int, default=TRIP_MAX_ORDERS)
+    simulate.add_argument("--dump", default=os.getenv("SIM_DUMP"),
+                          help="дамп БД (по умолчанию последний database/*.sql)")
+    simulate.add_argument("--output", "-o")
+
+    args = parser.parse_args()
+    db = InMemoryDatabaseLayer(dump_path=args.dump)
+    result = run_simulation(
+        db, args.orders, args.steps, args.invalid, args.threads, args.seed, args.max_orders
+    )
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if not result["ok"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Структурированное логирование процесса: JSON-записи, вывод без блокировок, уровни из env.
+
+Модули пишут через logging.getLogger(__name__) и передают идентификаторы
+сущностей в extra — они становятся полями JSON-записи:
+
+logger.debug("Заказ %s: курьер1", order_id, extra={"order_id": order_id})
+→ {"ts": "...", "level": "DEBUG", "logger": "db_layer", "msg": "Заказ 42: курьер1", "order_id": 42}
+
+Обработчик корневого логгера — QueueHandler: запрос только кладёт запись
+в очередь, форматирует и пишет в stderr поток QueueListener. Вызовы ниже
+уровня логгера отсекаются до форматирования сообщения.
+
+Настройка (setup_logging, см. main.lifespan):
+LOG_LEVEL=INFO                              уровень по умолчанию
+LOG_LEVELS=db_layer=DEBUG,scheduler=WARNING уровни отдельных модулей
+LOG_FORMAT=json|text                        text — строки для чтения глазами
+"""
+
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Iterable, Optional, TextIO
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Атрибуты LogRecord, которые не считаются полями из extra
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[QueueListener] = None
+_handler: Optional[QueueHandler] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка; поля из extra идут на верхний уровень."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _RecordQueueHandler(QueueHandler):
+    """
+    QueueHandler, который не склеивает запись в строку: сообщение
+    подставляется сразу (аргументы могут измениться после вызова), а
+    traceback сохраняется отдельно в exc_text — его разбирает форматтер.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_levels(spec: str) -> Dict[str, int]:
+    """'db_layer=DEBUG,scheduler=WARNING' -> {"db_layer": 10, "scheduler": 30}."""
+    levels: Dict[str, int] = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, sep, level = item.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"LOG_LEVELS: ожидается модуль=уровень, получено '{item}'")
+        levels[name.strip()] = _level(level)
+    return levels
+
+
+def _level(name: str) -> int:
+    level = logging.getLevelName(name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Неизвестный уровень логирования: {name}")
+    return level
+
+
+def setup_logging(
+    level: Optional[str] = None,
+    levels: Optional[str] = None,
+    fmt: Optional[str] = None,
+    stream: Optional[TextIO] = None,
+    filters: Iterable[logging.Filter] = (),
+) -> None:
+    """
+    Подключить очередь логов к корневому логгеру и запустить поток вывода.
+
+    Параметры по умолчанию берутся из LOG_LEVEL, LOG_LEVELS и LOG_FORMAT.
+    filters выполняются в потоке, который пишет запись (до очереди), — так
+    к записи добавляется контекст запроса (см. tracing.TraceContextFilter).
+    Повторный вызов без shutdown_logging() ничего не делает.
+    """
+    global _listener, _handler
+    if _listener is not None:
+        return
+    fmt = fmt or os.getenv("LOG_FORMAT", "json")
+    if fmt not in ("json", "text"):
+        raise ValueError(f"Неизвестный LOG_FORMAT: {fmt}")
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _handler = _RecordQueueHandler(records)
+    for log_filter in filters:
+        _handler.addFilter(log_filter)
+
+    root = logging.getLogger()
+    root.setLevel(_level(level or os.getenv("LOG_LEVEL", "INFO")))
+    root.addHandler(_handler)
+    for name, module_level in parse_levels(
+        levels if levels is not None else os.getenv("LOG_LEVELS", "")
+    ).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = QueueListener(records, output)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    """Дописать записи из очереди и отключить обработчик."""
+    global _listener, _handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    _listener.stop()
+    _listener = None
+    _handler = None
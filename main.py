@@ -1,54 +1,157 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-from typing import List, Optional
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Union
+import csv
+import io
+import json
+import logging
 import os
 
-from db_layer import DatabaseLayer, DbLayerError, FsmCallError
+from pydantic import ValidationError
+
+from db_layer import DatabaseLayer, AsyncDatabaseLayer, DbLayerError, FsmCallError, EXCHANGES
+from scheduler import Scheduler, reservation_timeouts_job, trip_activation_job
+from exchange_feed import ExchangeFeed
+from fsm_simulator import InMemoryDatabaseLayer
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, MetricsRegistry, instrument_db
+import tracing
+import migrations
+from log_config import setup_logging, shutdown_logging
 from models import (
-    OrderCreateRequest, OrderResponse,
+    OrderCreateRequest, OrderResponse, OrdersPage,
+    OrderBulkItem, OrdersBulkResponse,
     TripCreateRequest, TripResponse,
-    FsmActionRequest, ApiResponse,
-    UserCreateRequest, LockerCreateRequest,
-    CellCreateRequest, CellResponse, ButtonResponse
+    FsmActionRequest, FsmBatchRequest, ApiResponse,
+    UserCreateRequest, LockerCreateRequest, LockersProvisionRequest,
+    CellCreateRequest, CellResponse, ButtonResponse,
+    ButtonsBulkRequest, ButtonsBulkResponse
 )
 
+logger = logging.getLogger(__name__)
+
 # ========== DATABASE SINGLETON ==========
-db_instance: Optional[DatabaseLayer] = None
+db_instance: Optional[AsyncDatabaseLayer] = None
+scheduler: Optional[Scheduler] = None
+exchange_feed: Optional[ExchangeFeed] = None
+# Метрики процесса для /metrics (порог медленных запросов — DB_SLOW_QUERY_MS)
+metrics = MetricsRegistry(slow_query_ms=float(os.getenv("DB_SLOW_QUERY_MS", "200")))
+# Экспорт спанов трассировки: TRACE_EXPORTER=none|console|file (Server-Timing — всегда)
+span_exporter: Optional[tracing.SpanExporter] = None
+_trace_target = os.getenv("TRACE_EXPORTER", "none")
+if _trace_target != "none":
+    span_exporter = tracing.SpanExporter(
+        "console" if _trace_target == "console" else os.getenv("TRACE_FILE", "traces.jsonl")
+    )
+
+async def get_db() -> AsyncIterator[AsyncDatabaseLayer]:
+    """
+    Dependency для получения db instance.
 
-def get_db() -> DatabaseLayer:
-    """Dependency для получения db instance"""
+    Методы AsyncDatabaseLayer — корутины: блокирующие запросы выполняются
+    в пуле потоков и не останавливают event loop. На каждый запрос
+    открывается своя Session (соединение из пула), после ответа она
+    закрывается — запросы не делят транзакции между собой.
+    """
     if db_instance is None:
         raise HTTPException(status_code=500, detail="Database not initialized")
-    return db_instance
+    async with db_instance.session_scope():
+        yield db_instance
 
 # ========== LIFECYCLE ==========
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup и shutdown события"""
-    global db_instance
+    global db_instance, scheduler, exchange_feed
     
     # Startup
+    # Логи — JSON в stderr через очередь (LOG_LEVEL, LOG_LEVELS, LOG_FORMAT)
+    setup_logging(filters=[tracing.TraceContextFilter()])
     try:
-        db_instance = DatabaseLayer(
-            host=os.getenv("DB_HOST", "localhost"),
-            port=int(os.getenv("DB_PORT", "3307")),
-            database=os.getenv("DB_NAME", "testdb"),
-            user=os.getenv("DB_USER", "root"),
-            password=os.getenv("DB_PASSWORD", "root"),
-            echo=False
+        if os.getenv("DB_BACKEND", "mysql") == "memory":
+            # FSM-симулятор в памяти процесса — для нагрузочных прогонов без MySQL
+            db = InMemoryDatabaseLayer(
+                dump_path=os.getenv("SIM_DUMP") or None,
+                workers=int(os.getenv("DB_THREADS", "8")),
+                city_cache_size=int(os.getenv("CITY_CACHE_SIZE", "10000")),
+            )
+        else:
+            db = DatabaseLayer(
+                host=os.getenv("DB_HOST", "localhost"),
+                port=int(os.getenv("DB_PORT", "3307")),
+                database=os.getenv("DB_NAME", "testdb"),
+                user=os.getenv("DB_USER", "root"),
+                password=os.getenv("DB_PASSWORD", "root"),
+                echo=False,
+                pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+                max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+                pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+                pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+                fsm_engine=os.getenv("FSM_ENGINE", "python"),
+                fsm_cache_ttl=float(os.getenv("FSM_CACHE_TTL", "300")),
+                button_cache_ttl=float(os.getenv("BUTTON_CACHE_TTL", "300")),
+                city_cache_size=int(os.getenv("CITY_CACHE_SIZE", "10000")),
+                poolclass=tracing.TracedQueuePool,
+            )
+        if not isinstance(db, InMemoryDatabaseLayer) and os.getenv("DB_AUTO_MIGRATE", "1") == "1":
+            applied = migrations.upgrade(db)
+            if applied:
+                logger.info("Migrations applied: %s", applied, extra={"migrations": applied})
+        instrument_db(db, metrics)
+        tracing.instrument_db(db)
+        db_threads = os.getenv("DB_THREADS")
+        db_instance = AsyncDatabaseLayer(
+            db, max_workers=int(db_threads) if db_threads else None
         )
-        print("✅ Database connected")
-    except Exception as e:
-        print(f"❌ Database connection failed: {e}")
+        logger.info("Database connected")
+        if os.getenv("CITY_CACHE_WARM", "1") == "1":
+            cells = await db_instance.warm_city_cache()
+            logger.info("City cache warmed: %d cells", cells)
+    except Exception:
+        logger.exception("Database connection failed")
+        shutdown_logging()
         raise
+
+    exchange_feed = ExchangeFeed(db_instance)
+    exchange_feed.start()
+
+    if os.getenv("SCHEDULER_ENABLED", "1") == "1":
+        jitter = float(os.getenv("SCHEDULER_JITTER", "0.1"))
+        scheduler = Scheduler(db_instance)
+        scheduler.add_job(
+            "reservation_timeouts",
+            float(os.getenv("RESERVATION_SWEEP_INTERVAL", "30")),
+            reservation_timeouts_job(int(os.getenv("RESERVATION_TIMEOUT_SEC", "1800"))),
+            jitter=jitter,
+        )
+        scheduler.add_job(
+            "trip_activation",
+            float(os.getenv("TRIP_ACTIVATION_INTERVAL", "60")),
+            trip_activation_job(
+                int(os.getenv("TRIP_MAX_ORDERS", "5")),
+                float(os.getenv("TRIP_TIMEOUT_HOURS", "24")),
+            ),
+            jitter=jitter,
+        )
+        scheduler.start()
+        logger.info("Scheduler started", extra={"jobs": list(scheduler.jobs)})
     
     yield
     
     # Shutdown
-    #if db_instance:
-     #   db_instance.close()
-      #  print("🔌 Database connection closed")
+    if exchange_feed:
+        await exchange_feed.stop()
+        exchange_feed = None
+    if scheduler:
+        await scheduler.stop()
+        scheduler = None
+    if db_instance:
+        db_instance.close()
+        logger.info("Database connection closed")
+    if span_exporter:
+        span_exporter.shutdown()
+    shutdown_logging()
 
 # ========== FASTAPI APP ==========
 app = FastAPI(
@@ -57,6 +160,8 @@ app = FastAPI(
     version="2.0.0",
     lifespan=lifespan
 )
+# Маршруты с разбивкой валидация/эндпоинт в трассе — до объявления эндпоинтов
+app.router.route_class = tracing.TracedRoute
 
 # ========== CORS CONFIGURATION ==========
 origins = [
@@ -74,6 +179,12 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"]
 )
+app.add_middleware(MetricsMiddleware, registry=metrics)
+app.add_middleware(
+    tracing.TracingMiddleware,
+    exporter=span_exporter,
+    sample_ratio=float(os.getenv("TRACE_SAMPLE_RATIO", "1.0")),
+)
 
 # ========== HEALTH CHECK ==========
 @app.get("/")
@@ -81,9 +192,9 @@ async def root():
     return {"status": "ok", "message": "FSM Emulator API v2.0"}
 
 @app.get("/health")
-async def health_check(db: DatabaseLayer = Depends(get_db)):
+async def health_check(db: AsyncDatabaseLayer = Depends(get_db)):
     try:
-        counters = db.get_log_counters()
+        counters = await db.get_log_counters()
         return {
             "status": "healthy",
             "database": "connected",
@@ -91,11 +202,20 @@ async def health_check(db: DatabaseLayer = Depends(get_db)):
                 "fsm_errors": counters[0],
                 "fsm_actions": counters[1],
                 "hardware_commands": counters[2]
-            }
+            },
+            "pool": await db.get_pool_stats(),
+            "scheduler": scheduler.stats() if scheduler else None,
+            "exchange_feed": exchange_feed.stats() if exchange_feed else None,
+            "city_cache": await db.get_city_cache_stats()
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Health check failed: {str(e)}")
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Метрики в формате Prometheus: время SQL по запросам, процедуры, HTTP, пул."""
+    return PlainTextResponse(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
 # ==================== ORDERS ENDPOINTS (НОВЫЕ) ====================
 
 @app.post("/api/orders/create-smart", response_model=dict)
@@ -106,13 +226,13 @@ async def create_order_smart(
     pickup_type: str = "courier",    # ← Тип забора (self/courier)
     delivery_type: str = "courier",  # ← Тип доставки (self/courier)
     auto_assign_trip: bool = True,   # ← Автопривязка к рейсу
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Умное создание заказа с автопарсингом городов.
     
-    Процесс:
-    1. Парсит города из location_address постаматов
+    Процесс (одна транзакция, см. DatabaseLayer.create_order_and_assign):
+    1. Берёт города постаматов (кэш ячейка → город)
     2. Создаёт заказ с pickup_type и delivery_type
     3. Опционально: автоматически привязывает к рейсу
     
@@ -131,30 +251,21 @@ async def create_order_smart(
         - pickup='courier', delivery='courier' → Полная курьерская доставка
     """
     try:
-        # Шаг 1: Парсинг городов из адресов постаматов
-        from_city = db.get_locker_city_by_cell(source_cell_id)
-        to_city = db.get_locker_city_by_cell(dest_cell_id)
-        
-        # Шаг 2: Создание заказа
-        order_id = db.create_order(
+        # Города, заказ и привязка к рейсу — одной транзакцией
+        result = await db.create_order_and_assign(
             description=title,
             source_cell_id=source_cell_id,
             dest_cell_id=dest_cell_id,
-            from_city=from_city,
-            to_city=to_city,
             pickup_type=pickup_type,
-            delivery_type=delivery_type
+            delivery_type=delivery_type,
+            auto_assign_trip=auto_assign_trip
         )
-        
-        # Шаг 3: Опционально - умная привязка к рейсу
-        trip_id = None
-        is_new_trip = False
-        trip_message = "Order created without trip assignment"
-        
-        if auto_assign_trip:
-            trip_id, is_new_trip, trip_message = db.assign_order_to_trip_smart(
-                order_id, from_city, to_city
-            )
+        order_id = result["order_id"]
+        trip_id = result["trip_id"]
+        from_city = result["from_city"]
+        to_city = result["to_city"]
+        is_new_trip = result["is_new_trip"]
+        trip_message = result["message"]
         
         return {
             "success": True,
@@ -184,7 +295,7 @@ async def create_order_manual(
     title: str = "Order",
     pickup_type: str = "courier",
     delivery_type: str = "courier",
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Создание заказа с явным указанием городов (без парсинга).
@@ -192,7 +303,7 @@ async def create_order_manual(
     Используйте этот endpoint если хотите задать города вручную.
     """
     try:
-        order_id = db.create_order(
+        order_id = await db.create_order(
             description=title,
             source_cell_id=source_cell_id,
             dest_cell_id=dest_cell_id,
@@ -214,11 +325,129 @@ async def create_order_manual(
         raise HTTPException(status_code=400, detail=str(e))
 
 
+# Максимум строк в одном POST /api/orders/bulk
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "10000"))
+
+
+@app.post("/api/orders/bulk", response_model=OrdersBulkResponse)
+async def create_orders_bulk(
+    request: Request,
+    auto_assign_trip: bool = True,
+    db: AsyncDatabaseLayer = Depends(get_db),
+):
+    """
+    Массовое создание заказов (онбординг мерчанта).
+
+    Тело — по Content-Type:
+    - application/json — массив объектов;
+    - application/x-ndjson — по объекту JSON на строку;
+    - text/csv — строка заголовка с именами полей, затем строки.
+
+    Поля строки — OrderBulkItem: description, from_city/to_city или
+    source_cell_id/dest_cell_id (город по ячейке), pickup_type, delivery_type.
+    Заказы вставляются пачками и сразу раскладываются по рейсам маршрута
+    (auto_assign_trip=false — без рейсов). Ошибка строки не мешает
+    остальным: results идут в порядке входа.
+    """
+    try:
+        raw_rows = _parse_bulk_body(await request.body(), request.headers.get("content-type", ""))
+    except UnsupportedBulkFormat as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(raw_rows) > BULK_MAX_ROWS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком много строк: {len(raw_rows)} (максимум {BULK_MAX_ROWS})",
+        )
+
+    results: List[Dict] = [{"index": i} for i in range(len(raw_rows))]
+    valid_indexes: List[int] = []
+    valid_rows: List[Dict] = []
+    for index, raw in enumerate(raw_rows):
+        if isinstance(raw, str):
+            results[index]["error"] = raw
+            continue
+        try:
+            item = OrderBulkItem.model_validate(raw)
+        except ValidationError as e:
+            results[index]["error"] = "; ".join(
+                f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}"
+                for err in e.errors()
+            )
+            continue
+        valid_indexes.append(index)
+        valid_rows.append(item.model_dump())
+
+    try:
+        bulk = await db.create_orders_bulk(valid_rows, auto_assign_trip=auto_assign_trip)
+    except DbLayerError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for index, result in zip(valid_indexes, bulk["results"]):
+        results[index].update(result)
+
+    return {
+        "created": bulk["created"],
+        "failed": len(results) - bulk["created"],
+        "trips_created": len(bulk["new_trip_ids"]),
+        "results": results,
+    }
+
+
+class UnsupportedBulkFormat(ValueError):
+    """Content-Type тела /api/orders/bulk не поддерживается (ответ 415)."""
+
+
+def _parse_bulk_body(body: bytes, content_type: str) -> List[Union[Dict[str, Any], str]]:
+    """
+    Строки тела /api/orders/bulk: dict или текст ошибки разбора строки.
+
+    ValueError — тело целиком не разобрать; UnsupportedBulkFormat — формат
+    не поддержан.
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    text_body = body.decode("utf-8-sig")
+
+    if media_type == "application/json":
+        try:
+            rows = json.loads(text_body)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Некорректный JSON: {e}") from e
+        if not isinstance(rows, list):
+            raise ValueError("Ожидается JSON-массив заказов")
+        return [row if isinstance(row, dict) else "Ожидается объект" for row in rows]
+
+    if media_type in ("application/x-ndjson", "application/jsonl"):
+        rows: List[Union[Dict[str, Any], str]] = []
+        for line in text_body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                rows.append(f"Некорректный JSON: {e}")
+                continue
+            rows.append(row if isinstance(row, dict) else "Ожидается объект")
+        return rows
+
+    if media_type in ("text/csv", "application/csv"):
+        reader = csv.DictReader(io.StringIO(text_body))
+        if not reader.fieldnames:
+            raise ValueError("CSV без строки заголовка")
+        # Пустая ячейка — поле не задано
+        return [
+            {key: value for key, value in row.items() if key and value not in ("", None)}
+            for row in reader
+        ]
+
+    raise UnsupportedBulkFormat("Поддерживаются application/json, application/x-ndjson и text/csv")
+
+
 @app.post("/api/orders/{order_id}/start-flow", response_model=dict)
 async def start_order_flow(
     order_id: int,
     user_id: int = 0,
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Запустить FSM flow заказа (первая развилка на основе pickup_type).
@@ -232,8 +461,8 @@ async def start_order_flow(
         user_id: ID курьера (если pickup_type='courier')
     """
     try:
-        db.start_order_flow(order_id, user_id)
-        order = db.get_order(order_id)
+        await db.start_order_flow(order_id, user_id)
+        order = await db.get_order(order_id)
         
         return {
             "success": True,
@@ -250,7 +479,7 @@ async def start_order_flow(
 @app.post("/api/orders/{order_id}/handle-parcel-confirmed", response_model=dict)
 async def handle_parcel_confirmed(
     order_id: int,
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Обработка после попадания посылки в постамат2 (вторая развилка на основе delivery_type).
@@ -262,8 +491,8 @@ async def handle_parcel_confirmed(
     Вызывать после FSM перехода в order_parcel_confirmed.
     """
     try:
-        db.handle_parcel_confirmed(order_id)
-        order = db.get_order(order_id)
+        await db.handle_parcel_confirmed(order_id)
+        order = await db.get_order(order_id)
         
         return {
             "success": True,
@@ -276,55 +505,92 @@ async def handle_parcel_confirmed(
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.get("/api/orders/by-route", response_model=List[dict])
+@app.get("/api/orders/by-route", response_model=Union[List[dict], OrdersPage])
 async def get_orders_by_route(
     from_city: str,
     to_city: str,
     statuses: Optional[str] = None,
-    db: DatabaseLayer = Depends(get_db)
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
-    """Получить заказы по маршруту (опционально фильтровать по статусам)"""
+    """
+    Получить заказы по маршруту (опционально фильтровать по статусам).
+
+    Пагинация и потоковая выдача — как у GET /api/orders.
+    """
     try:
         status_list = statuses.split(",") if statuses else None
-        orders = db.get_orders_for_route(from_city, to_city, status_list)
+        if stream:
+            return _ndjson_response(db.db.iter_orders(status_list, from_city, to_city))
+        if limit is not None:
+            return await db.get_orders_page(limit, cursor, status_list, from_city, to_city)
+        orders = await db.get_orders_for_route(from_city, to_city, status_list)
         return orders
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/orders/{order_id}", response_model=dict)
-async def get_order(order_id: int, db: DatabaseLayer = Depends(get_db)):
+async def get_order(order_id: int, db: AsyncDatabaseLayer = Depends(get_db)):
     """Получить заказ по ID"""
     try:
-        order = db.get_order(order_id)
+        order = await db.get_order(order_id)
         if not order:
             raise HTTPException(status_code=404, detail=f"Order {order_id} not found")
         return order
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.get("/api/orders", response_model=List[dict])
+@app.get("/api/orders", response_model=Union[List[dict], OrdersPage])
 async def get_all_orders(
     statuses: Optional[str] = None,
-    db: DatabaseLayer = Depends(get_db),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    db: AsyncDatabaseLayer = Depends(get_db),
 ):
     """
     Получить все заказы без привязки к маршруту.
     Опционально: фильтр по статусам, через запятую, например:
     ?statuses=order_created,order_parcel_confirmed
+
+    Пагинация: ?limit=100 возвращает {"orders": [...], "next_cursor": "..."};
+    следующая страница — ?limit=100&cursor=<next_cursor>. Без limit —
+    прежний полный список.
+
+    ?stream=true — NDJSON (одна строка JSON на заказ), строки читаются из
+    БД по мере отправки клиенту.
     """
     try:
         status_list = statuses.split(",") if statuses else None
-        orders = db.get_all_orders(status_list)
+        if stream:
+            return _ndjson_response(db.db.iter_orders(status_list))
+        if limit is not None:
+            return await db.get_orders_page(limit, cursor, status_list)
+        orders = await db.get_all_orders(status_list)
         return orders
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+
+def _ndjson_response(rows: Iterator[Dict]) -> StreamingResponse:
+    """Отдать строки генератора как application/x-ndjson."""
+    def body() -> Iterator[str]:
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
 # ==================== БИРЖИ КУРЬЕРОВ (НОВЫЕ) ====================
 
 @app.get("/api/courier/exchange-pickup", response_model=dict)
 async def get_exchange_orders_pickup(
     city: Optional[str] = None,
-    db: DatabaseLayer = Depends(get_db)
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
+    since: Optional[str] = None,
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Биржа заказов для курьера1 (забор от клиента).
@@ -336,14 +602,24 @@ async def get_exchange_orders_pickup(
     
     Args:
         city: Фильтр по городу отправления (опционально)
+        limit: Размер страницы; следующая — с cursor=next_cursor
+        since: Опрос изменений: первый запрос с since=0, дальше — since
+            из предыдущего ответа; приходят только новые/изменённые заказы,
+            а в removed — id заказов, ушедших с биржи (взял курьер, отмена,
+            таймаут): их нужно убрать из списка. Изменения последних секунд
+            приходят повторно — клиент заменяет заказ по id
     """
     try:
-        orders = db.get_available_orders_for_courier1(city)
+        page = await db.get_exchange_orders("pickup", city, limit, cursor, since)
+        orders = page["orders"]
         return {
             "type": "pickup",
             "description": "Заказы для курьера1 (забор от клиента)",
             "count": len(orders),
-            "orders": orders
+            "orders": orders,
+            "removed": page["removed"],
+            "next_cursor": page["next_cursor"],
+            "since": page["since"]
         }
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -352,7 +628,10 @@ async def get_exchange_orders_pickup(
 @app.get("/api/courier/exchange-delivery", response_model=dict)
 async def get_exchange_orders_delivery(
     city: Optional[str] = None,
-    db: DatabaseLayer = Depends(get_db)
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
+    since: Optional[str] = None,
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Биржа заказов для курьера2 (доставка получателю).
@@ -364,25 +643,61 @@ async def get_exchange_orders_delivery(
     
     Args:
         city: Фильтр по городу назначения (опционально)
+        limit: Размер страницы; следующая — с cursor=next_cursor
+        since: Опрос изменений: первый запрос с since=0, дальше — since
+            из предыдущего ответа; приходят только новые/изменённые заказы,
+            а в removed — id заказов, ушедших с биржи (взял курьер, отмена,
+            таймаут): их нужно убрать из списка. Изменения последних секунд
+            приходят повторно — клиент заменяет заказ по id
     """
     try:
-        orders = db.get_available_orders_for_courier2(city)
+        page = await db.get_exchange_orders("delivery", city, limit, cursor, since)
+        orders = page["orders"]
         return {
             "type": "delivery",
             "description": "Заказы для курьера2 (доставка получателю)",
             "count": len(orders),
-            "orders": orders
+            "orders": orders,
+            "removed": page["removed"],
+            "next_cursor": page["next_cursor"],
+            "since": page["since"]
         }
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.get("/api/courier/exchange/stream")
+async def stream_exchange(
+    exchange: Optional[str] = None,
+    city: Optional[str] = None,
+):
+    """
+    Push-лента бирж (text/event-stream) вместо опроса exchange-pickup/delivery.
+
+    События: enter — заказ появился на бирже, leave — ушёл с неё;
+    ready — подписка оформлена; reset — клиент отстал, нужно перечитать
+    биржу страницей и переподключиться. Раз в 15 с приходит комментарий-пинг.
+
+    Args:
+        exchange: pickup / delivery (по умолчанию обе)
+        city: город отправления (pickup) / назначения (delivery)
+    """
+    if exchange_feed is None:
+        raise HTTPException(status_code=500, detail="Exchange feed not initialized")
+    if exchange is not None and exchange not in EXCHANGES:
+        raise HTTPException(status_code=400, detail=f"Неизвестная биржа: {exchange}")
+    return StreamingResponse(
+        exchange_feed.sse(exchange, city),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # ==================== TRIPS ENDPOINTS ====================
 
 @app.post("/api/trips", response_model=ApiResponse)
-async def create_trip(request: TripCreateRequest, db: DatabaseLayer = Depends(get_db)):
+async def create_trip(request: TripCreateRequest, db: AsyncDatabaseLayer = Depends(get_db)):
     """Создать рейс"""
     try:
-        trip_id = db.create_trip(
+        trip_id = await db.create_trip(
             from_city=request.from_city,
             to_city=request.to_city,
             driver_user_id=request.driver_user_id,
@@ -400,10 +715,10 @@ async def create_trip(request: TripCreateRequest, db: DatabaseLayer = Depends(ge
 
 
 @app.get("/api/trips/{trip_id}", response_model=dict)
-async def get_trip(trip_id: int, db: DatabaseLayer = Depends(get_db)):
+async def get_trip(trip_id: int, db: AsyncDatabaseLayer = Depends(get_db)):
     """Получить рейс по ID"""
     try:
-        trip = db.get_trip(trip_id)
+        trip = await db.get_trip(trip_id)
         if not trip:
             raise HTTPException(status_code=404, detail=f"Trip {trip_id} not found")
         return trip
@@ -412,10 +727,10 @@ async def get_trip(trip_id: int, db: DatabaseLayer = Depends(get_db)):
 
 
 @app.get("/api/trips/{trip_id}/orders", response_model=List[int])
-async def get_trip_orders(trip_id: int, db: DatabaseLayer = Depends(get_db)):
+async def get_trip_orders(trip_id: int, db: AsyncDatabaseLayer = Depends(get_db)):
     """Получить список order_id рейса"""
     try:
-        order_ids = db.get_trip_orders(trip_id)
+        order_ids = await db.get_trip_orders(trip_id)
         return order_ids
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -425,11 +740,11 @@ async def get_trip_orders(trip_id: int, db: DatabaseLayer = Depends(get_db)):
 async def assign_order_to_trip(
     trip_id: int,
     order_id: int,
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """Привязать заказ к рейсу (ручной метод)"""
     try:
-        success, msg = db.assign_order_to_trip(order_id, trip_id)
+        success, msg = await db.assign_order_to_trip(order_id, trip_id)
         return ApiResponse(success=success, message=msg)
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -438,7 +753,7 @@ async def assign_order_to_trip(
 @app.post("/api/orders/{order_id}/assign-trip-smart", response_model=dict)
 async def assign_trip_smart(
     order_id: int,
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Умная привязка существующего заказа к рейсу.
@@ -446,11 +761,11 @@ async def assign_trip_smart(
     Автоматически найдёт подходящий рейс или создаст новый.
     """
     try:
-        order = db.get_order(order_id)
+        order = await db.get_order(order_id)
         if not order:
             raise HTTPException(status_code=404, detail=f"Order {order_id} not found")
         
-        trip_id, is_new, msg = db.assign_order_to_trip_smart(
+        trip_id, is_new, msg = await db.assign_order_to_trip_smart(
             order_id, 
             order["from_city"], 
             order["to_city"]
@@ -469,15 +784,15 @@ async def assign_trip_smart(
 @app.post("/api/trips/{trip_id}/activate", response_model=dict)
 async def activate_trip(
     trip_id: int,
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Ручная активация конкретного рейса.
     Активирует рейс даже если не достигнут порог заказов.
     """
     try:
-        db.activate_trip_manual(trip_id) 
-        trip = db.get_trip(trip_id)
+        await db.activate_trip_manual(trip_id) 
+        trip = await db.get_trip(trip_id)
         
         return {
             "success": True,
@@ -497,13 +812,14 @@ async def process_timeouts(
     reservation_timeout_sec: int = 1800,
     trip_timeout_hours: float = 24.0,
     trip_max_orders: int = 5,
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
-    Обработка таймаутов (эмуляция планировщика).
+    Обработка таймаутов вручную.
     
-    На продакшене вызывается автоматически через крон каждые 30 секунд.
-    В тестах - вручную через этот endpoint.
+    В работе те же проходы выполняет встроенный планировщик (scheduler.py,
+    SCHEDULER_ENABLED=1) — внешний крон не нужен. Endpoint оставлен для
+    тестов и ручного запуска с произвольными порогами.
     
     Args:
         reservation_timeout_sec: Таймаут резерва заказа (по умолчанию 30 минут)
@@ -511,25 +827,37 @@ async def process_timeouts(
         trip_max_orders: Максимум заказов для автоактивации рейса
     """
     try:
-        orders_processed = db.check_and_process_reservation_timeouts(reservation_timeout_sec)
-        trips_activated = db.update_trip_active_flags(trip_max_orders, trip_timeout_hours)
+        timeouts = await db.check_and_process_reservation_timeouts(reservation_timeout_sec)
+        orders_processed = len(timeouts["processed"])
+        activated_trip_ids = await db.update_trip_active_flags(trip_max_orders, trip_timeout_hours)
+        trips_activated = len(activated_trip_ids)
         
         return {
             "success": True,
             "orders_processed": orders_processed,
+            "processed_order_ids": timeouts["processed"],
+            "failed_order_ids": timeouts["failed"],
             "trips_activated": trips_activated,
+            "activated_trip_ids": activated_trip_ids,
             "message": f"Обработано заказов: {orders_processed}, Активировано рейсов: {trips_activated}"
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка обработки таймаутов: {str(e)}")
 
+@app.get("/api/scheduler", response_model=dict)
+async def scheduler_stats():
+    """Статистика встроенного планировщика: последний прогон, длительность, счётчики."""
+    if scheduler is None:
+        return {"enabled": False, "jobs": {}}
+    return {"enabled": True, "jobs": scheduler.stats()}
+
 # ==================== FSM ACTIONS ====================
 
 @app.post("/api/fsm/action", response_model=ApiResponse)
-async def perform_fsm_action(request: FsmActionRequest, db: DatabaseLayer = Depends(get_db)):
+async def perform_fsm_action(request: FsmActionRequest, db: AsyncDatabaseLayer = Depends(get_db)):
     """Выполнить FSM действие"""
     try:
-        result = db.call_fsm_action(
+        result = await db.call_fsm_action(
             entity_type=request.entity_type,
             entity_id=request.entity_id,
             action_name=request.action_name,
@@ -545,27 +873,96 @@ async def perform_fsm_action(request: FsmActionRequest, db: DatabaseLayer = Depe
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.post("/api/fsm/actions/batch", response_model=dict)
+async def perform_fsm_actions_batch(
+    request: FsmBatchRequest,
+    db: AsyncDatabaseLayer = Depends(get_db)
+):
+    """
+    Выполнить пачку FSM действий на одном соединении.
+
+    atomic=false — переходы независимы, ошибка одного не мешает остальным.
+    atomic=true — всё или ничего: при первой ошибке вся пачка откатывается.
+
+    Пример: trip_confirm_pickup для рейса + order_pickup_by_voditel
+    для каждого его заказа одним запросом.
+    """
+    try:
+        results = await db.call_fsm_actions_batch(
+            [action.model_dump() for action in request.actions],
+            atomic=request.atomic
+        )
+        applied = sum(1 for r in results if r["success"])
+        return {
+            "success": applied == len(results),
+            "atomic": request.atomic,
+            "applied": applied,
+            "failed": len(results) - applied,
+            "results": results
+        }
+    except FsmCallError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/api/fsm/reload", response_model=ApiResponse)
+async def reload_fsm_cache(db: AsyncDatabaseLayer = Depends(get_db)):
+    """Перечитать граф переходов FSM и button_states из БД (после их правки)"""
+    try:
+        stats = await db.reload_fsm_cache()
+        stats.update(await db.reload_button_cache())
+        return ApiResponse(success=True, message="FSM cache reloaded", data=stats)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка перезагрузки FSM: {str(e)}")
+
+
 @app.get("/api/fsm/buttons", response_model=List[ButtonResponse])
 async def get_buttons(
     user_role: str,
     entity_type: str,
     entity_id: int,
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """Получить доступные кнопки для роли"""
     try:
-        buttons = db.get_buttons(user_role, entity_type, entity_id)
+        buttons = await db.get_buttons(user_role, entity_type, entity_id)
         return [ButtonResponse(**btn) for btn in buttons]
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+
+@app.post("/api/fsm/buttons/bulk", response_model=ButtonsBulkResponse)
+async def get_buttons_bulk(
+    request: ButtonsBulkRequest,
+    db: AsyncDatabaseLayer = Depends(get_db)
+):
+    """
+    Кнопки роли сразу для многих сущностей (одним запросом вместо N).
+
+    Ответ: {"buttons": {"order:5": [...], "trip:2": [...]}, "missing": ["order:7"]}
+    """
+    try:
+        entities = [(e.entity_type, e.entity_id) for e in request.entities]
+        found = await db.get_buttons_bulk(request.user_role, entities)
+        buttons = {
+            f"{entity_type}:{entity_id}": [ButtonResponse(**btn) for btn in btns]
+            for (entity_type, entity_id), btns in found.items()
+        }
+        missing = [
+            f"{entity_type}:{entity_id}"
+            for entity_type, entity_id in dict.fromkeys(entities)
+            if (entity_type, entity_id) not in found
+        ]
+        return ButtonsBulkResponse(buttons=buttons, missing=missing)
+    except DbLayerError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # ==================== LOCKERS / CELLS ====================
 
 @app.post("/api/lockers", response_model=ApiResponse)
-async def create_locker(request: LockerCreateRequest, db: DatabaseLayer = Depends(get_db)):
+async def create_locker(request: LockerCreateRequest, db: AsyncDatabaseLayer = Depends(get_db)):
     """Создать постамат"""
     try:
-        db.create_locker(
+        await db.create_locker(
             locker_id=request.locker_id,
             locker_code=request.locker_code,
             location_address=request.location_address,
@@ -577,10 +974,10 @@ async def create_locker(request: LockerCreateRequest, db: DatabaseLayer = Depend
 
 
 @app.post("/api/lockers/cells", response_model=ApiResponse)
-async def create_cell(request: CellCreateRequest, db: DatabaseLayer = Depends(get_db)):
+async def create_cell(request: CellCreateRequest, db: AsyncDatabaseLayer = Depends(get_db)):
     """Создать ячейку"""
     try:
-        cell_id = db.create_locker_cell(
+        cell_id = await db.create_locker_cell(
             locker_id=request.locker_id,
             cell_code=request.cell_code,
             cell_type=request.cell_type
@@ -594,10 +991,41 @@ async def create_cell(request: CellCreateRequest, db: DatabaseLayer = Depends(ge
         raise HTTPException(status_code=400, detail=str(e))
         
 
+@app.post("/api/lockers/provision", response_model=dict)
+async def provision_lockers(
+    request: LockersProvisionRequest, db: AsyncDatabaseLayer = Depends(get_db)
+):
+    """
+    Массово завести постаматы сети (до 1000 за вызов) одной транзакцией.
+
+    Повторный вызов обновляет адрес/модель существующих постаматов и
+    досоздаёт недостающие ячейки; with_cells=true — ячейки по моделям
+    (locker_models.cell_count_s/m/l/p, коды S-01, M-01, ...).
+    locker_code, занятый другим постаматом, — 400 без изменений.
+    """
+    try:
+        return await db.provision_lockers(
+            [locker.model_dump() for locker in request.lockers],
+            with_cells=request.with_cells,
+        )
+    except DbLayerError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/api/lockers/{locker_id}/provision", response_model=dict)
+async def provision_locker_cells(locker_id: int, db: AsyncDatabaseLayer = Depends(get_db)):
+    """Создать все ячейки постамата по его модели (идемпотентно)."""
+    try:
+        counts = await db.provision_locker_cells([locker_id])
+        return {"locker_id": locker_id, "cells": counts[locker_id]}
+    except DbLayerError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.get("/api/lockers", response_model=List[dict])
-async def list_lockers(db: DatabaseLayer = Depends(get_db)):
+async def list_lockers(db: AsyncDatabaseLayer = Depends(get_db)):
     try:
-        return db.get_lockers()
+        return await db.get_lockers()
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -606,11 +1034,11 @@ async def list_lockers(db: DatabaseLayer = Depends(get_db)):
 async def get_cells_by_status(
     locker_id: int,
     status: str = "locker_free",
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """Получить ячейки постамата по статусу"""
     try:
-        cells = db.get_locker_cells_by_status(locker_id, status)
+        cells = await db.get_locker_cells_by_status(locker_id, status)
         return [CellResponse(**cell) for cell in cells]
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -619,7 +1047,7 @@ async def get_cells_by_status(
 @app.get("/api/cells/{cell_id}/city", response_model=dict)
 async def get_cell_city(
     cell_id: int,
-    db: DatabaseLayer = Depends(get_db)
+    db: AsyncDatabaseLayer = Depends(get_db)
 ):
     """
     Получить город по ID ячейки (парсинг адреса).
@@ -627,7 +1055,7 @@ async def get_cell_city(
     Пример: "Москва, Ленина 10" → "Москва"
     """
     try:
-        city = db.get_locker_city_by_cell(cell_id)
+        city = await db.get_locker_city_by_cell(cell_id)
         return {"cell_id": cell_id, "city": city}
     except DbLayerError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -635,10 +1063,10 @@ async def get_cell_city(
 # ==================== USERS ====================
 
 @app.post("/api/users", response_model=ApiResponse)
-async def create_user(request: UserCreateRequest, db: DatabaseLayer = Depends(get_db)):
+async def create_user(request: UserCreateRequest, db: AsyncDatabaseLayer = Depends(get_db)):
     """Создать пользователя"""
     try:
-        db.create_user(
+        await db.create_user(
             user_id=request.user_id,
             name=request.name,
             role=request.role
@@ -649,10 +1077,10 @@ async def create_user(request: UserCreateRequest, db: DatabaseLayer = Depends(ge
 
 
 @app.get("/api/users/{user_id}/role")
-async def get_user_role(user_id: int, db: DatabaseLayer = Depends(get_db)):
+async def get_user_role(user_id: int, db: AsyncDatabaseLayer = Depends(get_db)):
     """Получить роль пользователя"""
     try:
-        role = db.get_user_role(user_id)
+        role = await db.get_user_role(user_id)
         if not role:
             raise HTTPException(status_code=404, detail=f"User {user_id} not found")
         return {"user_id": user_id, "role": role}
@@ -662,20 +1090,20 @@ async def get_user_role(user_id: int, db: DatabaseLayer = Depends(get_db)):
 # ==================== UTILITIES ====================
 
 @app.post("/api/test/clear", response_model=ApiResponse)
-async def clear_test_data(db: DatabaseLayer = Depends(get_db)):
+async def clear_test_data(db: AsyncDatabaseLayer = Depends(get_db)):
     """Очистить тестовые данные"""
     try:
-        db.clear_test_data()
+        await db.clear_test_data()
         return ApiResponse(success=True, message="Test data cleared")
     except DbLayerError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/api/test/log-counters")
-async def get_log_counters(db: DatabaseLayer = Depends(get_db)):
+async def get_log_counters(db: AsyncDatabaseLayer = Depends(get_db)):
     """Получить счётчики логов"""
     try:
-        error_count, fsm_count, hw_count = db.get_log_counters()
+        error_count, fsm_count, hw_count = await db.get_log_counters()
         return {
             "fsm_errors": error_count,
             "fsm_actions": fsm_count,
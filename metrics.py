@@ -0,0 +1,395 @@
+"""
+Метрики запросов к БД и HTTP в формате Prometheus (GET /metrics).
+
+Что меряется:
+- каждый SQL-запрос через engine (события before/after_cursor_execute):
+  гистограмма времени по стабильному имени запроса, ошибки, медленные
+  запросы (порог DB_SLOW_QUERY_MS, пишутся в лог metrics вместе с маршрутом);
+- хранимые процедуры через mysql-connector (callproc идёт мимо engine) —
+  через DatabaseLayer.add_procedure_listener;
+- потоковое чтение заказов (iter_orders, курсор mysql-connector мимо
+  engine) — через DatabaseLayer.add_raw_query_listener, в те же серии
+  db_query_*, что и запросы через engine;
+- HTTP-запросы (MetricsMiddleware): время и число ответов по шаблону
+  маршрута и коду, число SQL-запросов и время в БД на один HTTP-запрос.
+
+Имя запроса: execution_options(query_name="...") у запроса, иначе
+<глагол>_<таблица>_<хэш>, где хэш считается по тексту запроса без
+литералов и с одним плейсхолдером вместо списков IN (...) и строк VALUES —
+поэтому один и тот же запрос с разным числом id попадает в одну серию.
+
+Использование (см. main.py):
+metrics = MetricsRegistry(slow_query_ms=200)
+app.add_middleware(MetricsMiddleware, registry=metrics)
+instrument_db(db, metrics)
+...
+metrics.render()  # текст для /metrics
+"""
+
+import bisect
+import contextvars
+import hashlib
+import logging
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+from db_layer import DatabaseLayer, DbLayerError
+
+logger = logging.getLogger(__name__)
+
+# charset добавляет PlainTextResponse
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Границы гистограмм времени (секунды)
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# Границы гистограммы числа SQL-запросов на HTTP-запрос
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Сколько разных текстов запросов помнить в кэше имён
+QUERY_NAME_CACHE_SIZE = 10000
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_PARAM = re.compile(r"%\(\w+\)s|%s|\?|:\w+")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_VALUES_ROWS = re.compile(r"(\(\?\))(?:\s*,\s*\(\?\))+")
+_SPACES = re.compile(r"\s+")
+_VERB = re.compile(r"^\s*(\w+)")
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+`?(\w+)`?", re.IGNORECASE)
+
+
+def fingerprint(statement: str) -> str:
+    """Текст запроса без литералов, плейсхолдеров и длины списков."""
+    normalized = _STRING_LITERAL.sub("?", statement)
+    normalized = _PARAM.sub("?", normalized)
+    normalized = _NUMBER.sub("?", normalized)
+    normalized = _PLACEHOLDER_LIST.sub("?", normalized)
+    normalized = _VALUES_ROWS.sub(r"\1", normalized)
+    return _SPACES.sub(" ", normalized).strip()
+
+
+_query_names: Dict[str, str] = {}
+_query_names_lock = threading.Lock()
+
+
+def query_name(statement: str) -> str:
+    """Стабильное имя запроса: <глагол>_<таблица>_<8 символов md5 отпечатка>."""
+    name = _query_names.get(statement)
+    if name is not None:
+        return name
+    normalized = fingerprint(statement)
+    verb = _VERB.match(normalized)
+    table = _TABLE.search(normalized)
+    name = "_".join(
+        part
+        for part in (
+            verb.group(1).lower() if verb else "sql",
+            table.group(1).lower() if table else None,
+            hashlib.md5(normalized.encode()).hexdigest()[:8],
+        )
+        if part
+    )
+    with _query_names_lock:
+        if len(_query_names) >= QUERY_NAME_CACHE_SIZE:
+            _query_names.clear()
+        _query_names[statement] = name
+    return name
+
+
+class Histogram:
+    """Потокобезопасная гистограмма Prometheus (кумулятивные бакеты считаются при выводе)."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class RequestStats:
+    """SQL-работа одного HTTP-запроса (живёт в contextvars запроса)."""
+
+    __slots__ = ("route", "queries", "db_seconds")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Статистика текущего HTTP-запроса; AsyncDatabaseLayer.run() переносит
+# contextvars в поток БД, поэтому хуки engine видят её и там
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "metrics_request", default=None
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    return ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+
+
+class MetricsRegistry:
+    """
+    Счётчики и гистограммы процесса и их вывод в текстовом формате Prometheus.
+
+    slow_query_ms: запросы и процедуры дольше порога пишутся в лог (WARNING)
+        (0 — не писать)
+    """
+
+    def __init__(self, slow_query_ms: float = 200.0):
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        # имя метрики -> {значения меток: Histogram | int}
+        self._histograms: Dict[str, Dict[Tuple[str, ...], Histogram]] = {}
+        self._counters: Dict[str, Dict[Tuple[str, ...], int]] = {}
+        self._gauge_sources: List = []
+
+    # ---------- запись ----------
+
+    def _histogram(self, metric: str, labels: Tuple[str, ...], buckets: Sequence[float]) -> Histogram:
+        series = self._histograms.get(metric)
+        histogram = series.get(labels) if series else None
+        if histogram is None:
+            with self._lock:
+                series = self._histograms.setdefault(metric, {})
+                histogram = series.setdefault(labels, Histogram(buckets))
+        return histogram
+
+    def inc(self, metric: str, labels: Tuple[str, ...], value: int = 1) -> None:
+        with self._lock:
+            series = self._counters.setdefault(metric, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe_query(
+        self, name: str, seconds: float, statement: str, error: bool = False
+    ) -> None:
+        """Один SQL-запрос через engine."""
+        self._histogram("db_query_duration_seconds", (name,), LATENCY_BUCKETS).observe(seconds)
+        if error:
+            self.inc("db_query_errors_total", (name,))
+        request = current_request.get()
+        if request is not None:
+            request.queries += 1
+            request.db_seconds += seconds
+        self._check_slow("db_slow_queries_total", name, seconds, statement, request)
+
+    def observe_raw_query(
+        self, statement: str, seconds: float, error: Optional[BaseException] = None
+    ) -> None:
+        """SQL-запрос мимо engine (подписчик DatabaseLayer.add_raw_query_listener)."""
+        self.observe_query(query_name(statement), seconds, statement, error is not None)
+
+    def observe_procedure(
+        self, name: str, seconds: float, error: Optional[BaseException] = None
+    ) -> None:
+        """Вызов хранимой процедуры (подписчик DatabaseLayer.add_procedure_listener)."""
+        self._histogram("db_procedure_duration_seconds", (name,), LATENCY_BUCKETS).observe(seconds)
+        if error is not None:
+            self.inc("db_procedure_errors_total", (name,))
+        request = current_request.get()
+        if request is not None:
+            request.queries += 1
+            request.db_seconds += seconds
+        self._check_slow("db_slow_procedures_total", name, seconds, f"CALL {name}", request)
+
+    def _check_slow(
+        self,
+        metric: str,
+        name: str,
+        seconds: float,
+        statement: str,
+        request: Optional[RequestStats],
+    ) -> None:
+        if self.slow_query_ms <= 0 or seconds * 1000 < self.slow_query_ms:
+            return
+        self.inc(metric, (name,))
+        logger.warning(
+            "Медленный запрос %s: %.1f мс", name, seconds * 1000,
+            extra={
+                "query_name": name,
+                "route": request.route if request is not None else None,
+                "duration_ms": round(seconds * 1000, 1),
+                "statement": _SPACES.sub(" ", statement)[:500],
+            },
+        )
+
+    def observe_request(
+        self, method: str, route: str, status: int, seconds: float, stats: RequestStats
+    ) -> None:
+        """Завершённый HTTP-запрос."""
+        self.inc("http_requests_total", (method, route, str(status)))
+        self._histogram(
+            "http_request_duration_seconds", (method, route), LATENCY_BUCKETS
+        ).observe(seconds)
+        self._histogram(
+            "http_request_db_queries", (method, route), QUERY_COUNT_BUCKETS
+        ).observe(stats.queries)
+        self._histogram(
+            "http_request_db_seconds", (method, route), LATENCY_BUCKETS
+        ).observe(stats.db_seconds)
+
+    def add_gauges(self, source) -> None:
+        """
+        Источник мгновенных значений: source() -> {имя метрики: число}.
+
+        Вызывается при каждом render(); нечисловые значения пропускаются.
+        """
+        self._gauge_sources.append(source)
+
+    # ---------- вывод ----------
+
+    _HELP = {
+        "db_query_duration_seconds": ("histogram", ("query",), "Время SQL-запроса через engine"),
+        "db_query_errors_total": ("counter", ("query",), "Ошибки SQL-запросов"),
+        "db_slow_queries_total": ("counter", ("query",), "SQL-запросы дольше DB_SLOW_QUERY_MS"),
+        "db_procedure_duration_seconds": ("histogram", ("procedure",), "Время хранимой процедуры"),
+        "db_procedure_errors_total": ("counter", ("procedure",), "Ошибки хранимых процедур"),
+        "db_slow_procedures_total": ("counter", ("procedure",), "Процедуры дольше DB_SLOW_QUERY_MS"),
+        "http_requests_total": ("counter", ("method", "route", "status"), "HTTP-ответы"),
+        "http_request_duration_seconds": ("histogram", ("method", "route"), "Время HTTP-запроса"),
+        "http_request_db_queries": ("histogram", ("method", "route"), "SQL-запросов на HTTP-запрос"),
+        "http_request_db_seconds": ("histogram", ("method", "route"), "Время в БД на HTTP-запрос"),
+    }
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus 0.0.4."""
+        lines: List[str] = []
+        with self._lock:
+            histograms = {metric: dict(series) for metric, series in self._histograms.items()}
+            counters = {metric: dict(series) for metric, series in self._counters.items()}
+
+        for metric in sorted(set(histograms) | set(counters)):
+            kind, label_names, help_text = self._HELP[metric]
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            if kind == "counter":
+                for labels, value in sorted(counters[metric].items()):
+                    lines.append(f"{metric}{{{_labels(label_names, labels)}}} {value}")
+                continue
+            for labels, histogram in sorted(histograms[metric].items()):
+                counts, total, count = histogram.snapshot()
+                base = _labels(label_names, labels)
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{{{base},le="{bound:g}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{base},le="+Inf"}} {count}')
+                lines.append(f"{metric}_sum{{{base}}} {total:.6f}")
+                lines.append(f"{metric}_count{{{base}}} {count}")
+
+        for source in self._gauge_sources:
+            try:
+                values = source()
+            except Exception as e:
+                lines.append(f"# gauge source failed: {_SPACES.sub(' ', str(e))[:200]}")
+                continue
+            for metric, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def instrument_db(db: DatabaseLayer, registry: MetricsRegistry) -> None:
+    """
+    Подключить метрики к DatabaseLayer: события engine, процедуры,
+    запросы мимо engine и пул.
+
+    У FSM-симулятора (DB_BACKEND=memory) нет engine — там остаются
+    HTTP-метрики и состояние «пула».
+    """
+    db.add_procedure_listener(registry.observe_procedure)
+    db.add_raw_query_listener(registry.observe_raw_query)
+    registry.add_gauges(
+        lambda: {f"db_pool_{key}": value for key, value in db.get_pool_stats().items()}
+    )
+    try:
+        engine = db.engine
+    except DbLayerError:
+        return
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is None:
+            return
+        name = context.execution_options.get("query_name") or query_name(statement)
+        registry.observe_query(name, time.perf_counter() - started, statement)
+
+    def handle_error(exception_context):
+        context = exception_context.execution_context
+        started = getattr(context, "_metrics_started", None)
+        statement = exception_context.statement
+        if started is None or statement is None:
+            return
+        name = context.execution_options.get("query_name") or query_name(statement)
+        registry.observe_query(name, time.perf_counter() - started, statement, error=True)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: время и SQL-работа каждого HTTP-запроса.
+
+    Маршрут — шаблон пути FastAPI (/api/orders/{order_id}), чтобы id
+    не плодили серии; запросы мимо маршрутов идут в route="unmatched".
+    """
+
+    def __init__(self, app, registry: MetricsRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope["path"])
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            route = scope.get("route")
+            stats.route = getattr(route, "path", None) or "unmatched"
+            self.registry.observe_request(
+                scope["method"], stats.route, status, time.perf_counter() - started, stats
+            )
@@ -0,0 +1,466 @@
+"""
+Версионные миграции схемы поверх дампа database/Dump20251127 (1).sql.
+
+Применённые версии хранятся в таблице schema_migrations. Каждый шаг
+идемпотентен (индекс/колонка проверяются через information_schema),
+поэтому миграцию можно безопасно перезапустить после сбоя.
+Параллельный старт нескольких реплик сериализуется через GET_LOCK.
+
+Использование:
+python migrations.py upgrade   # применить недостающие миграции
+python migrations.py status    # какие версии применены
+python migrations.py check     # EXPLAIN горячих запросов: идут ли они по индексу
+python migrations.py backfill-cities  # дозаполнить city_id (идемпотентно)
+python migrations.py recount-trips    # пересчитать trips.order_count по stage_orders
+
+Из кода (main.lifespan, если DB_AUTO_MIGRATE != 0):
+migrations.upgrade(db)
+"""
+
+import argparse
+import logging
+import os
+import sys
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import text
+
+from db_layer import DatabaseLayer
+from log_config import setup_logging, shutdown_logging
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_LOCK = "fsm_schema_migrations"
+
+
+# ==================== ШАГИ МИГРАЦИЙ ====================
+# Шаг — объект с apply(db, conn) -> bool (True, если что-то изменено)
+
+def _index_exists(conn, table: str, name: str) -> bool:
+    return bool(conn.execute(
+        text(
+            "SELECT COUNT(*) FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() "
+            "  AND table_name = :table AND index_name = :name"
+        ),
+        {"table": table, "name": name},
+    ).scalar())
+
+
+class AddIndex:
+    """CREATE INDEX, если индекса с таким именем у таблицы ещё нет."""
+
+    def __init__(self, table: str, name: str, columns: Sequence[str]):
+        self.table = table
+        self.name = name
+        self.columns = list(columns)
+
+    def apply(self, db: DatabaseLayer, conn) -> bool:
+        if _index_exists(conn, self.table, self.name):
+            return False
+        cols = ", ".join(f"`{c}`" for c in self.columns)
+        conn.execute(text(f"CREATE INDEX `{self.name}` ON `{self.table}` ({cols})"))
+        return True
+
+    def __str__(self) -> str:
+        return f"index {self.table}.{self.name} ({', '.join(self.columns)})"
+
+
+class DropIndex:
+    """DROP INDEX, если индекс есть (заменён другим)."""
+
+    def __init__(self, table: str, name: str):
+        self.table = table
+        self.name = name
+
+    def apply(self, db: DatabaseLayer, conn) -> bool:
+        if not _index_exists(conn, self.table, self.name):
+            return False
+        conn.execute(text(f"DROP INDEX `{self.name}` ON `{self.table}`"))
+        return True
+
+    def __str__(self) -> str:
+        return f"drop index {self.table}.{self.name}"
+
+
+class AddColumn:
+    """ALTER TABLE ... ADD COLUMN, если колонки ещё нет."""
+
+    def __init__(self, table: str, column: str, ddl: str):
+        self.table = table
+        self.column = column
+        self.ddl = ddl
+
+    def apply(self, db: DatabaseLayer, conn) -> bool:
+        exists = conn.execute(
+            text(
+                "SELECT COUNT(*) FROM information_schema.columns "
+                "WHERE table_schema = DATABASE() "
+                "  AND table_name = :table AND column_name = :column"
+            ),
+            {"table": self.table, "column": self.column},
+        ).scalar()
+        if exists:
+            return False
+        conn.execute(text(f"ALTER TABLE `{self.table}` ADD COLUMN `{self.column}` {self.ddl}"))
+        return True
+
+    def __str__(self) -> str:
+        return f"column {self.table}.{self.column} {self.ddl}"
+
+
+class CreateTable:
+    """CREATE TABLE IF NOT EXISTS."""
+
+    def __init__(self, name: str, body: str):
+        self.name = name
+        self.body = body
+
+    def apply(self, db: DatabaseLayer, conn) -> bool:
+        exists = conn.execute(
+            text(
+                "SELECT COUNT(*) FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = :name"
+            ),
+            {"name": self.name},
+        ).scalar()
+        if exists:
+            return False
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS `{self.name}` ({self.body})"))
+        return True
+
+    def __str__(self) -> str:
+        return f"table {self.name}"
+
+
+class BackfillCityIds:
+    """Данные: city_id у существующих постаматов, заказов и рейсов."""
+
+    def apply(self, db: DatabaseLayer, conn) -> bool:
+        # На соединении миграции: upgrade() уже держит соединения блокировки
+        # и миграции, а пул CLI — pool_size=1, max_overflow=1
+        counts = db.backfill_city_ids(conn=conn)
+        self.counts = counts
+        return any(counts.values())
+
+    def __str__(self) -> str:
+        return f"backfill city ids {getattr(self, 'counts', {})}"
+
+
+class RecountTripOrders:
+    """Данные: trips.order_count по уже привязанным заказам."""
+
+    def apply(self, db: DatabaseLayer, conn) -> bool:
+        # На соединении миграции, как BackfillCityIds
+        self.fixed = db.recount_trip_order_counts(conn=conn)
+        return bool(self.fixed)
+
+    def __str__(self) -> str:
+        return f"recount trips.order_count ({getattr(self, 'fixed', 0)} trips)"
+
+
+class Migration:
+    def __init__(self, version: int, name: str, steps: List):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "hot_query_indexes", [
+        # Таймауты резерва, биржи курьеров, фильтр get_all_orders по статусу
+        AddIndex("orders", "idx_orders_status_created", ["status", "created_at"]),
+        # get_orders_for_route (маршрут + статусы)
+        AddIndex("orders", "idx_orders_route_status", ["from_city", "to_city", "status"]),
+        # Листинги по дате создания без фильтра по статусу
+        AddIndex("orders", "idx_orders_created", ["created_at"]),
+        # assign_order_to_trip_smart: поиск открытого рейса по маршруту
+        AddIndex("trips", "idx_trips_route_status", ["from_city", "to_city", "status"]),
+        # История переходов сущности
+        AddIndex("fsm_action_logs", "idx_fsm_action_logs_entity", ["entity_type", "entity_id"]),
+    ]),
+    Migration(2, "courier_exchange_indexes", [
+        # Страницы бирж: WHERE status, тип, город ORDER BY created_at, id
+        AddIndex("orders", "idx_orders_exchange_pickup",
+                 ["status", "pickup_type", "from_city", "created_at"]),
+        AddIndex("orders", "idx_orders_exchange_delivery",
+                 ["status", "delivery_type", "to_city", "created_at"]),
+        # Опрос бирж по since: тот же фильтр, порядок updated_at, id
+        AddIndex("orders", "idx_orders_exchange_pickup_upd",
+                 ["status", "pickup_type", "from_city", "updated_at"]),
+        AddIndex("orders", "idx_orders_exchange_delivery_upd",
+                 ["status", "delivery_type", "to_city", "updated_at"]),
+    ]),
+    Migration(3, "normalized_city_ids", [
+        CreateTable(
+            "cities",
+            "id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,"
+            " name VARCHAR(100) NOT NULL,"
+            " UNIQUE KEY uq_cities_name (name)",
+        ),
+        AddColumn("lockers", "city_id", "INT NULL"),
+        AddColumn("orders", "from_city_id", "INT NULL"),
+        AddColumn("orders", "to_city_id", "INT NULL"),
+        AddColumn("trips", "from_city_id", "INT NULL"),
+        AddColumn("trips", "to_city_id", "INT NULL"),
+        AddIndex("lockers", "idx_lockers_city", ["city_id"]),
+        # Маршруты и биржи сравнивают id городов вместо строк
+        AddIndex("orders", "idx_orders_route_ids", ["from_city_id", "to_city_id", "status"]),
+        AddIndex("trips", "idx_trips_route_ids", ["from_city_id", "to_city_id", "status"]),
+        AddIndex("orders", "idx_orders_exchange_pickup_city",
+                 ["status", "pickup_type", "from_city_id", "created_at"]),
+        AddIndex("orders", "idx_orders_exchange_delivery_city",
+                 ["status", "delivery_type", "to_city_id", "created_at"]),
+        AddIndex("orders", "idx_orders_exchange_pickup_city_upd",
+                 ["status", "pickup_type", "from_city_id", "updated_at"]),
+        AddIndex("orders", "idx_orders_exchange_delivery_city_upd",
+                 ["status", "delivery_type", "to_city_id", "updated_at"]),
+        DropIndex("orders", "idx_orders_route_status"),
+        DropIndex("trips", "idx_trips_route_status"),
+        DropIndex("orders", "idx_orders_exchange_pickup"),
+        DropIndex("orders", "idx_orders_exchange_delivery"),
+        DropIndex("orders", "idx_orders_exchange_pickup_upd"),
+        DropIndex("orders", "idx_orders_exchange_delivery_upd"),
+        BackfillCityIds(),
+    ]),
+    Migration(4, "trip_order_count", [
+        # Занятые места в рейсе: условный инкремент вместо COUNT(*) по stage_orders
+        AddColumn("trips", "order_count", "INT NOT NULL DEFAULT 0"),
+        # _allocate_trip_slot: маршрут + статус + order_count < max
+        AddIndex("trips", "idx_trips_route_slots",
+                 ["from_city_id", "to_city_id", "status", "order_count"]),
+        DropIndex("trips", "idx_trips_route_ids"),
+        RecountTripOrders(),
+    ]),
+    Migration(5, "exchange_changes_indexes", [
+        # Опрос бирж после старта: все изменения заказов типа courier
+        # по городу (без статуса, ушедшие с биржи — removed)
+        AddIndex("orders", "idx_orders_pickup_changes",
+                 ["pickup_type", "from_city_id", "updated_at"]),
+        AddIndex("orders", "idx_orders_delivery_changes",
+                 ["delivery_type", "to_city_id", "updated_at"]),
+    ]),
+]
+
+
+# ==================== ПРИМЕНЕНИЕ ====================
+
+def _ensure_table(conn) -> None:
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "  version INT NOT NULL PRIMARY KEY,"
+            "  name VARCHAR(255) NOT NULL,"
+            "  applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP"
+            ")"
+        )
+    )
+
+
+def applied_versions(db: DatabaseLayer) -> Dict[int, str]:
+    """{version: applied_at} для уже применённых миграций."""
+    with db.engine.begin() as conn:
+        _ensure_table(conn)
+        rows = conn.execute(
+            text("SELECT version, applied_at FROM schema_migrations ORDER BY version")
+        ).fetchall()
+    return {row[0]: str(row[1]) for row in rows}
+
+
+def upgrade(db: DatabaseLayer, lock_timeout: int = 60) -> List[int]:
+    """
+    Применить все недостающие миграции по порядку версий.
+
+    Returns:
+        Список применённых сейчас версий.
+    """
+    with db.advisory_lock(MIGRATIONS_LOCK, timeout=lock_timeout) as acquired:
+        if not acquired:
+            raise RuntimeError("Миграции уже выполняет другой процесс")
+
+        done = applied_versions(db)
+        applied: List[int] = []
+        for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+            if migration.version in done:
+                continue
+            # DDL в MySQL коммитится неявно, поэтому версия записывается
+            # после всех шагов, а сами шаги идемпотентны
+            with db.engine.begin() as conn:
+                for step in migration.steps:
+                    if step.apply(db, conn):
+                        logger.info(
+                            "Миграция %s: %s", migration.version, step,
+                            extra={"migration": migration.version},
+                        )
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                    {"version": migration.version, "name": migration.name},
+                )
+            applied.append(migration.version)
+        return applied
+
+
+def status(db: DatabaseLayer) -> List[Dict]:
+    done = applied_versions(db)
+    return [
+        {
+            "version": m.version,
+            "name": m.name,
+            "applied_at": done.get(m.version),
+        }
+        for m in sorted(MIGRATIONS, key=lambda m: m.version)
+    ]
+
+
+# ==================== ПРОВЕРКА ПЛАНОВ ====================
+
+# Горячие запросы db_layer: (таблица в плане, SQL, параметры)
+HOT_QUERIES: Dict[str, tuple] = {
+    "reservation_timeouts": (
+        "orders",
+        "SELECT id, status FROM orders "
+        "WHERE status IN ('order_courier_reserved_post1_and_post2', 'order_client_reserved_post1_and_post2') "
+        "  AND created_at < NOW() - INTERVAL 1800 SECOND",
+        {},
+    ),
+    "orders_for_route": (
+        "orders",
+        "SELECT id, status FROM orders "
+        "WHERE from_city_id = 1 AND to_city_id = 2 AND status IN ('order_created')",
+        {},
+    ),
+    "all_orders_by_status": (
+        "orders",
+        "SELECT id, status FROM orders WHERE status IN ('order_created')",
+        {},
+    ),
+    "exchange_courier1": (
+        "o",
+        "SELECT o.id FROM orders o "
+        "WHERE o.status = 'order_courier_reserved_post1_and_post2' AND o.pickup_type = 'courier' "
+        "  AND o.from_city_id = 1 "
+        "ORDER BY o.created_at ASC, o.id ASC LIMIT 50",
+        {},
+    ),
+    "exchange_courier2": (
+        "o",
+        "SELECT o.id FROM orders o "
+        "WHERE o.status = 'order_parcel_confirmed_post2' AND o.delivery_type = 'courier' "
+        "  AND o.to_city_id = 2 "
+        "ORDER BY o.created_at ASC, o.id ASC LIMIT 50",
+        {},
+    ),
+    "exchange_courier1_since": (
+        "o",
+        "SELECT o.id FROM orders o "
+        "WHERE o.status = 'order_courier_reserved_post1_and_post2' AND o.pickup_type = 'courier' "
+        "  AND o.from_city_id = 1 AND o.updated_at > NOW() - INTERVAL 1 MINUTE "
+        "ORDER BY o.updated_at ASC, o.id ASC LIMIT 50",
+        {},
+    ),
+    "exchange_courier1_changes": (
+        "o",
+        "SELECT o.id, o.status FROM orders o "
+        "WHERE o.pickup_type = 'courier' "
+        "  AND o.from_city_id = 1 AND o.updated_at > NOW() - INTERVAL 1 MINUTE "
+        "ORDER BY o.updated_at ASC, o.id ASC LIMIT 50",
+        {},
+    ),
+    "trip_slot_for_route": (
+        "t",
+        "SELECT t.id FROM trips t "
+        "WHERE t.from_city_id = 1 AND t.to_city_id = 2 "
+        "  AND t.status IN ('trip_created', 'trip_assigned') AND t.order_count < 5 "
+        "ORDER BY t.id LIMIT 1",
+        {},
+    ),
+    "entity_history": (
+        "fsm_action_logs",
+        "SELECT id FROM fsm_action_logs WHERE entity_type = 'order' AND entity_id = 1",
+        {},
+    ),
+}
+
+
+def check(db: DatabaseLayer, names: Optional[List[str]] = None) -> Dict[str, Dict]:
+    """
+    EXPLAIN каждого горячего запроса.
+
+    Запрос считается проблемным, если по его основной таблице план — полный
+    скан (type = ALL) или индекс не выбран. На почти пустых таблицах
+    оптимизатор вправе предпочесть скан — проверять на реальных данных.
+    """
+    report: Dict[str, Dict] = {}
+    with db.engine.connect() as conn:
+        for name, (table, sql, params) in HOT_QUERIES.items():
+            if names and name not in names:
+                continue
+            rows = conn.execute(text("EXPLAIN " + sql), params).mappings().fetchall()
+            plan = next((r for r in rows if r["table"] == table), rows[0] if rows else {})
+            key = plan.get("key")
+            report[name] = {
+                "ok": bool(key) and plan.get("type") != "ALL",
+                "key": key,
+                "type": plan.get("type"),
+                "rows": plan.get("rows"),
+            }
+    return report
+
+
+# ==================== CLI ====================
+
+def db_from_env() -> DatabaseLayer:
+    return DatabaseLayer(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=int(os.getenv("DB_PORT", "3307")),
+        database=os.getenv("DB_NAME", "testdb"),
+        user=os.getenv("DB_USER", "root"),
+        password=os.getenv("DB_PASSWORD", "root"),
+        pool_size=1,
+        max_overflow=1,
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Миграции схемы FSM")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("upgrade", help="Применить недостающие миграции")
+    sub.add_parser("status", help="Показать применённые версии")
+    sub.add_parser("backfill-cities", help="Дозаполнить city_id постаматов, заказов и рейсов")
+    sub.add_parser("recount-trips", help="Пересчитать trips.order_count по stage_orders")
+    check_parser = sub.add_parser("check", help="EXPLAIN горячих запросов")
+    check_parser.add_argument("queries", nargs="*", help="Имена запросов (по умолчанию все)")
+    args = parser.parse_args()
+
+    setup_logging()
+    db = db_from_env()
+    try:
+        if args.command == "upgrade":
+            applied = upgrade(db)
+            print(f"Применено миграций: {len(applied)} {applied}")
+        elif args.command == "status":
+            for row in status(db):
+                mark = row["applied_at"] or "не применена"
+                print(f"{row['version']:>4}  {row['name']:<30} {mark}")
+        elif args.command == "backfill-cities":
+            for key, count in db.backfill_city_ids().items():
+                print(f"{key:<22} {count}")
+        elif args.command == "recount-trips":
+            print(f"Исправлено рейсов: {db.recount_trip_order_counts()}")
+        elif args.command == "check":
+            report = check(db, args.queries or None)
+            failed = [name for name, r in report.items() if not r["ok"]]
+            for name, r in report.items():
+                mark = "OK  " if r["ok"] else "SCAN"
+                print(f"{mark} {name:<24} key={r['key']} type={r['type']} rows={r['rows']}")
+            if failed:
+                print(f"Без индекса: {', '.join(failed)}")
+                return 1
+        return 0
+    finally:
+        db.close()
+        shutdown_logging()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from typing import Optional, List, Dict
 
 # ========== REQUEST MODELS ==========
 class OrderCreateRequest(BaseModel):
@@ -10,6 +10,16 @@ class OrderCreateRequest(BaseModel):
     dest_cell_id: Optional[int] = None
     delivery_type: Optional[str] = None
 
+class OrderBulkItem(BaseModel):
+    """Строка /api/orders/bulk: маршрут — городами или ячейками постаматов."""
+    description: str
+    from_city: Optional[str] = None
+    to_city: Optional[str] = None
+    source_cell_id: Optional[int] = None
+    dest_cell_id: Optional[int] = None
+    pickup_type: str = "courier"
+    delivery_type: str = "courier"
+
 class TripCreateRequest(BaseModel):
     from_city: str
     to_city: str
@@ -24,6 +34,18 @@ class FsmActionRequest(BaseModel):
     user_id: int
     extra_id: Optional[str] = None
 
+class FsmBatchRequest(BaseModel):
+    actions: List[FsmActionRequest] = Field(..., max_length=500)
+    atomic: bool = False  # True — всё или ничего
+
+class EntityRef(BaseModel):
+    entity_type: str
+    entity_id: int
+
+class ButtonsBulkRequest(BaseModel):
+    user_role: str
+    entities: List[EntityRef] = Field(..., max_length=1000)
+
 class UserCreateRequest(BaseModel):
     user_id: int
     name: str
@@ -36,6 +58,10 @@ class LockerCreateRequest(BaseModel):
     location_address: str
     model_id: int = 1
 
+class LockersProvisionRequest(BaseModel):
+    lockers: List[LockerCreateRequest] = Field(..., max_length=1000)
+    with_cells: bool = True  # сразу создать ячейки по locker_models
+
 class CellCreateRequest(BaseModel):
     locker_id: int
     cell_code: str
@@ -53,6 +79,16 @@ class OrderResponse(BaseModel):
     source_cell_id: Optional[int]
     dest_cell_id: Optional[int]
 
+class OrdersPage(BaseModel):
+    orders: List[dict]
+    next_cursor: Optional[str] = None  # None — это последняя страница
+
+class OrdersBulkResponse(BaseModel):
+    created: int
+    failed: int
+    trips_created: int
+    results: List[dict]  # по порядку входа: {"index", "order_id", "trip_id"} или {"index", "error"}
+
 class TripResponse(BaseModel):
     id: int
     status: str
@@ -72,6 +108,10 @@ class ButtonResponse(BaseModel):
     button_name: str
     is_enabled: bool
 
+class ButtonsBulkResponse(BaseModel):
+    buttons: Dict[str, List[ButtonResponse]]  # ключ "entity_type:entity_id"
+    missing: List[str]
+
 class ApiResponse(BaseModel):
     success: bool
     message: str
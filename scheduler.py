@@ -0,0 +1,186 @@
+"""
+Фоновый планировщик таймаутов внутри процесса API.
+
+Заменяет внешний крон, который дёргал POST /api/timeouts/process:
+- каждая задача крутится в своей asyncio-задаче с интервалом и jitter;
+- новый прогон задачи не начинается, пока не закончился предыдущий;
+- между репликами прогон защищён GET_LOCK: если блокировку держит
+  другая реплика, тик пропускается;
+- по каждой задаче копится статистика (длительность, счётчики и первые id последнего прогона).
+
+Использование (см. main.lifespan):
+scheduler = Scheduler(adb)
+scheduler.add_job("reservation_timeouts", 30, sweep_reservations)
+scheduler.start()
+...
+await scheduler.stop()
+"""
+
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from db_layer import AsyncDatabaseLayer, DatabaseLayer
+
+logger = logging.getLogger(__name__)
+
+# Сколько id хранить в last_result задачи: /health и /api/scheduler отдают
+# его на каждый запрос, полные списки после большого прогона слишком велики
+RESULT_SAMPLE_SIZE = 20
+
+
+class ScheduledJob:
+    """Периодическая задача планировщика и её статистика."""
+
+    def __init__(
+        self,
+        name: str,
+        interval: float,
+        func: Callable[[DatabaseLayer], Dict[str, Any]],
+        jitter: float = 0.1,
+        lock_name: Optional[str] = None,
+    ):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.jitter = jitter
+        self.lock_name = lock_name or f"fsm_scheduler:{name}"
+        self._lock = asyncio.Lock()
+
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_started_at: Optional[datetime] = None
+        self.last_duration_sec: Optional[float] = None
+        self.last_result: Optional[Dict[str, Any]] = None
+        self.last_error: Optional[str] = None
+
+    def next_delay(self) -> float:
+        """Интервал ± jitter (доля интервала), чтобы реплики не били в БД разом."""
+        spread = self.interval * self.jitter
+        return max(0.0, self.interval + random.uniform(-spread, spread))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval_sec": self.interval,
+            "running": self._lock.locked(),
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "last_started_at": self.last_started_at.isoformat() if self.last_started_at else None,
+            "last_duration_sec": self.last_duration_sec,
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+        }
+
+
+class Scheduler:
+    """Запускает ScheduledJob в event loop, работу с БД — в пуле AsyncDatabaseLayer."""
+
+    def __init__(self, adb: AsyncDatabaseLayer):
+        self.adb = adb
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def add_job(
+        self,
+        name: str,
+        interval: float,
+        func: Callable[[DatabaseLayer], Dict[str, Any]],
+        jitter: float = 0.1,
+    ) -> ScheduledJob:
+        job = ScheduledJob(name, interval, func, jitter=jitter)
+        self.jobs[name] = job
+        return job
+
+    def start(self) -> None:
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._loop(job), name=f"scheduler:{job.name}"))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def run_job(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Выполнить задачу сейчас.
+
+        Возвращает результат или None, если прогон пропущен: задача уже идёт
+        в этом процессе или блокировку держит другая реплика.
+        """
+        job = self.jobs[name]
+        if job._lock.locked():
+            job.skipped += 1
+            return None
+
+        async with job._lock:
+            job.last_started_at = datetime.now()
+            started = time.perf_counter()
+            try:
+                result = await self.adb.run(self._run_locked, job)
+            except Exception as e:
+                job.errors += 1
+                job.last_error = str(e)
+                logger.exception("Планировщик: задача %s упала", job.name, extra={"job": job.name})
+                return None
+            finally:
+                job.last_duration_sec = round(time.perf_counter() - started, 3)
+
+            if result is None:
+                job.skipped += 1
+                return None
+            job.runs += 1
+            job.last_result = result
+            job.last_error = None
+            return result
+
+    def _run_locked(self, job: ScheduledJob) -> Optional[Dict[str, Any]]:
+        """Выполняется в потоке БД: GET_LOCK на время прогона задачи."""
+        db = self.adb.db
+        with db.advisory_lock(job.lock_name) as acquired:
+            if not acquired:
+                return None
+            return job.func(db)
+
+    async def _loop(self, job: ScheduledJob) -> None:
+        while True:
+            await asyncio.sleep(job.next_delay())
+            await self.run_job(job.name)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+
+# ==================== ЗАДАЧИ ====================
+
+def reservation_timeouts_job(timeout_seconds: int) -> Callable[[DatabaseLayer], Dict[str, Any]]:
+    """Перевод просроченных резервов заказов (order_timeout_reservation)."""
+
+    def job(db: DatabaseLayer) -> Dict[str, Any]:
+        result = db.check_and_process_reservation_timeouts(timeout_seconds)
+        return {
+            "processed": len(result["processed"]),
+            "failed": len(result["failed"]),
+            "processed_order_ids_sample": result["processed"][:RESULT_SAMPLE_SIZE],
+            "failed_order_ids_sample": result["failed"][:RESULT_SAMPLE_SIZE],
+        }
+
+    return job
+
+
+def trip_activation_job(max_orders: int, wait_hours: float) -> Callable[[DatabaseLayer], Dict[str, Any]]:
+    """Активация набравших заказы или заждавшихся рейсов."""
+
+    def job(db: DatabaseLayer) -> Dict[str, Any]:
+        trip_ids = db.update_trip_active_flags(max_orders, wait_hours)
+        return {
+            "processed": len(trip_ids),
+            "activated_trip_ids_sample": trip_ids[:RESULT_SAMPLE_SIZE],
+        }
+
+    return job
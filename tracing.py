@@ -0,0 +1,473 @@
+"""
+Трассировка HTTP-запросов до SQL: где ушло время медленного запроса.
+
+На каждый HTTP-запрос TracingMiddleware заводит трассу (contextvars;
+AsyncDatabaseLayer.run() переносит их в поток БД) и собирает спаны:
+- fastapi.validation — разбор тела, валидация и зависимости (TracedRoute);
+- fastapi.endpoint — код обработчика, fastapi.serialize — ответ;
+- db.pool.wait — ожидание соединения из пула (TracedQueuePool);
+- db.query — каждый SQL-запрос через engine (события cursor_execute)
+  и потоковое чтение заказов мимо engine (add_raw_query_listener);
+- db.procedure — хранимые процедуры (fsm_perform_action и др.).
+
+Итог по категориям уходит в заголовок ответа Server-Timing
+(validation, pool, db, proc, app), сами спаны — в экспортёр в формате
+ConsoleSpanExporter OpenTelemetry (JSON на строку, id в hex, время ISO 8601).
+Входящий заголовок traceparent (W3C) продолжает чужую трассу, в ответ
+отдаётся traceparent корневого спана.
+
+Настройка (см. main.py):
+TRACE_EXPORTER=none|console|file   куда писать спаны (none — только Server-Timing)
+TRACE_FILE=traces.jsonl            файл для file
+TRACE_SAMPLE_RATIO=1.0             доля экспортируемых трасс
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+from db_layer import DatabaseLayer, DbLayerError
+from metrics import query_name
+
+# Категории Server-Timing в порядке вывода
+SERVER_TIMING_CATEGORIES = ("validation", "pool", "db", "proc")
+
+# Сколько символов SQL сохранять в db.statement
+MAX_STATEMENT_LENGTH = 1000
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_ids = random.Random()
+
+
+def _new_id(bits: int) -> str:
+    return f"{_ids.getrandbits(bits):0{bits // 4}x}"
+
+
+def _iso(ns: int) -> str:
+    return datetime.fromtimestamp(ns / 1e9, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class Span:
+    """Один интервал трассы (кусок работы с началом, концом и атрибутами)."""
+
+    __slots__ = (
+        "name", "trace_id", "span_id", "parent_id", "kind",
+        "start_ns", "end_ns", "attributes", "error",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        kind: str = "INTERNAL",
+        start_ns: Optional[int] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set_error(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"[:500]
+
+    def to_otel(self, resource: Dict[str, Any]) -> Dict:
+        """Словарь в формате ConsoleSpanExporter (span.to_json()) OpenTelemetry SDK."""
+        return {
+            "name": self.name,
+            "context": {
+                "trace_id": f"0x{self.trace_id}",
+                "span_id": f"0x{self.span_id}",
+                "trace_state": "[]",
+            },
+            "kind": f"SpanKind.{self.kind}",
+            "parent_id": f"0x{self.parent_id}" if self.parent_id else None,
+            "start_time": _iso(self.start_ns),
+            "end_time": _iso(self.end_ns or self.start_ns),
+            "status": (
+                {"status_code": "ERROR", "description": self.error}
+                if self.error
+                else {"status_code": "UNSET"}
+            ),
+            "attributes": self.attributes,
+            "events": [],
+            "links": [],
+            "resource": {"attributes": resource, "schema_url": ""},
+        }
+
+
+class RequestTrace:
+    """Трасса одного HTTP-запроса: корневой спан, дочерние спаны и суммы для Server-Timing."""
+
+    def __init__(self, root: Span, sampled: bool):
+        self.root = root
+        self.sampled = sampled
+        self.spans: List[Span] = []
+        self.timings: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.handler_started_ns: Optional[int] = None
+        self.endpoint_started = False
+        self.endpoint_ended_ns: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def add(self, span: Span, category: Optional[str] = None) -> None:
+        """Завершённый спан (из любого потока); category — строка Server-Timing."""
+        with self._lock:
+            if self.sampled:
+                self.spans.append(span)
+            if category:
+                self.timings[category] = self.timings.get(category, 0.0) + span.duration_ms
+                self.counts[category] = self.counts.get(category, 0) + 1
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing на текущий момент."""
+        with self._lock:
+            parts = [
+                f'{category};dur={self.timings[category]:.2f};desc="{self.counts[category]}x"'
+                for category in SERVER_TIMING_CATEGORIES
+                if category in self.timings
+            ]
+        parts.append(f"app;dur={self.root.duration_ms:.2f}")
+        return ", ".join(parts)
+
+
+current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("trace", default=None)
+# Спан, к которому цепляются дочерние (по умолчанию — корневой)
+current_span: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+
+def record_span(
+    name: str,
+    start_ns: int,
+    end_ns: int,
+    category: Optional[str] = None,
+    attributes: Optional[Dict[str, Any]] = None,
+    error: Optional[BaseException] = None,
+    kind: str = "INTERNAL",
+) -> None:
+    """Добавить уже закончившийся интервал в трассу текущего запроса (вне запроса — ничего)."""
+    trace = current_trace.get()
+    if trace is None:
+        return
+    parent = current_span.get() or trace.root
+    span = Span(name, trace.root.trace_id, parent.span_id, kind, start_ns, attributes)
+    span.end_ns = end_ns
+    if error is not None:
+        span.set_error(error)
+    trace.add(span, category)
+
+
+class TraceContextFilter(logging.Filter):
+    """Фильтр логов: добавляет к записи trace_id и span_id текущего запроса."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace = current_trace.get()
+        if trace is not None:
+            record.trace_id = trace.root.trace_id
+            record.span_id = (current_span.get() or trace.root).span_id
+        return True
+
+
+class TracedQueuePool(QueuePool):
+    """QueuePool, который пишет в трассу время ожидания соединения (db.pool.wait)."""
+
+    def _do_get(self):
+        if current_trace.get() is None:
+            return super()._do_get()
+        started = time.time_ns()
+        error: Optional[BaseException] = None
+        try:
+            return super()._do_get()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            record_span(
+                "db.pool.wait", started, time.time_ns(), "pool",
+                {"db.pool.size": self.size(), "db.pool.checked_out": self.checkedout()},
+                error,
+            )
+
+
+def instrument_db(db: DatabaseLayer) -> None:
+    """
+    Спаны SQL-запросов (через engine и мимо него) и процедур DatabaseLayer.
+
+    Ожидание пула видно, только если engine создан с
+    poolclass=TracedQueuePool. У FSM-симулятора нет engine — спанов БД нет.
+    """
+    def on_procedure(name: str, seconds: float, error: Optional[BaseException]) -> None:
+        end_ns = time.time_ns()
+        record_span(
+            f"CALL {name}", end_ns - int(seconds * 1e9), end_ns, "proc",
+            {"db.system": "mysql", "db.operation": "CALL", "db.procedure": name},
+            error, "CLIENT",
+        )
+
+    def query_span(
+        name: str, statement: str, start_ns: int, end_ns: int, error: Optional[BaseException]
+    ) -> None:
+        record_span(
+            name, start_ns, end_ns, "db",
+            {
+                "db.system": "mysql",
+                "db.operation": statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "",
+                "db.statement": statement[:MAX_STATEMENT_LENGTH],
+                "db.query_name": name,
+            },
+            error, "CLIENT",
+        )
+
+    def on_raw_query(statement: str, seconds: float, error: Optional[BaseException]) -> None:
+        end_ns = time.time_ns()
+        query_span(query_name(statement), statement, end_ns - int(seconds * 1e9), end_ns, error)
+
+    db.add_procedure_listener(on_procedure)
+    db.add_raw_query_listener(on_raw_query)
+    try:
+        engine = db.engine
+    except DbLayerError:
+        return
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None and current_trace.get() is not None:
+            context._trace_started = time.time_ns()
+
+    def finish(context, statement: str, error: Optional[BaseException] = None) -> None:
+        started = getattr(context, "_trace_started", None)
+        if started is None:
+            return
+        context._trace_started = None
+        name = context.execution_options.get("query_name") or query_name(statement)
+        query_span(name, statement, started, time.time_ns(), error)
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        finish(context, statement)
+
+    def handle_error(exception_context):
+        context = exception_context.execution_context
+        if context is not None and exception_context.statement is not None:
+            finish(context, exception_context.statement, exception_context.original_exception)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+class TracedRoute(APIRoute):
+    """
+    Маршрут FastAPI, отделяющий в трассе валидацию от кода обработчика.
+
+    fastapi.validation — от входа в обработчик маршрута до вызова функции
+    эндпоинта (чтение тела, pydantic, зависимости), fastapi.endpoint — сама
+    функция, fastapi.serialize — проверка response_model и сборка ответа.
+    Подключается до объявления маршрутов: app.router.route_class = TracedRoute.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        # get_request_handler берёт функцию из dependant.call при каждом запросе
+        self.dependant.call = self._traced_call(self.dependant.call)
+
+    @staticmethod
+    def _traced_call(call: Callable) -> Callable:
+        def start(trace: RequestTrace) -> Span:
+            now = time.time_ns()
+            if trace.handler_started_ns is not None:
+                record_span("fastapi.validation", trace.handler_started_ns, now, "validation")
+            trace.endpoint_started = True
+            return Span("fastapi.endpoint", trace.root.trace_id, trace.root.span_id, start_ns=now)
+
+        def finish(trace: RequestTrace, span: Span) -> None:
+            span.end_ns = trace.endpoint_ended_ns = time.time_ns()
+            trace.add(span)
+
+        if asyncio.iscoroutinefunction(call):
+            @functools.wraps(call)
+            async def traced(*args: Any, **kwargs: Any) -> Any:
+                trace = current_trace.get()
+                if trace is None:
+                    return await call(*args, **kwargs)
+                span = start(trace)
+                token = current_span.set(span)
+                try:
+                    return await call(*args, **kwargs)
+                except BaseException as e:
+                    span.set_error(e)
+                    raise
+                finally:
+                    current_span.reset(token)
+                    finish(trace, span)
+        else:
+            @functools.wraps(call)
+            def traced(*args: Any, **kwargs: Any) -> Any:
+                trace = current_trace.get()
+                if trace is None:
+                    return call(*args, **kwargs)
+                span = start(trace)
+                token = current_span.set(span)
+                try:
+                    return call(*args, **kwargs)
+                except BaseException as e:
+                    span.set_error(e)
+                    raise
+                finally:
+                    current_span.reset(token)
+                    finish(trace, span)
+        return traced
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def traced_handler(request):
+            trace = current_trace.get()
+            if trace is None:
+                return await handler(request)
+            trace.handler_started_ns = time.time_ns()
+            error: Optional[BaseException] = None
+            try:
+                return await handler(request)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                now = time.time_ns()
+                if not trace.endpoint_started:
+                    # До эндпоинта не дошли — запрос отклонила валидация
+                    record_span(
+                        "fastapi.validation", trace.handler_started_ns, now, "validation",
+                        error=error,
+                    )
+                elif error is None and trace.endpoint_ended_ns is not None:
+                    record_span("fastapi.serialize", trace.endpoint_ended_ns, now)
+
+        return traced_handler
+
+
+class SpanExporter:
+    """
+    Запись спанов JSON-строками в фоне (очередь + поток), чтобы запрос
+    не ждал вывода. target — "console" (stdout) или путь к файлу.
+    """
+
+    def __init__(self, target: str, service_name: str = "fsm-api"):
+        self.target = target
+        self.resource = {"service.name": service_name, "telemetry.sdk.language": "python"}
+        self._queue: "queue.SimpleQueue[Optional[List[Span]]]" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="span_exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, spans: List[Span]) -> None:
+        self._queue.put(spans)
+
+    def _run(self) -> None:
+        stream = sys.stdout if self.target == "console" else open(self.target, "a", encoding="utf-8")
+        try:
+            while True:
+                spans = self._queue.get()
+                if spans is None:
+                    return
+                for span in spans:
+                    stream.write(json.dumps(span.to_otel(self.resource), ensure_ascii=False) + "\n")
+                if self._queue.empty():
+                    stream.flush()
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+    def shutdown(self) -> None:
+        """Дописать накопленное и остановить поток."""
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class TracingMiddleware:
+    """
+    ASGI-middleware: трасса на каждый HTTP-запрос, Server-Timing и traceparent в ответе.
+
+    exporter=None — спаны не пишутся, Server-Timing считается всё равно.
+    """
+
+    def __init__(self, app, exporter: Optional[SpanExporter] = None, sample_ratio: float = 1.0):
+        self.app = app
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id, parent_id = None, None
+        for name, value in scope.get("headers", ()):
+            if name == b"traceparent":
+                match = _TRACEPARENT.match(value.decode("latin-1").strip())
+                if match:
+                    trace_id, parent_id = match.group(1), match.group(2)
+                break
+        method = scope["method"]
+        root = Span(
+            f"{method} {scope['path']}", trace_id or _new_id(128), parent_id, "SERVER",
+            attributes={"http.request.method": method, "url.path": scope["path"]},
+        )
+        sampled = self.exporter is not None and _ids.random() < self.sample_ratio
+        trace = RequestTrace(root, sampled)
+        trace_token = current_trace.set(trace)
+        span_token = current_span.set(root)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", ()))
+                headers.append((b"server-timing", trace.server_timing().encode()))
+                headers.append((
+                    b"traceparent",
+                    f"00-{root.trace_id}-{root.span_id}-{'01' if sampled else '00'}".encode(),
+                ))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            root.set_error(e)
+            raise
+        finally:
+            current_span.reset(span_token)
+            current_trace.reset(trace_token)
+            root.end_ns = time.time_ns()
+            route = getattr(scope.get("route"), "path", None)
+            if route:
+                root.name = f"{method} {route}"
+                root.attributes["http.route"] = route
+            root.attributes["http.response.status_code"] = status
+            if status >= 500 and root.error is None:
+                root.error = f"HTTP {status}"
+            if sampled:
+                self.exporter.export(trace.spans + [root])